@@ -1,11 +1,11 @@
 # Basic imports
-import os, json, logging, tempfile
+import os, json, logging
 from dotenv import load_dotenv, find_dotenv
 
 # Init logging
 import logging
 
-import requests
+from typing import List
 
 
 log = logging.getLogger(__name__)
@@ -13,26 +13,38 @@ log = logging.getLogger(__name__)
 # FastAPI, Starlette, Pydantic etc...
 import fastapi
 from fastapi import FastAPI
-from fastapi.datastructures import UploadFile
-from fastapi.params import File
 from fastapi.exceptions import HTTPException
-from starlette.responses import RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
 
 
 # Import our components
 from app.utils import timed
 
 from app.extractor import UNIVERSAL_EXTRACTOR
+from app.extractor.upload import (
+    UPLOAD_FORM_SLACK_BYTES,
+    UPLOAD_MAX_BYTES,
+    SpooledUpload,
+    UploadTooLarge,
+)
 from app.models import (
     DefinitionResponse,
+    DefinitionsRequest,
     ExtractorRequest,
     ExtractorResponse,
     ImmersiveReaderTokenResponse,
     PipelineExecutionRequest,
     PipelineExecutionResponse,
+    PipelineInfo,
+    ReadinessResponse,
 )
 
-from app.pipeline import PipelineFactoryInstance
+from app.pipeline import PipelineFactoryInstance, ResultCacheInstance
+from app.executor import ExecutorQueueFull, PipelineExecutorInstance
+from app.dictionary import DICTIONARY_MAX_TERMS, DictionaryInstance
+from app.http_clients import HttpClientsInstance
+from app.immersive_reader import ImmersiveReaderTokenInstance
+from app.warmup import PipelineWarmupInstance
 
 
 # Load environment vars
@@ -51,12 +63,92 @@ api = FastAPI(
 )
 
 
+# The upload endpoints parse the multipart body themselves, this is the form they expect
+UPLOAD_FORM_SCHEMA = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "title": "Upload",
+                "type": "object",
+                "required": ["file"],
+                "properties": {
+                    "file": {"title": "File", "type": "string", "format": "binary"}
+                },
+            }
+        }
+    },
+}
+
+
+def openapi() -> dict:
+    """
+    FastAPI's OpenAPI schema, plus the form of the upload endpoints
+    """
+    if api.openapi_schema is None:
+        schema = FastAPI.openapi(api)
+        for path, operations in schema.get("paths", {}).items():
+            if path.endswith("/upload") and "post" in operations:
+                operations["post"]["requestBody"] = UPLOAD_FORM_SCHEMA
+
+    return api.openapi_schema
+
+
+api.openapi = openapi
+
+
+@api.middleware("http")
+async def limit_upload_size(request: fastapi.Request, call_next):
+    """
+    Rejects uploads that announce a body larger than UPLOAD_MAX_BYTES right away, before the body is read.
+    (Uploads without a Content-Length, e.g. chunked ones, are counted while they arrive, see SpooledUpload.from_stream)
+    """
+    length = request.headers.get("content-length", "")
+    # some slack for the multipart headers and boundaries
+    if (
+        request.url.path.endswith("/upload")
+        and length.isdigit()
+        and int(length) > UPLOAD_MAX_BYTES + UPLOAD_FORM_SLACK_BYTES
+    ):
+        return JSONResponse(
+            {"detail": f"Upload exceeds the max. size of {UPLOAD_MAX_BYTES} bytes"},
+            status_code=413,
+        )
+
+    return await call_next(request)
+
+
 @api.get("/", include_in_schema=False)
 async def docs_redirect():
     log.info("Redirecting / to openAPI /docs ")
     return RedirectResponse(f"docs")
 
 
+@api.get(
+    "/healthz",
+    description="Liveness probe: the API process is up and serving requests.",
+    tags=["health"],
+)
+async def healthz():
+    return {"status": "ok"}
+
+
+@api.get(
+    "/readyz",
+    description="Readiness probe: returns 200 once all pipelines configured in WARMUP_PIPELINES \
+        are loaded and warmed up, 503 before that (or if a warm-up failed). \
+        Reports status, load and warm-up time per pipeline.",
+    tags=["health"],
+    response_model=ReadinessResponse,
+)
+async def readyz():
+    readiness = ReadinessResponse(
+        ready=PipelineWarmupInstance.ready,
+        pipelines=PipelineWarmupInstance.status,
+    )
+    return JSONResponse(readiness.dict(), status_code=200 if readiness.ready else 503)
+
+
 """
 ---
 --- Pipeline execution endpoints: Run pipeline on some raw input text. 
@@ -65,6 +157,21 @@ async def docs_redirect():
 """
 
 
+@api.get(
+    "/pipelines",
+    description="Lists the pipelines that are currently loaded (cached) by this API process, \
+    with their settings, approximate memory usage and number of cache hits. \
+    The least recently used pipeline is listed first. \
+    Use the 'language_model' setting to select the spaCy model of a pipeline, \
+    at most PIPELINE_CACHE_SIZE pipelines are kept per process. \
+    (With PIPELINE_EXECUTOR=process, every worker process has its own pipelines, not listed here)",
+    tags=["pipeline"],
+    response_model=List[PipelineInfo],
+)
+async def list_pipelines() -> List[PipelineInfo]:
+    return PipelineFactoryInstance.info()
+
+
 @api.post(
     "/pipeline/{name}",
     description="Executes an NLP analysis pipeline with on some input text meta-data and settings. \
@@ -91,11 +198,6 @@ async def execute_pipeline(
         settings = {**settings, **dict(request.query_params)}
         log.info(f"Starting pipeline '{name}' with settings: {settings}")
 
-        # Gets the singleton instance of the pipeline
-        # As NLP models (more specific: spacy Languages) are expensive to create and apparently stateful,
-        # we instantiate every language model only once per process
-        pipeline = PipelineFactoryInstance.create(name)
-
         #
         # settings.clean_only: disable all pipes other than the text preprocessing.
         #
@@ -127,7 +229,13 @@ async def execute_pipeline(
         #
         # EXECUTE
         #
-        response = pipeline.execute(
+        # This runs in the (bounded) pipeline worker pool, so a long running document
+        # doesn't block the event loop for all other requests.
+        # The worker gets the singleton instance of the pipeline:
+        # As NLP models (more specific: spacy Languages) are expensive to create and apparently stateful,
+        # we instantiate every language model only once per process
+        response = await PipelineExecutorInstance.execute(
+            name,
             text=raw_text,
             meta=meta,
             settings=settings,
@@ -137,6 +245,10 @@ async def execute_pipeline(
             f"Stats: {create_time_ms}ms model create time, {extract_time_ms}ms text extraction, {execution_time_ms}ms nlp pipeline execution"
         ) """
         return response
+    except ExecutorQueueFull as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": str(e.retry_after)})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Error executing pipeline '{name}': {str(e)}")
 
@@ -149,7 +261,7 @@ async def execute_pipeline(
     tags=["pipeline"],
 )
 async def execute_pipeline_upload(
-    request: fastapi.Request, name: str, file: UploadFile = File(...)
+    request: fastapi.Request, name: str
 ) -> PipelineExecutionResponse:
 
     # generate settings object from query params
@@ -157,7 +269,7 @@ async def execute_pipeline_upload(
 
     try:
         # upload file to temp folder and extract the text
-        extractResponse = await extract_from_upload(file)
+        extractResponse = await extract_from_upload(request)
 
         # Create new pipeline execution request, using extracted input text.
         execution_request = PipelineExecutionRequest(
@@ -168,11 +280,147 @@ async def execute_pipeline_upload(
             request=request, name=name, execution_request=execution_request
         )
 
+    except HTTPException as e:
+        # "503 - queue is full" and "413 - upload too large", don't turn that into a "400"
+        if e.status_code in (413, 503):
+            raise
+        log.error(f"Error running pipeline from file upload : {str(e.detail)}")
+        raise HTTPException(
+            400, f"Error running pipeline from file upload: {str(e.detail)}"
+        )
     except Exception as e:
         log.error(f"Error running pipeline from file upload : {str(e)}")
         raise HTTPException(400, f"Error running pipeline from file upload: {str(e)}")
 
 
+def _parse_batch_body(body: bytes, content_type: str) -> List[PipelineExecutionRequest]:
+    """
+    Accepts either a json array of execution requests, or NDJSON (one request per line)
+    """
+    text = body.decode("utf-8").strip()
+    if not text:
+        return []
+    if "ndjson" in content_type or not text.startswith("["):
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        items = json.loads(text)
+
+    return [PipelineExecutionRequest(**item) for item in items]
+
+
+@api.post(
+    "/pipeline/{name}/batch",
+    description="Executes an NLP analysis pipeline on many documents at once, using spaCy's batched processing. \
+    The request body is either a json array of pipeline execution requests, or NDJSON (one request per line). \
+    The response is streamed back as NDJSON, one pipeline execution response per line, in input order. \
+    Query params are used as settings for all documents (settings of single requests are ignored). \
+    Use the 'batch_size' and 'n_process' query params to tune spaCy's Language.pipe. \
+    A batch takes one slot of the pipeline execution queue, it's rejected with 503 if the queue is full.",
+    tags=["pipeline"],
+)
+async def execute_pipeline_batch(
+    request: fastapi.Request, name: str
+) -> StreamingResponse:
+    settings = dict(request.query_params)
+    batch_size = int(settings.pop("batch_size", 32))
+    n_process = int(settings.pop("n_process", 1))
+
+    try:
+        body = await request.body()
+        execution_requests = _parse_batch_body(
+            body, request.headers.get("content-type", "")
+        )
+    except Exception as e:
+        raise HTTPException(400, f"Can't parse batch execution request: {str(e)}")
+
+    if settings.get("clean_only"):
+        settings = {**settings, **{"enable": ["cleaner"]}}
+
+    # A batch takes one slot of the pipeline executor while it's streamed,
+    # so it counts against the same limit as single executions
+    executor = PipelineExecutorInstance
+    try:
+        executor.acquire(name)
+    except ExecutorQueueFull as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": str(e.retry_after)})
+
+    log.info(
+        f"Starting batch of {len(execution_requests)} documents on pipeline '{name}' with settings: {settings}"
+    )
+
+    def _items():
+        # (text, meta) tuples. URLs are extracted on the fly, while spaCy consumes the batch
+        for execution_request in execution_requests:
+            meta = execution_request.meta or {}
+            if execution_request.url:
+                extracted = UNIVERSAL_EXTRACTOR.extract(
+                    ExtractorRequest(url=execution_request.url)
+                )
+                yield extracted.text or "", {**(extracted.meta or {}), **meta}
+            else:
+                yield execution_request.text or "", meta
+
+    def _stream():
+        # Sync generator, Starlette iterates it in its threadpool (not on the event loop)
+        try:
+            with PipelineFactoryInstance.checkout(name, settings) as pipeline:
+                for response in pipeline.execute_batch(
+                    _items(), settings, batch_size=batch_size, n_process=n_process
+                ):
+                    yield response.json() + "\n"
+        except Exception as e:
+            msg = f"Error executing batch on pipeline '{name}': {str(e)}"
+            log.error(msg)
+            yield json.dumps({"error": msg}) + "\n"
+        finally:
+            executor.release()
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+"""
+---
+--- Admin endpoints: cache statistics and purging
+---
+"""
+
+
+@api.get(
+    "/cache/results",
+    description="Statistics of the pipeline result cache (of this API process).",
+    tags=["admin"],
+)
+async def result_cache_stats() -> dict:
+    return ResultCacheInstance.stats()
+
+
+@api.delete(
+    "/cache/results",
+    description="Purges the pipeline result cache. Pass a 'key' (as reported in 'result_cache_key' of an execution) \
+        to purge a single entry, or 'expired_only=true' to only purge expired entries.",
+    tags=["admin"],
+)
+async def purge_result_cache(key: str = None, expired_only: bool = False) -> dict:
+    if key:
+        purged = ResultCacheInstance.delete(key)
+    elif expired_only:
+        purged = ResultCacheInstance.purge_expired()
+    else:
+        purged = ResultCacheInstance.clear()
+
+    log.info(f"Purged {purged} entries from the pipeline result cache")
+    return {"purged": purged}
+
+
+@api.get(
+    "/metrics/http",
+    description="Outbound HTTP calls (of this API process) per host: number of requests, errors and latency.",
+    tags=["admin"],
+)
+async def http_metrics() -> dict:
+    return HttpClientsInstance.stats()
+
+
 """
 ---
 --- Extract endpoints: Extract raw text from file uploads, url links
@@ -189,32 +437,32 @@ async def execute_pipeline_upload(
             thanks to Apache Tika, Azure Computer Vision OCR, Abbyy Cloud OCR and other best-of-breed extractor components.",
     tags=["extract"],
 )
-async def extract_from_upload(file: UploadFile = File(...)) -> ExtractorResponse:
+async def extract_from_upload(request: fastapi.Request) -> ExtractorResponse:
     """
-    Upload a file and extract text and (possibly) meta-data
+    Upload a file and extract text and (possibly) meta-data.
+    The multipart body is parsed while it arrives (see UPLOAD_FORM_SCHEMA for the form),
+    small uploads stay in memory, larger ones are streamed into a temp file (see UPLOAD_MAX_BYTES)
     """
-    ext = os.path.splitext(file.filename)[1]
-    temp = tempfile.NamedTemporaryFile(
-        prefix="jargonbuster_", suffix=f"{ext}", delete=False
-    )
+    try:
+        upload = await SpooledUpload.from_stream(
+            request.stream(), request.headers.get("content-type", "")
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(413, str(e))
+    except Exception as e:
+        log.error(str(e))
+        raise HTTPException(400, f"Can't extract from the the uploaded file: {str(e)}")
 
     # Set the content type
-    meta = {"content_type": file.content_type}
+    meta = {"content_type": upload.content_type}
 
     try:
-        # Write into temp file
-        data = await file.read()
-        temp.write(data)
-
         # Extractor:  parse file into (raw) text
         log.info(
-            f"Starting text extraction for '{file.content_type}' from uploaded file '{file.filename}' "
+            f"Starting text extraction for '{upload.content_type}' from uploaded file '{upload.filename}' "
         )
-        extractResponse = UNIVERSAL_EXTRACTOR.extract(
-            ExtractorRequest(
-                filename=temp.name,
-                meta=meta,
-            )
+        extractResponse = await UNIVERSAL_EXTRACTOR.aextract(
+            upload.extractor_request(meta)
         )
 
         return extractResponse
@@ -223,9 +471,7 @@ async def extract_from_upload(file: UploadFile = File(...)) -> ExtractorResponse
         log.error(str(e))
         raise HTTPException(400, f"Can't extract from the the uploaded file: {str(e)}")
     finally:
-        log.debug(f"deleting upload temp file: {temp.name}")
-        temp.close()
-        os.unlink(temp.name)
+        upload.close()
 
 
 @api.get(
@@ -242,7 +488,8 @@ async def extract_from_url(url: str) -> ExtractorResponse:
 
     try:
         # UniversalExtractor, pass any url or filename and we'll figure it out :)
-        extractResponse = UNIVERSAL_EXTRACTOR.extract(ExtractorRequest(url=url))
+        # (the extractors' blocking calls run in the extractor thread pool, not on the event loop)
+        extractResponse = await UNIVERSAL_EXTRACTOR.aextract(ExtractorRequest(url=url))
 
         return extractResponse
 
@@ -257,20 +504,10 @@ async def extract_from_url(url: str) -> ExtractorResponse:
     response_model=DefinitionResponse,
 )
 async def definition(term: str) -> DefinitionResponse:
-
-    apiKey = os.environ.get("MW_API_KEY")
-
-    url = f"https://www.dictionaryapi.com/api/v3/references/medical/json/{term}?key={apiKey}"
-
     try:
-
-        resp = requests.get(url)
-        if resp.ok:
-            jsonResp = resp.json()
-            if jsonResp:
-                definitions = jsonResp
-                return DefinitionResponse(term=term, definitions=definitions)
-        return DefinitionResponse(term=term, definitions=[])
+        # cached, see Dictionary
+        definitions = await DictionaryInstance.lookup(term)
+        return DefinitionResponse(term=term, definitions=definitions)
 
     except Exception as e:
         log.error(str(e))
@@ -278,6 +515,36 @@ async def definition(term: str) -> DefinitionResponse:
         raise HTTPException(930, message)
 
 
+@api.post(
+    "/definitions",
+    description="Lookup multiple terms in the Merriam-Webster medical dictionary (concurrently). \
+        Returns the definitions in the order of the terms, terms that failed have an 'error'.",
+    response_model=List[DefinitionResponse],
+)
+async def definitions(request: DefinitionsRequest) -> List[DefinitionResponse]:
+    if len(request.terms) > DICTIONARY_MAX_TERMS:
+        raise HTTPException(
+            400, f"Too many terms, max. {DICTIONARY_MAX_TERMS} per request"
+        )
+
+    results = await DictionaryInstance.lookup_many(request.terms)
+
+    responses = []
+    for term in request.terms:
+        result = results[term]
+        if isinstance(result, Exception):
+            log.error(f"Error querying dictionary for '{term}': {str(result)}")
+            responses.append(
+                DefinitionResponse(
+                    term=term, error=f"Error querying dictionary for '{term}'"
+                )
+            )
+        else:
+            responses.append(DefinitionResponse(term=term, definitions=result))
+
+    return responses
+
+
 @api.get(
     "/getIRToken",
     description="Retrieves a client token for integration with the Microsoft Immersive Reader instance.",
@@ -285,40 +552,11 @@ async def definition(term: str) -> DefinitionResponse:
     response_model=ImmersiveReaderTokenResponse,
 )
 async def getIRToken():
-    clientId = str(os.environ.get("AZ_IMMERSIVE_READER_CLIENT_ID"))
-    clientSecret = str(os.environ.get("AZ_IMMERSIVE_READER_CLIENT_SECRET"))
-    resource = "https://cognitiveservices.azure.com/"
-    grantType = "client_credentials"
-
-    # AAD auth endpoint
-    tenantId = str(os.environ.get("AZ_IMMERSIVE_READER_TENANT_ID"))
-    oauthTokenUrl = f"https://login.windows.net/{tenantId}/oauth2/token"
-
     subdomain = str(os.environ.get("AZ_IMMERSIVE_READER_SUBDOMAIN"))
 
     try:
-        headers = {"content-type": "application/x-www-form-urlencoded"}
-        data = {
-            "client_id": clientId,
-            "client_secret": clientSecret,
-            "resource": resource,
-            "grant_type": grantType,
-        }
-
-        resp = requests.post(
-            oauthTokenUrl,
-            data=data,
-            headers=headers,
-        )
-        jsonResp = resp.json()
-
-        if "access_token" not in jsonResp:
-            print(jsonResp)
-            raise HTTPException(
-                910, "AAD Authentication error. Check your IR access credentials"
-            )
-
-        token = jsonResp["access_token"]
+        # cached until shortly before it expires, see ImmersiveReaderToken
+        token = await ImmersiveReaderTokenInstance.get()
 
         return ImmersiveReaderTokenResponse(token=token, subdomain=subdomain)
     except Exception as e:
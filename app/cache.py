@@ -0,0 +1,237 @@
+import app
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any
+
+
+log = logging.getLogger(__name__)
+
+
+def hash_key(*parts) -> str:
+    """
+    Content address for a cache entry: sha256 over all (str) parts
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode("utf-8"))
+        sha.update(b"\0")
+
+    return sha.hexdigest()
+
+
+class TieredCache(object):
+    """
+    Key/value cache with an in-memory LRU tier and an optional on-disk (SQLite) tier.
+    Entries expire after 'ttl' seconds (per entry, can be overridden when setting a value).
+    The disk tier survives restarts and can be shared between processes, values are pickled.
+    Its SQLite connection is opened lazily, one per process: a connection must not be used across a fork
+    (e.g. by the workers of PIPELINE_EXECUTOR=process).
+
+    'max_disk_entries' bounds the disk tier, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 256,
+        ttl: float = 3600,
+        path: str = None,
+        max_disk_entries: int = None,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+
+        # key -> (expires, value), least recently used first
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._db: sqlite3.Connection = None
+        # process that opened (or failed to open) self._db
+        self._db_pid: int = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """
+        Connection to the on-disk tier of this process (None: memory only). Call with self._lock held.
+        """
+        if self.path and self._db_pid != os.getpid():
+            # a connection inherited from the parent process is just dropped, not used (or closed)
+            self._db_pid = os.getpid()
+            self._db = self._open_db(self.path)
+        return self._db
+
+    def _open_db(self, path: str) -> sqlite3.Connection:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # shared by the threads of this process, see self._lock
+            db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            db.commit()
+            log.info(f"Using on-disk tier for '{self.name}' cache: {path}")
+            return db
+        except Exception as e:
+            log.error(f"Can't open on-disk tier for '{self.name}' cache: {str(e)}")
+            return None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                expires, value = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            db = self.db
+            if db:
+                try:
+                    row = db.execute(
+                        "SELECT value, expires FROM cache WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row and row[1] > now:
+                        value = pickle.loads(row[0])
+                        db.execute(
+                            "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+                        )
+                        db.commit()
+                        self._set_memory(key, value, row[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                except Exception as e:
+                    log.error(f"Error reading from '{self.name}' cache: {str(e)}")
+
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._set_memory(key, value, expires)
+
+            db = self.db
+            if db:
+                try:
+                    db.execute(
+                        "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                        (key, pickle.dumps(value), expires, time.time()),
+                    )
+                    if self.max_disk_entries:
+                        db.execute(
+                            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                            (self.max_disk_entries,),
+                        )
+                    db.commit()
+                except Exception as e:
+                    log.error(f"Error writing to '{self.name}' cache: {str(e)}")
+
+    def _set_memory(self, key: str, value: Any, expires: float):
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def delete(self, key: str) -> int:
+        """
+        Removes an entry from all tiers, returns the number of removed entries
+        """
+        with self._lock:
+            removed = 1 if self._memory.pop(key, None) else 0
+            db = self.db
+            if db:
+                removed = max(
+                    removed,
+                    db.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount,
+                )
+                db.commit()
+            return removed
+
+    def clear(self) -> int:
+        """
+        Removes all entries from all tiers, returns the number of removed entries
+        """
+        with self._lock:
+            removed = len(self._memory)
+            self._memory.clear()
+            db = self.db
+            if db:
+                removed = max(removed, db.execute("DELETE FROM cache").rowcount)
+                db.commit()
+            return removed
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (expires, _) in self._memory.items() if expires <= now]
+            for key in expired:
+                del self._memory[key]
+            removed = len(expired)
+            db = self.db
+            if db:
+                removed += db.execute(
+                    "DELETE FROM cache WHERE expires <= ?", (now,)
+                ).rowcount
+                db.commit()
+            return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "name": self.name,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+            db = self.db
+            if db:
+                stats["disk_entries"] = db.execute(
+                    "SELECT COUNT(*) FROM cache"
+                ).fetchone()[0]
+            return stats
+
+
+def create_cache(
+    name: str,
+    env_prefix: str,
+    maxsize: int = 256,
+    ttl: float = 3600,
+    path: str = None,
+    max_disk_entries: int = None,
+):
+    """
+    Creates a cache configured via env vars (the arguments are the defaults):
+        <PREFIX>_SIZE               max. entries in memory
+        <PREFIX>_TTL                seconds until an entry expires
+        <PREFIX>_PATH               SQLite file for the on-disk tier (empty: memory only)
+        <PREFIX>_MAX_DISK_ENTRIES   max. entries on disk (default: unbounded)
+    """
+    max_disk_entries = os.getenv(f"{env_prefix}_MAX_DISK_ENTRIES", max_disk_entries)
+
+    return TieredCache(
+        name,
+        maxsize=int(os.getenv(f"{env_prefix}_SIZE", maxsize)),
+        ttl=float(os.getenv(f"{env_prefix}_TTL", ttl)),
+        path=os.getenv(f"{env_prefix}_PATH", path) or None,
+        max_disk_entries=int(max_disk_entries) if max_disk_entries else None,
+    )
@@ -1,127 +1,475 @@
 import app
+import re
 import logging
+import unicodedata
+from bisect import bisect_right
+from typing import Callable, List, Optional, Pattern, Tuple, Union
 from spacy.language import Language
 from spacy.tokens import Doc
 
-from textacy import preprocessing
-import re
+from textacy.preprocessing.resources import (
+    RE_URL,
+    RE_SHORT_URL,
+    RE_PHONE_NUMBER,
+    RE_EMAIL,
+    RE_USER_HANDLE,
+    RE_HYPHENATED_WORD,
+    QUOTE_TRANSLATION_TABLE,
+)
 
 log = logging.getLogger(__name__)
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
+
+
+# Zero-width spaces are removed (see textacy's normalize_whitespace)
+ZWSP_TRANSLATION_TABLE = {ord(c): None for c in "\u200b\u2060\ufeff"}
+
+# Linebreaks and other whitespace in a single pass (see textacy's normalize_whitespace):
+# a run of linebreaks becomes one "\n", a run of other whitespace one " ".
+# Only runs that actually change are matched, single " " and "\n" are left alone.
+RE_WHITESPACE = re.compile(
+    r"(?=\s)(?:((?:\r\n|[\n\v]){2,}|\r\n|\v)|([^\S\n\v]{2,}|[^\S \n\v]))",
+    flags=re.UNICODE,
+)
+
+# textacy's RE_HYPHENATED_WORD, anchored at the start of a word: a match can only start there anyway,
+# but without the anchor the regex backtracks through every single word character.
+RE_HYPHENATED_WORD = re.compile(
+    r"\b" + RE_HYPHENATED_WORD.pattern, flags=RE_HYPHENATED_WORD.flags
+)
+
+# The same as textacy's normalize_repeating_chars(chars=".,;:-_ ", maxn=1)
+REPEATING_PUNCT = ".,;:-_ "
+RE_REPEATING_PUNCT = re.compile(r"({}){{2,}}".format(re.escape(REPEATING_PUNCT)))
+
+# The same as replacing "\n " and " \n" with " " and then the remaining "\n" with " "
+RE_NEWLINE_NEXT_TO_SPACE = re.compile(r"(?<= )\n|\n(?= )")
+
+# The remaining newlines become spaces
+NEWLINE_TRANSLATION_TABLE = {ord("\n"): " "}
+
+# Any single character between two spaces
+RE_SINGLE_CHAR = re.compile(" . ")
+
+# textacy's RE_PHONE_NUMBER, a match always starts with one of "+", "(" or a digit
+RE_PHONE_NUMBER = re.compile(
+    r"(?=[+(\d])" + RE_PHONE_NUMBER.pattern, flags=RE_PHONE_NUMBER.flags
+)
+RE_PHONE_NUMBER_PREFILTER = re.compile(r"\d{3}[ .-]?\d{4}")
+
+# URLs, e-mail addresses and user handles never contain whitespace, so only the
+# (whitespace delimited) tokens that contain one of these need to be looked at
+RE_URL_CANDIDATE = re.compile(r"://|www\d{0,3}\.", flags=re.IGNORECASE)
+RE_SHORT_URL_CANDIDATE = re.compile(r"\.[a-z]{2,12}/", flags=re.IGNORECASE)
+RE_EMAIL_CANDIDATE = re.compile("@")
+RE_NON_WHITESPACE = re.compile(r"\S*")
+
+RE_NON_ASCII = re.compile(r"[^\x00-\x7f]+")
+
+
+# An edit replaced text[start:end] with a text of 'length' characters
+Edit = Tuple[int, int, int]
+
+
+def _whitespace_repl(match) -> str:
+    return "\n" if match.lastindex == 1 else " "
+
+
+class OffsetMap(object):
+    """
+    Maps offsets in the result of a cleaning pass back to the text before the pass.
+    Created from the edits of the pass, the text in between is unchanged.
+    Offsets within replaced text map to the start of the replaced text plus the same distance,
+    but never beyond its end.
+    """
+
+    def __init__(self, edits: List[Edit], length: int):
+        self.length = length
+        # sorted anchors: new_starts[i] (after the pass) corresponds to old_starts[i] (before the pass)
+        self.new_starts = [0]
+        self.old_starts = [0]
+
+        shift = 0
+        for start, end, replacement_length in edits:
+            self.new_starts.append(start + shift)
+            self.old_starts.append(start)
+            shift += replacement_length - (end - start)
+            self.new_starts.append(end + shift)
+            self.old_starts.append(end)
+
+    def __call__(self, offset: int, end: bool = False) -> int:
+        """
+        'end': the offset is the (exclusive) end of a span. The end of a replacement maps to
+        the end of the replaced text, and an end right before removed text stays before it.
+        """
+        i = bisect_right(self.new_starts, offset - 1 if end else offset) - 1
+        if i + 1 < len(self.new_starts):
+            if end and offset >= self.new_starts[i + 1]:
+                return self.old_starts[i + 1]
+            limit = self.old_starts[i + 1]
+        else:
+            limit = self.length
+
+        return min(self.old_starts[i] + offset - self.new_starts[i], limit)
+
+
+class CleaningResult(object):
+    """
+    The cleaned text, plus the offset maps of all passes to get from the cleaned text back to the raw text.
+    """
+
+    def __init__(self, text: str, raw_length: int, offset_maps: List[OffsetMap]):
+        self.text = text
+        self.raw_length = raw_length
+        self.offset_maps = offset_maps
+
+    def raw_offset(self, offset: int, end: bool = False) -> int:
+        for offset_map in reversed(self.offset_maps):
+            offset = offset_map(offset, end)
+        return offset
+
+    def raw_span(self, start: int, end: int) -> Tuple[int, int]:
+        """
+        Maps [start, end) in the cleaned text to the raw text
+        """
+        raw_start = self.raw_offset(start)
+        if end <= start:
+            return raw_start, raw_start
+
+        return raw_start, max(raw_start, self.raw_offset(end, end=True))
+
+
+class CleaningPass(object):
+    """
+    A single pass over the whole text.
+    'prefilter' is a substring (or regex) the text must contain, otherwise the pass is skipped.
+    If a list of 'edits' is passed, the pass records what it replaced (see OffsetMap).
+    """
+
+    def __init__(self, name: str, prefilter: Union[str, Pattern] = None):
+        self.name = name
+        self.prefilter = prefilter
+
+    def __call__(self, text: str, edits: List[Edit] = None) -> str:
+        if self.prefilter is not None:
+            if isinstance(self.prefilter, str):
+                if self.prefilter not in text:
+                    return text
+            elif not self.prefilter.search(text):
+                return text
+
+        return self.apply(text, edits)
+
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        raise NotImplementedError()
+
+
+class StripPass(CleaningPass):
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        stripped = text.strip()
+        if edits is not None and len(stripped) != len(text):
+            start = len(text) - len(text.lstrip())
+            edits.append((0, start, 0))
+            edits.append((start + len(stripped), len(text), 0))
+
+        return stripped
+
+
+class UnicodePass(CleaningPass):
+    """
+    Unicode normalization of the whole text.
+    The edits are only an approximation: runs of non-ASCII characters (plus the character in front,
+    combining characters may be composed with it) are normalized on their own.
+    """
+
+    def __init__(self, name: str, form: str = "NFKC"):
+        super().__init__(name)
+        self.form = form
+
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        if text.isascii():
+            # nothing to normalize, and no edits to record
+            return text
+
+        normalized = unicodedata.normalize(self.form, text)
+        if edits is None or normalized is text or normalized == text:
+            return normalized
+
+        run_edits = []
+        length = len(text)
+        last = 0
+        for match in RE_NON_ASCII.finditer(text):
+            start = max(match.start() - 1, last)
+            run = text[start : match.end()]
+            normalized_run = unicodedata.normalize(self.form, run)
+            if normalized_run != run:
+                run_edits.append((start, match.end(), len(normalized_run)))
+                length += len(normalized_run) - len(run)
+            last = match.end()
+
+        if length == len(normalized):
+            edits.extend(run_edits)
+        else:
+            edits.append((0, len(text), len(normalized)))
+
+        return normalized
+
+
+class TranslatePass(CleaningPass):
+    """
+    str.translate with a translation table. Only characters that are deleted
+    (or replaced with more than one character) are edits.
+    """
+
+    def __init__(self, name: str, table: dict, prefilter: Union[str, Pattern] = None):
+        super().__init__(name, prefilter)
+        self.table = table
+        # characters that are deleted (None) or replaced with a string of another length
+        resized = "".join(
+            re.escape(chr(c))
+            for c, r in table.items()
+            if r is None or (isinstance(r, str) and len(r) != 1)
+        )
+        self._resized = re.compile(f"[{resized}]+") if resized else None
+
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        if edits is not None and self._resized is not None:
+            for match in self._resized.finditer(text):
+                edits.append(
+                    (
+                        match.start(),
+                        match.end(),
+                        len(match.group().translate(self.table)),
+                    )
+                )
+
+        return text.translate(self.table)
+
+
+def _sub(
+    pattern: Pattern,
+    replacement: Union[str, Callable],
+    text: str,
+    edits: List[Edit],
+    offset: int = 0,
+) -> str:
+    """
+    Pattern.sub that records its edits, 'offset' is added to all edits.
+    """
+    parts = []
+    last = 0
+    for match in pattern.finditer(text):
+        if callable(replacement):
+            replaced = replacement(match)
+        else:
+            replaced = match.expand(replacement)
+
+        start, end = match.span()
+        parts.append(text[last:start])
+        parts.append(replaced)
+        if replaced != match.group():
+            edits.append((offset + start, offset + end, len(replaced)))
+        last = end
+
+    if not parts:
+        return text
+
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+class SubPass(CleaningPass):
+    """
+    Pattern.sub with a replacement template or a (dispatch) function
+    """
+
+    def __init__(
+        self,
+        name: str,
+        pattern: Pattern,
+        replacement: Union[str, Callable],
+        prefilter: Union[str, Pattern] = None,
+    ):
+        super().__init__(name, prefilter)
+        self.pattern = pattern
+        self.replacement = replacement
+
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        if edits is None:
+            return self.pattern.sub(self.replacement, text)
+
+        return _sub(self.pattern, self.replacement, text, edits)
+
+
+class TokenPass(SubPass):
+    """
+    Pattern.sub, but only on the whitespace delimited tokens that contain a 'candidate' match.
+    Only valid if the pattern can't match across whitespace and doesn't look
+    more than one character behind/ahead of a match.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        candidate: Pattern,
+        pattern: Pattern,
+        replacement: Union[str, Callable],
+    ):
+        super().__init__(name, pattern, replacement)
+        self.candidate = candidate
+
+    def apply(self, text: str, edits: Optional[List[Edit]]) -> str:
+        parts = []
+        last = 0
+        for match in self.candidate.finditer(text):
+            start, end = match.span()
+            if start < last:
+                # same token as the previous candidate
+                continue
+
+            while start > last and not text[start - 1].isspace():
+                start -= 1
+            end = RE_NON_WHITESPACE.match(text, end).end()
+
+            token = text[start:end]
+            parts.append(text[last:start])
+            if edits is None:
+                parts.append(self.pattern.sub(self.replacement, token))
+            else:
+                parts.append(_sub(self.pattern, self.replacement, token, edits, start))
+            last = end
+
+        if not parts:
+            return text
+
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+class CleaningEngine(object):
+    """
+    Runs a compiled cleaning profile: the passes are applied in order.
+    """
+
+    def __init__(self, profile: str, passes: List[CleaningPass]):
+        self.profile = profile
+        self.passes = passes
+
+    def clean(self, text: str) -> str:
+        for cleaning_pass in self.passes:
+            text = cleaning_pass(text)
+        return text
+
+    def clean_with_offsets(self, text: str) -> CleaningResult:
+        """
+        Cleans the text and keeps track of the offsets, to map the cleaned text back to the raw text.
+        """
+        raw_length = len(text)
+        offset_maps = []
+        for cleaning_pass in self.passes:
+            edits = []
+            length = len(text)
+            text = cleaning_pass(text, edits)
+            if edits:
+                offset_maps.append(OffsetMap(edits, length))
+
+        return CleaningResult(text, raw_length, offset_maps)
+
+
+def _compile_default_profile() -> List[CleaningPass]:
+    """
+    The "default" profile. Produces exactly the same text as the textacy preprocessing chain
+
+        strip, normalize_unicode(NFKC), normalize_whitespace, normalize_repeating_chars("\\n"),
+        normalize_hyphenated_words, normalize_quotation_marks, replace_urls, replace_phone_numbers,
+        replace_emails, replace_user_handles, normalize_repeating_chars(".,;:-_ "),
+        re.sub("\\n ", " "), re.sub(" \\n", " "), re.sub("\\n", " "), re.sub(" . ", " ")
+
+    but needs fewer passes over the text. The order of the passes matters (e.g. the removal of
+    URLs changes the look-behind of the following patterns), so only passes that can't interact are merged.
+
+    Note: normalize_repeating_chars("\\n") is a no-op after normalize_whitespace and is dropped.
+    """
+    return [
+        StripPass("strip"),
+        UnicodePass("unicode", form="NFKC"),
+        TranslatePass("zero_width_spaces", ZWSP_TRANSLATION_TABLE),
+        SubPass("whitespace", RE_WHITESPACE, _whitespace_repl),
+        StripPass("strip_whitespace"),
+        SubPass("hyphenated_words", RE_HYPHENATED_WORD, r"\1\2", prefilter="-"),
+        TranslatePass("quotation_marks", QUOTE_TRANSLATION_TABLE),
+        TokenPass("urls", RE_URL_CANDIDATE, RE_URL, ""),
+        TokenPass("short_urls", RE_SHORT_URL_CANDIDATE, RE_SHORT_URL, ""),
+        SubPass(
+            "phone_numbers",
+            RE_PHONE_NUMBER,
+            "",
+            prefilter=RE_PHONE_NUMBER_PREFILTER,
+        ),
+        TokenPass("emails", RE_EMAIL_CANDIDATE, RE_EMAIL, ""),
+        TokenPass("user_handles", RE_EMAIL_CANDIDATE, RE_USER_HANDLE, ""),
+        SubPass(
+            "repeating_punctuation",
+            RE_REPEATING_PUNCT,
+            REPEATING_PUNCT,
+            prefilter=REPEATING_PUNCT * 2,
+        ),
+        SubPass("newlines", RE_NEWLINE_NEXT_TO_SPACE, "", prefilter="\n"),
+        TranslatePass("linebreaks", NEWLINE_TRANSLATION_TABLE, prefilter="\n"),
+        SubPass("single_chars", RE_SINGLE_CHAR, " "),
+    ]
+
+
+CLEANING_PROFILES = {
+    "default": _compile_default_profile,
+}
+
+
+def compile_profile(profile: str = "default") -> CleaningEngine:
+    if profile not in CLEANING_PROFILES:
+        raise ValueError(f"Unknown cleaning profile: {profile}")
+
+    return CleaningEngine(profile, CLEANING_PROFILES[profile]())
 
 
 class Cleaner(object):
     """
-    Creates a new Doc with the text cleaned and normalized.
+    Cleans and normalizes the text.
+    Usually the pipeline cleans the text *before* tokenization (see DefaultSummarizerPipeline.execute)
+    and passes pre_cleaned=True, so this stage only registers its extension. Otherwise it creates
+    a new Doc from the cleaned text (which means that the text is tokenized twice).
+    The CleaningResult (with the offsets into the raw text) is stored in doc.user_data["cleaning"].
     TODO: Maybe add (optional) Spelling correction here, using a domain/language specific dictionary
     """
 
     nlp: Language = None
 
-    def __init__(self, nlp):
+    def __init__(self, nlp, profile: str = "default"):
         self.nlp = nlp
+        self.engine = compile_profile(profile)
 
-    def __call__(self, doc):
-        if not doc.has_extension(STAGE.CLEANER):
-            doc.set_extension(STAGE.CLEANER, getter=self._get_clean_info)
+    def __call__(self, doc: Doc, pre_cleaned: bool = False):
+        stage_extension(doc, STAGE.CLEANER, "_get_clean_info")
 
-        new_text = self._clean(doc.text)
-        new_doc = self.nlp.make_doc(new_text)  # need to re-Tokenize
+        if pre_cleaned:
+            return doc
+
+        cleaning = self.clean(doc.text)
+        new_doc = self.nlp.make_doc(cleaning.text)  # need to re-Tokenize
+        new_doc.user_data["cleaning"] = cleaning
 
         return new_doc
 
     def _get_clean_info(self, doc: Doc):
-        return {"cleaning-profile": "default"}
-
-    def _clean(self, text: str):
-        txt = text.strip()
-
-        #
-        txt = preprocessing.normalize_unicode(txt, form="NFKC")
-
-        # txt = preprocessing.remove_punctuation(txt)
-
-        # Collapse whitespaces
-        txt = preprocessing.normalize_whitespace(txt)
-        # Remove newlines
-        txt = preprocessing.normalize_repeating_chars(txt, chars="\n", maxn=1)
-        # fix hyphen-ated words
-        txt = preprocessing.normalize_hyphenated_words(txt)
-        txt = preprocessing.normalize_quotation_marks(txt)
-        txt = preprocessing.replace_urls(txt, replace_with="")
-        txt = preprocessing.replace_phone_numbers(txt, replace_with="")
-        txt = preprocessing.replace_emails(txt, replace_with="")
-        txt = preprocessing.replace_user_handles(txt, replace_with="")
-        txt = preprocessing.normalize_repeating_chars(txt, chars=".,;:-_ ", maxn=1)
-        txt = re.sub("\n ", " ", txt)
-        txt = re.sub(" \n", " ", txt)
-        txt = re.sub("\n", " ", txt)
-        txt = re.sub(" . ", " ", txt)
-
-        # txt = text.encode().decode("unicode-escape")
-        # Used ftfy for "fixing" broken text, e.g. Unicode
-        # txt = fix_text(txt.strip(), normalization="NFKC")
-
-        # re- minissence => reminissence
-        # txt = re.sub(r"([a-z])\-\s{,2}([a-z])", r"\1\2", txt)
-
-        # collapse two+ newlines into single whitespace
-        # txt = re.sub(r"\s+\n{1,}\s*(\w)", r" \1", txt)
-
-        # collapse two+ newlines into single whitespace
-        # txt = re.sub("\n+", " ", txt)
+        info = {"cleaning-profile": self.engine.profile}
+        cleaning = doc.user_data.get("cleaning")
+        if cleaning is not None:
+            info["raw_length"] = cleaning.raw_length
+            info["cleaned_length"] = len(cleaning.text)
 
-        """
-        # collapse two+ newlines into single whitespace
-        txt = re.sub(r"\s+\n{2,}\s*(\w)", r" \1", txt)
-
-        # double-newlines to dots
-        txt = re.sub(r"\n\n", ". ", txt)
-
-        # collapse whitespace
-        txt = re.sub(r"(\s){2,}", r"\1", txt)
-        # collapse dots
-        txt = re.sub(r"\.{2,}", ".", txt)
-        # newline to whitespace between word characters
-        txt = re.sub(r"(\w)\n(\w)", r"\1 \2", txt)
-        # newline + open brace to whitespace
-        txt = re.sub(r"(\w)\n(\()", r"\1 \2", txt)
-        # comma + newline  to whitespace
-        txt = re.sub(r"(\w)\,\n(\w)", r"\1 \2", txt)
-
-        # Number end of sentence, followed by sentence that starts with number + dot
-        txt = re.sub(r"(\d+)\.(\d\.\s+)", r"\1. ", txt)
-        # remove decimals + dot after whitespace followed by whitespace
-        txt = re.sub(r"(\.\s*)\d+\.\s+", r"\1", txt)
-
-        # collapse backslashes
-        txt = re.sub(r"\\{2,}", r"\\", txt)
-        # remove 'escaped backslash' artefacts
-        txt = re.sub(r"\\\\", "", txt)
-        # remove lowdash artifacts ("lines")
-        txt = re.sub(r"_{2,}", r"", txt)
-
-        # normalize newline
-        txt = re.sub(r"\r\n", r"\n", txt)
-        # Linebreaks starting with numbers \n77\n
-        txt = re.sub(r"\n\d+\n", r"\n", txt)
-
-        # remove quotes + decimals on beginning of sentences
-        txt = re.sub(r"\.([\"']?)\d+\s+", r".\1", txt)
-        # remove quotes + decimals on beginning of sentences
-        txt = re.sub(r"\.([\"']?)\d+\s+", r".\1", txt)
-
-        # collapse dots
-        txt = re.sub(r"\.\s+\.", ". ", txt)
-        # collapse whitespace
-        txt = re.sub(r"(\w+)\s{2,}(\w+)", r"\1 \2", txt)
-
-        # Add space+ dot with double quotes
-        txt = re.sub(r"\.\"(\w+)", r'.". \1', txt)
-
-        # Add space+ between two sentences
-        txt = re.sub(r"([a-z])\.([A-Z])", r"\1. \2", txt)
-        """
+        return info
 
-        return txt
+    def clean(self, text: str) -> CleaningResult:
+        return self.engine.clean_with_offsets(text)
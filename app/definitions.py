@@ -0,0 +1,249 @@
+import app
+import os
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv, find_dotenv
+from spacy.language import Language
+from spacy.tokens import Doc
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.cache import TieredCache
+from app.dictionary import (
+    MW_API_KEY,
+    MW_API_URL,
+    Dictionary,
+    DictionaryCacheInstance,
+    normalize_term,
+)
+from app.health_analyzer import CATEGORIES
+from app.http_clients import HttpClientsInstance
+from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
+
+
+# Time budget of the definitions stage per document in milliseconds, lookups that take longer are skipped
+DEFINITIONS_PREFETCH_BUDGET_MS = int(os.getenv("DEFINITIONS_PREFETCH_BUDGET_MS", 1500))
+# Max. number of terms looked up per document
+DEFINITIONS_PREFETCH_MAX_TERMS = int(os.getenv("DEFINITIONS_PREFETCH_MAX_TERMS", 50))
+
+# Named entity labels that are numbers, dates etc., nothing to look up in a dictionary
+NUMERIC_LABELS = {
+    "CARDINAL",
+    "DATE",
+    "MONEY",
+    "ORDINAL",
+    "PERCENT",
+    "QUANTITY",
+    "TIME",
+}
+
+
+class DefinitionsLookup(object):
+    """
+    Runs dictionary lookups (see app.dictionary.Dictionary) on an asyncio event loop in a background thread,
+    so pipeline stages (which run in worker threads/processes) can resolve many terms concurrently.
+
+    Lookups that didn't finish in time keep running in the background, their results end up in the
+    dictionary cache (which is shared with the /definition(s) endpoints), so the next document gets them from there.
+    """
+
+    def __init__(
+        self,
+        url: str = MW_API_URL,
+        api_key: str = MW_API_KEY,
+        cache: TieredCache = DictionaryCacheInstance,
+    ):
+        self.url = url
+        self.api_key = api_key
+        self.cache = cache
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # created on the loop
+        self._dictionary: Dictionary = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="definitions", daemon=True
+                ).start()
+        return self._loop
+
+    def cached(self, term: str) -> Optional[list]:
+        return self.cache.get(normalize_term(term))
+
+    def lookup_many(
+        self, terms: List[str], timeout: float
+    ) -> Tuple[Dict[str, list], List[str]]:
+        """
+        Looks up all terms concurrently, waits at most 'timeout' seconds.
+        Returns the definitions of the terms that were done in time (lookups that failed are left out)
+        and the terms that weren't done in time
+        """
+        loop = self._get_loop()
+        futures = {
+            asyncio.run_coroutine_threadsafe(self._lookup(term), loop): term
+            for term in terms
+        }
+        done, pending = concurrent.futures.wait(futures, timeout=timeout)
+
+        definitions = {}
+        for future in done:
+            if future.exception() is not None:
+                log.warning(
+                    f"Can't look up definitions of '{futures[future]}': {str(future.exception())}"
+                )
+                continue
+            definitions[futures[future]] = future.result()
+
+        return definitions, [futures[future] for future in pending]
+
+    async def _lookup(self, term: str) -> list:
+        if self._dictionary is None:
+            self._dictionary = Dictionary(
+                url=self.url,
+                api_key=self.api_key,
+                cache=self.cache,
+                client=HttpClientsInstance.create_async_client(),
+            )
+        return await self._dictionary.lookup(term)
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._dictionary is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._dictionary.client.aclose(), self._loop
+            ).result()
+            self._dictionary = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+DefinitionsLookupInstance = DefinitionsLookup()
+
+
+class DefinitionsPrefetcher(object):
+    """
+    Collects the unique terms of the document (the entities found by health_analyzer, then the named entities)
+    and looks up their definitions in the (cached) dictionary, concurrently.
+    The stage takes at most 'budget_ms', definitions that aren't there by then are left out of the result.
+
+    Optional, only runs with the setting "prefetch_definitions=true" (or if "enable"d explicitly).
+
+    Env vars:
+        DEFINITIONS_PREFETCH_BUDGET_MS      time budget per document in ms (default: 1500)
+        DEFINITIONS_PREFETCH_MAX_TERMS      max. terms looked up per document (default: 50)
+        MW_API_*, DICTIONARY_*              see app.dictionary.Dictionary
+    """
+
+    nlp: Language = None
+
+    def __init__(
+        self,
+        nlp,
+        lookup: DefinitionsLookup = DefinitionsLookupInstance,
+        budget_ms: int = DEFINITIONS_PREFETCH_BUDGET_MS,
+        max_terms: int = DEFINITIONS_PREFETCH_MAX_TERMS,
+    ):
+        self.nlp = nlp
+        self.lookup = lookup
+        self.budget_ms = budget_ms
+        self.max_terms = max_terms
+
+    def __call__(self, doc: Doc):
+        stage_extension(doc, STAGE.DEFINITIONS, "_prefetch")
+
+        return doc
+
+    def _terms(self, doc: Doc) -> List[str]:
+        """
+        Unique terms (by their normalized form), health entities first, in order of appearance
+        """
+        pipeline_names = doc.user_data.get("pipeline", self.nlp.pipe_names)
+        texts = []
+
+        if STAGE.HEALTH_ANALYZER in pipeline_names and doc.has_extension(
+            STAGE.HEALTH_ANALYZER
+        ):
+            health = doc._.get(STAGE.HEALTH_ANALYZER) or {}
+            entities = [e for key in CATEGORIES for e in health.get(key, [])]
+            entities.sort(key=lambda e: e.get("offset", 0))
+            texts.extend(e["text"] for e in entities if e.get("text"))
+
+        if doc.is_nered:
+            texts.extend(
+                entity.text
+                for entity in doc.ents
+                if entity.label_ not in NUMERIC_LABELS
+            )
+
+        terms = {}
+        for text in texts:
+            key = normalize_term(text)
+            if key and key not in terms:
+                terms[key] = text
+
+        return list(terms.values())[: self.max_terms]
+
+    def _prefetch(self, doc: Doc) -> dict:
+        """
+        Getter method. Terms in the dictionary cache are resolved right away, the rest is looked up
+        within the time budget.
+        """
+        assert doc.has_extension(STAGE.DEFINITIONS)
+
+        terms = self._terms(doc)
+        definitions = {}
+        missing = []
+        for term in terms:
+            cached = self.lookup.cached(term)
+            if cached is not None:
+                definitions[term] = cached
+            else:
+                missing.append(term)
+        cached_count = len(definitions)
+
+        skipped = []
+        if missing:
+            looked_up, skipped = self.lookup.lookup_many(
+                missing, timeout=self.budget_ms / 1000
+            )
+            definitions.update(looked_up)
+            if skipped:
+                log.info(
+                    f"Skipped definitions of {len(skipped)} terms, not resolved within {self.budget_ms}ms"
+                )
+
+        # only the short definitions of the dictionary entries, in order of the terms.
+        # Unknown terms come back as a list of suggestions (strings)
+        result = {}
+        for term in terms:
+            entries = [e for e in definitions.get(term) or [] if isinstance(e, dict)]
+            if entries:
+                result[term] = [
+                    {
+                        "id": e.get("meta", {}).get("id"),
+                        "fl": e.get("fl"),
+                        "shortdef": e.get("shortdef", []),
+                    }
+                    for e in entries
+                ]
+
+        return {
+            "definitions": result,
+            "terms": len(terms),
+            "cached": cached_count,
+            "resolved": len(result),
+            "skipped": skipped,
+        }
@@ -0,0 +1,138 @@
+import app
+import os
+import asyncio
+import logging
+import string
+from typing import Dict, Iterable
+from urllib.parse import quote
+from dotenv import load_dotenv, find_dotenv
+
+import httpx
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.cache import TieredCache, create_cache
+from app.http_clients import HttpClientsInstance
+
+
+# Merriam-Webster medical dictionary API
+MW_API_URL = os.getenv(
+    "MW_API_URL", "https://www.dictionaryapi.com/api/v3/references/medical/json"
+)
+MW_API_KEY = os.getenv("MW_API_KEY")
+
+# Seconds we remember that a term is not in the dictionary
+DICTIONARY_NEGATIVE_TTL = float(os.getenv("DICTIONARY_NEGATIVE_TTL", 24 * 3600))
+# Max. concurrent requests to the dictionary API
+DICTIONARY_MAX_CONCURRENCY = int(os.getenv("DICTIONARY_MAX_CONCURRENCY", 8))
+
+# Max. number of terms of a bulk lookup
+DICTIONARY_MAX_TERMS = int(os.getenv("DICTIONARY_MAX_TERMS", 200))
+
+# Definitions per (normalized) term, see DICTIONARY_CACHE_* env vars
+DictionaryCacheInstance = create_cache(
+    "dictionary", "DICTIONARY_CACHE", maxsize=4096, ttl=7 * 24 * 3600
+)
+
+
+def normalize_term(term: str) -> str:
+    """
+    Lower case, single spaces, no surrounding punctuation: "  Breast  Cancer," -> "breast cancer"
+    """
+    return " ".join(term.split()).strip(string.punctuation + " ").lower()
+
+
+class Dictionary(object):
+    """
+    Looks up terms in the Merriam-Webster medical dictionary, with a cache in front of it.
+    Terms are normalized (see normalize_term()) before looking them up.
+    Terms that aren't in the dictionary are cached, too (MW returns a list of suggestions for them),
+    but only for 'negative_ttl' seconds.
+    Concurrent lookups of the same term share one upstream request.
+
+    Env vars:
+        MW_API_URL                  dictionary API (default: MW medical dictionary)
+        MW_API_KEY                  API key
+        DICTIONARY_NEGATIVE_TTL     seconds until we look up unknown terms again (default: 1 day)
+        DICTIONARY_MAX_CONCURRENCY  max. concurrent requests to the dictionary API (default: 8)
+        DICTIONARY_MAX_TERMS        max. terms of a bulk lookup (POST /definitions) (default: 200)
+        DICTIONARY_CACHE_*          see app.cache.create_cache() (default: memory only, 4096 terms, 7 days)
+    """
+
+    def __init__(
+        self,
+        url: str = MW_API_URL,
+        api_key: str = MW_API_KEY,
+        cache: TieredCache = DictionaryCacheInstance,
+        negative_ttl: float = DICTIONARY_NEGATIVE_TTL,
+        max_concurrency: int = DICTIONARY_MAX_CONCURRENCY,
+        client: httpx.AsyncClient = None,
+    ):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        self.max_concurrency = max_concurrency
+        self.client = client
+        self.upstream_requests = 0
+
+        # normalized term -> pending upstream request
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # created on the event loop
+        self._semaphore: asyncio.Semaphore = None
+
+    async def lookup(self, term: str) -> list:
+        """
+        Definitions of a term, as returned by the dictionary API
+        """
+        key = normalize_term(term)
+        if not key:
+            return []
+
+        definitions = self.cache.get(key)
+        if definitions is not None:
+            return definitions
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(future)
+
+    async def lookup_many(self, terms: Iterable[str]) -> Dict[str, list]:
+        """
+        Looks up all terms concurrently, returns the definitions (or the exception) per term
+        """
+        terms = list(dict.fromkeys(terms))
+        results = await asyncio.gather(
+            *[self.lookup(term) for term in terms], return_exceptions=True
+        )
+        return dict(zip(terms, results))
+
+    async def _fetch(self, key: str) -> list:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        client = self.client or HttpClientsInstance.async_client
+        async with self._semaphore:
+            self.upstream_requests += 1
+            response = await client.get(
+                f"{self.url}/{quote(key)}", params={"key": self.api_key}
+            )
+        response.raise_for_status()
+
+        definitions = response.json() or []
+        # unknown terms: a list of suggestions (strings) instead of entries
+        found = any(isinstance(d, dict) for d in definitions)
+        self.cache.set(key, definitions, ttl=None if found else self.negative_ttl)
+
+        return definitions
+
+
+DictionaryInstance = Dictionary()
@@ -0,0 +1,151 @@
+import app
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.models import PipelineExecutionResponse
+
+
+class ExecutorQueueFull(Exception):
+    """
+    Raised when a pipeline execution can't be admitted because all workers are busy
+    and the wait queue is full. The API turns this into a "503 Service Unavailable".
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Pipeline execution queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _run_pipeline(
+    name: str, text: str, meta: dict, settings: dict, submitted: float
+) -> PipelineExecutionResponse:
+    """
+    Runs inside a worker (thread or process).
+    Has to be a module level function, so that it can be pickled for process pools.
+    Every worker process has its own PipelineFactory, e.g. its own cached spaCy models.
+    """
+    from app.pipeline import PipelineFactoryInstance
+
+    queue_wait_ms = round((timer() - submitted) * 1000)
+
+    with PipelineFactoryInstance.checkout(name, settings) as pipeline:
+        response = pipeline.execute(text=text, meta=meta, settings=settings)
+
+    # report how long this request waited for a free worker
+    timed = response.meta.setdefault("timed", {})
+    timed["queue_wait_ms"] = queue_wait_ms
+
+    return response
+
+
+class PipelineExecutor(object):
+    """
+    Runs pipeline executions off the event loop, in a bounded thread- or process pool.
+
+    At most 'max_workers' executions run at the same time, and at most 'queue_size' more
+    are waiting for a free worker. Everything beyond that is rejected right away with
+    ExecutorQueueFull, instead of piling up (and blocking everybody else).
+
+    Configured via env vars:
+        PIPELINE_EXECUTOR       "thread" (default) or "process"
+        PIPELINE_WORKERS        number of concurrent executions (default: 2)
+        PIPELINE_QUEUE_SIZE     number of waiting executions (default: 8)
+        PIPELINE_RETRY_AFTER    seconds reported in the "Retry-After" header (default: 10)
+    """
+
+    def __init__(
+        self,
+        mode: str = None,
+        max_workers: int = None,
+        queue_size: int = None,
+        retry_after: int = None,
+    ):
+        self.mode = (mode or os.getenv("PIPELINE_EXECUTOR", "thread")).lower()
+        self.max_workers = max_workers or int(os.getenv("PIPELINE_WORKERS", 2))
+        self.queue_size = (
+            queue_size
+            if queue_size is not None
+            else int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+        )
+        self.retry_after = retry_after or int(os.getenv("PIPELINE_RETRY_AFTER", 10))
+
+        if self.mode not in ["thread", "process"]:
+            raise ValueError(f"Unknown pipeline executor mode: '{self.mode}'")
+
+        # admission control: running + waiting executions
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.queue_size)
+        self._executor: Executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> Executor:
+        # created lazily, so that importing this module doesn't spawn workers
+        with self._lock:
+            if self._executor is None:
+                log.info(
+                    f"Starting pipeline {self.mode} pool with {self.max_workers} workers, queue size {self.queue_size}"
+                )
+                if self.mode == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix="pipeline",
+                    )
+            return self._executor
+
+    async def execute(
+        self, name: str, text: str, meta: dict = {}, settings: dict = {}
+    ) -> PipelineExecutionResponse:
+        """
+        Submits a pipeline execution and waits (non-blocking) for its result.
+        Raises ExecutorQueueFull if there's no room left in the queue.
+        """
+        self.acquire(name)
+        try:
+            future = self.executor.submit(
+                _run_pipeline, name, text, meta, settings, timer()
+            )
+        except Exception:
+            self.release()
+            raise
+
+        future.add_done_callback(lambda f: self.release())
+
+        return await asyncio.wrap_future(future)
+
+    def acquire(self, name: str):
+        """
+        Takes a slot for an execution of pipeline 'name', release() it when the execution is done.
+        Executions that don't run in the pool (e.g. batches, which are streamed from the API process)
+        take their slot with this directly, so they count against the same limit.
+        Raises ExecutorQueueFull if there's no room left in the queue.
+        """
+        if not self._slots.acquire(blocking=False):
+            log.warning(f"Rejecting execution of pipeline '{name}', queue is full")
+            raise ExecutorQueueFull(self.retry_after)
+
+    def release(self):
+        self._slots.release()
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None:
+                log.info(f"Shutting down pipeline {self.mode} pool")
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+PipelineExecutorInstance = PipelineExecutor()
@@ -1,14 +1,10 @@
 import app
-import time
 from app.extractor.base import BaseExtractor
-import os, os.path, logging, requests, tempfile
+import os, os.path, logging
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 
-from requests_file import FileAdapter
-from urllib3.packages.six import BytesIO, StringIO
-
 
 log = logging.getLogger(__name__)
 
@@ -16,7 +12,9 @@ log = logging.getLogger(__name__)
 from app.models import ExtractorRequest, ExtractorResponse
 
 
-from app.extractor.base import detect_content_type
+from app.extractor.base import detect_content_type, run_in_extractor_pool
+from app.extractor.fetch import FetchContext, request_fetch
+from app.extractor.abbyy_ocr_runner import AbbyyOcrJobRunnerInstance, abbyy_ocr_app_id
 
 # Alternative: use ABBYY OCR service (commercial)
 # This extractor uses Abbyy OCR service to extract text from (scanned/ photographed) images.
@@ -26,47 +24,20 @@ from app.extractor.base import detect_content_type
 # https://github.com/abbyy/ocrsdk.com
 # We'll use the V2 json API (preview), see:
 # https://support.abbyy.com/hc/en-us/sections/360004931659-API-v2-JSON-version-
-
-abbyy_ocr_app_id = os.getenv("ABBYY_OCR_APP_ID", None)
-abbyy_ocr_password = os.getenv("ABBYY_OCR_PASSWORD", None)
-abbyy_ocr_url = os.getenv("ABBYY_OCR_URL", None)
+# The OCR tasks are run (and polled) by the AbbyyOcrJobRunner, see abbyy_ocr_runner.py
 
 
-def _is_supported_content_type(filename_or_url: str) -> bool:
-    content_type = detect_content_type(filename_or_url)
+def _is_supported_content_type(
+    filename_or_url: str, context: FetchContext = None
+) -> bool:
+    content_type = detect_content_type(filename_or_url, context)
 
     return "image" in content_type.lower()
 
 
 class AbbyyOcrExtractor(BaseExtractor):
-    def _processImage(self, filename):
-        # see: https://support.abbyy.com/hc/en-us/articles/360017269680-processImage-Method
-        url = f"{abbyy_ocr_url}/v2/processImage?language=english,german&profile=textExtraction&exportformat=txt"
-        try:
-            with open(filename, "rb") as image_file:
-                data = image_file.read()
-                result = requests.post(
-                    url, auth=(abbyy_ocr_app_id, abbyy_ocr_password), data=data
-                )
-                if result.status_code == 200:
-                    taskId = result.json()["taskId"]
-                    result_url = f"{abbyy_ocr_url}/v2/getTaskStatus?taskId={taskId}"
-                    downloadUrl = None
-                    while not downloadUrl:
-                        # FIXME: add timeout / error handling
-                        time.sleep(1)
-                        result = requests.get(
-                            result_url, auth=(abbyy_ocr_app_id, abbyy_ocr_password)
-                        )
-                        urls = result.json().get("resultUrls", None)
-                        if urls:
-                            downloadUrl = urls[0]
-
-                    return requests.get(downloadUrl).text
-                return None
-
-        except Exception as e:
-            log.error(e)
+    def _processImage(self, data: bytes):
+        return AbbyyOcrJobRunnerInstance.process(data)
 
     def can_handle(self, request: ExtractorRequest) -> bool:
         if not abbyy_ocr_app_id:
@@ -78,9 +49,12 @@ class AbbyyOcrExtractor(BaseExtractor):
         # check if the env vars are set and the filename/url points to a supported file format (image or pdf)
         is_supported_format = False
 
-        # URL -> try a HEAD request to determine the MIME content type
-        if request.url:
-            is_supported_format = _is_supported_content_type(request.url)
+        # URL or buffer -> determine the MIME content type from the first bytes
+        if request.url or request.buffer is not None:
+            with request_fetch(request) as fetch:
+                is_supported_format = _is_supported_content_type(
+                    request.url or request.filename, fetch
+                )
         elif request.filename:
             # filename -> check for file extension for image file
             extension = os.path.splitext(request.filename)[1][1:].lower()
@@ -98,25 +72,34 @@ class AbbyyOcrExtractor(BaseExtractor):
     def extract(self, request: ExtractorRequest) -> ExtractorResponse:
         log.info(f"Extracting text from image (Abbyy Cloud OCR) ...")
 
-        tmp = None
+        try:
+            # buffer, (shared) download or local file
+            with request_fetch(request) as fetch:
+                fulltext = self._processImage(fetch.content())
+            meta = {
+                **(request.meta or {}),
+                **{"source": "image", "extractor": "abbyy_ocr"},
+            }
+            return ExtractorResponse(text=fulltext or "", meta=meta)
+        except Exception as e:
+            msg = f"Error extracting text using Abbyy Cloud OCR: '{str(e)}'"
+            log.error(msg)
+            return ExtractorResponse(error=msg)
+
+    async def aextract(self, request: ExtractorRequest) -> ExtractorResponse:
+        log.info(f"Extracting text from image (Abbyy Cloud OCR) ...")
 
         try:
-            # if url, download to temp file first
-            if request.url:
-                r = requests.get(request.url)
-                tmp = tempfile.NamedTemporaryFile(delete=False, mode="wb")
-                tmp.write(r.content)
-                tmp.close()
-                fulltext = self._processImage(tmp.name)
-            else:
-                fulltext = self._processImage(request.filename)
-            meta = {**request.meta, **{"source": "image", "extractor": "abbyy_ocr"}}
+            # reading the document blocks, waiting for the OCR tasks doesn't (see AbbyyOcrJobRunner)
+            with request_fetch(request) as fetch:
+                data = await run_in_extractor_pool(fetch.content)
+                fulltext = await AbbyyOcrJobRunnerInstance.aprocess(data)
+            meta = {
+                **(request.meta or {}),
+                **{"source": "image", "extractor": "abbyy_ocr"},
+            }
             return ExtractorResponse(text=fulltext or "", meta=meta)
         except Exception as e:
             msg = f"Error extracting text using Abbyy Cloud OCR: '{str(e)}'"
             log.error(msg)
             return ExtractorResponse(error=msg)
-        finally:
-            if tmp:
-                tmp.close()
-                os.unlink(tmp.name)
@@ -0,0 +1,221 @@
+import app
+import asyncio
+import io
+import os
+import logging
+import threading
+from typing import List, Optional
+from dotenv import load_dotenv, find_dotenv
+
+import httpx
+from PIL import Image
+
+load_dotenv(find_dotenv())
+
+from app.http_clients import HttpClientsInstance
+
+
+log = logging.getLogger(__name__)
+
+
+abbyy_ocr_app_id = os.getenv("ABBYY_OCR_APP_ID", None)
+abbyy_ocr_password = os.getenv("ABBYY_OCR_PASSWORD", None)
+abbyy_ocr_url = os.getenv("ABBYY_OCR_URL", None)
+
+# Deadline of a whole OCR request (all pages, incl. polling and download) in seconds
+ABBYY_OCR_TIMEOUT = float(os.getenv("ABBYY_OCR_TIMEOUT", 120))
+# Max. number of OCR tasks in flight at the ABBYY service (per process)
+ABBYY_OCR_MAX_JOBS = int(os.getenv("ABBYY_OCR_MAX_JOBS", 4))
+# First poll after this many seconds, doubling up to ABBYY_OCR_POLL_MAX_INTERVAL
+ABBYY_OCR_POLL_INTERVAL = float(os.getenv("ABBYY_OCR_POLL_INTERVAL", 0.5))
+ABBYY_OCR_POLL_MAX_INTERVAL = float(os.getenv("ABBYY_OCR_POLL_MAX_INTERVAL", 5))
+
+# Task states that won't produce a result anymore, see:
+# https://support.abbyy.com/hc/en-us/articles/360017326719-Task-statuses
+FAILED_TASK_STATES = {"ProcessingFailed", "NotEnoughCredits", "Deleted"}
+
+
+class AbbyyOcrError(Exception):
+    """
+    Raised when an OCR task fails or doesn't finish before the deadline
+    """
+
+    pass
+
+
+def split_pages(data: bytes) -> List[bytes]:
+    """
+    Splits multi-frame images (TIFF, GIF) into one image per page.
+    Everything else (incl. PDF, which ABBYY takes as a whole) is returned as a single page.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            frames = getattr(image, "n_frames", 1)
+            if frames <= 1:
+                return [data]
+
+            page_format = "TIFF" if image.format == "TIFF" else "PNG"
+            pages = []
+            for frame in range(frames):
+                image.seek(frame)
+                page = io.BytesIO()
+                image.save(page, format=page_format)
+                pages.append(page.getvalue())
+            return pages
+    except Exception:
+        # not an image Pillow knows
+        return [data]
+
+
+class AbbyyOcrJobRunner(object):
+    """
+    Runs ABBYY Cloud OCR tasks on an asyncio event loop in a background thread,
+    so a waiting extractor only blocks on the result, not on the polling.
+
+    Every page of a document is submitted as its own task, all in parallel
+    (but not more than 'max_jobs' in flight per process), and polled with exponential backoff.
+    If the document isn't done before the deadline ('timeout'), AbbyyOcrError is raised.
+    All requests go through one pooled HTTP client (see app.http_clients), the result downloads too.
+
+    Env vars:
+        ABBYY_OCR_TIMEOUT               deadline of an OCR request in seconds (default: 120)
+        ABBYY_OCR_MAX_JOBS              max. OCR tasks in flight (default: 4)
+        ABBYY_OCR_POLL_INTERVAL         first poll interval in seconds (default: 0.5)
+        ABBYY_OCR_POLL_MAX_INTERVAL     max. poll interval in seconds (default: 5)
+    """
+
+    def __init__(
+        self,
+        url: str = abbyy_ocr_url,
+        app_id: str = abbyy_ocr_app_id,
+        password: str = abbyy_ocr_password,
+        timeout: float = ABBYY_OCR_TIMEOUT,
+        max_jobs: int = ABBYY_OCR_MAX_JOBS,
+        poll_interval: float = ABBYY_OCR_POLL_INTERVAL,
+        max_poll_interval: float = ABBYY_OCR_POLL_MAX_INTERVAL,
+    ):
+        self.url = url
+        self.auth = (app_id, password)
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # created on the loop
+        self._client: httpx.AsyncClient = None
+        self._semaphore: asyncio.Semaphore = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="abbyy-ocr", daemon=True
+                ).start()
+        return self._loop
+
+    def process(self, data: bytes) -> str:
+        """
+        OCR of a document, blocks until it's done (or the deadline passed)
+        """
+        future = asyncio.run_coroutine_threadsafe(self._process(data), self._get_loop())
+        return future.result()
+
+    async def aprocess(self, data: bytes) -> str:
+        """
+        Same as process(), to be awaited on any other event loop
+        """
+        future = asyncio.run_coroutine_threadsafe(self._process(data), self._get_loop())
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    async def _process(self, data: bytes) -> str:
+        if self._client is None:
+            self._client = HttpClientsInstance.create_async_client(
+                limits=httpx.Limits(max_connections=self.max_jobs * 2)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+
+        deadline = asyncio.get_event_loop().time() + self.timeout
+        pages = split_pages(data)
+        if len(pages) > 1:
+            log.info(f"Submitting {len(pages)} pages to ABBYY OCR ...")
+
+        try:
+            # also covers the time waiting for a free job slot
+            texts = await asyncio.wait_for(
+                asyncio.gather(*[self._run_task(page, deadline) for page in pages]),
+                self.timeout,
+            )
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            # the timeouts of the single requests are the remaining time until the deadline, too
+            raise AbbyyOcrError(f"ABBYY OCR didn't finish within {self.timeout}s")
+
+        return "\n\n".join(texts)
+
+    def _remaining(self, deadline: float, task_id: str = None) -> float:
+        remaining = deadline - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            raise AbbyyOcrError(
+                f"ABBYY OCR task {task_id or ''} didn't finish within {self.timeout}s"
+            )
+        return remaining
+
+    async def _run_task(self, data: bytes, deadline: float) -> str:
+        # see: https://support.abbyy.com/hc/en-us/articles/360017269680-processImage-Method
+        async with self._semaphore:
+            response = await self._client.post(
+                f"{self.url}/v2/processImage",
+                params={
+                    "language": "english,german",
+                    "profile": "textExtraction",
+                    "exportformat": "txt",
+                },
+                content=data,
+                auth=self.auth,
+                timeout=self._remaining(deadline),
+            )
+            response.raise_for_status()
+            task_id = response.json()["taskId"]
+
+            interval = self.poll_interval
+            while True:
+                await asyncio.sleep(min(interval, self._remaining(deadline, task_id)))
+                interval = min(interval * 2, self.max_poll_interval)
+
+                response = await self._client.get(
+                    f"{self.url}/v2/getTaskStatus",
+                    params={"taskId": task_id},
+                    auth=self.auth,
+                    timeout=self._remaining(deadline, task_id),
+                )
+                response.raise_for_status()
+                status = response.json()
+
+                if status.get("status") in FAILED_TASK_STATES:
+                    raise AbbyyOcrError(
+                        f"ABBYY OCR task {task_id} failed: {status.get('status')} {status.get('error', '')}"
+                    )
+                urls = status.get("resultUrls", None)
+                if urls:
+                    break
+
+        # the result is on (public) blob storage, no auth
+        response = await self._client.get(
+            urls[0], timeout=self._remaining(deadline, task_id)
+        )
+        response.raise_for_status()
+        return response.text
+
+
+AbbyyOcrJobRunnerInstance = AbbyyOcrJobRunner()
@@ -1,35 +1,106 @@
 from app.utils import timed
 
+import os
 from os import path
-import requests, logging
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from urllib3.packages.six import BytesIO
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
 
 
 log = logging.getLogger(__name__)
 
 
 from app.models import ExtractorRequest, ExtractorResponse
+from app.extractor.fetch import FetchContext
+from app.extractor.content_type import sniff_content_type
 
 # import detector object from tika
 from tika import detector
 
+# Max. number of (sync) extractor calls running at the same time for the async API, see BaseExtractor.aextract()
+EXTRACTOR_THREADS = int(os.getenv("EXTRACTOR_THREADS", 8))
+
+_pool: ThreadPoolExecutor = None
+_pool_lock = threading.Lock()
+
+
+def run_in_extractor_pool(func, *args) -> asyncio.Future:
+    """
+    Runs a blocking extractor call in the extractor thread pool, to be awaited on the event loop
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=EXTRACTOR_THREADS, thread_name_prefix="extractor"
+            )
+
+    return asyncio.get_event_loop().run_in_executor(_pool, partial(func, *args))
+
+
+def shutdown_extractor_pool(wait: bool = True):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait)
+            _pool = None
+
+
+# Tika needs more than the first bytes to tell what's inside these, e.g. OOXML documents are zip files
+CONTAINER_CONTENT_TYPES = [
+    "application/zip",
+    "application/x-tika-ooxml",
+    "application/x-tika-msoffice",
+    "application/octet-stream",
+]
+
 
 @timed()
-def detect_content_type(filename_or_url: str) -> str:
+def detect_content_type(filename_or_url: str, context: FetchContext = None) -> str:
     """
-    Use tika to get the content type of a file or url.
-    TODO there may be faster/ better ways
+    Get the content type of a file or url. We check magic bytes, the declared content type and
+    the file extension first (see sniff_content_type), and only ask Tika if that's inconclusive.
+    With a FetchContext, the content type is memoized, and urls are detected from the first bytes
+    of the (shared) download instead of downloading the whole document.
+    The detector that decided is stored in 'context.content_type_detector'.
     """
-    content_type = None
-    try:
+    if context is None:
         if path.isfile(filename_or_url):
-
-            content_type = detector.from_file(filename_or_url)
+            context = FetchContext(filename=filename_or_url)
         else:
-            buffer = requests.get(filename_or_url).content
-            content_type = detector.from_buffer(BytesIO(buffer))
+            context = FetchContext(url=filename_or_url)
+        try:
+            return detect_content_type(filename_or_url, context)
+        finally:
+            context.close()
+
+    if context.content_type:
+        return context.content_type
 
-        log.info(f"Detected '{content_type}' as content type for: {filename_or_url}")
+    content_type = None
+    try:
+        content_type, detector_name = sniff_content_type(
+            context.head(), context.name, context.declared_content_type
+        )
+
+        if not content_type:
+            detector_name = "tika"
+            if context.is_local and not context.is_buffered:
+                content_type = detector.from_file(context.filename)
+            else:
+                content_type = detector.from_buffer(BytesIO(context.head()))
+                if content_type in CONTAINER_CONTENT_TYPES:
+                    content_type = detector.from_buffer(BytesIO(context.content()))
+
+        log.info(
+            f"Detected '{content_type}' ({detector_name}) as content type for: {filename_or_url}"
+        )
 
     except Exception as e:
         msg = f"Error detecting content type of '{filename_or_url}' : {str(e)}"
@@ -37,6 +108,8 @@ def detect_content_type(filename_or_url: str) -> str:
         raise Exception(msg)
 
     assert content_type
+    context.content_type = content_type
+    context.content_type_detector = detector_name
 
     return content_type
 
@@ -44,6 +117,10 @@ def detect_content_type(filename_or_url: str) -> str:
 class BaseExtractor(object):
     """
     Extractors can extract raw (e.g. not preprocessed or cleaned) text and metadata from urls and/or local files
+
+    acan_handle()/aextract() are the async variants, for the API's event loop.
+    By default, they run can_handle()/extract() in the extractor thread pool (see EXTRACTOR_THREADS),
+    extractors that can do (some of) their work natively async override them.
     """
 
     def can_handle(self, request: ExtractorRequest) -> bool:
@@ -51,3 +128,9 @@ class BaseExtractor(object):
 
     def extract(self, request: ExtractorRequest) -> ExtractorResponse:
         raise NotImplementedError("This method should be overriden in subclass")
+
+    async def acan_handle(self, request: ExtractorRequest) -> bool:
+        return await run_in_extractor_pool(self.can_handle, request)
+
+    async def aextract(self, request: ExtractorRequest) -> ExtractorResponse:
+        return await run_in_extractor_pool(self.extract, request)
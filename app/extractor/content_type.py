@@ -0,0 +1,137 @@
+import os
+import logging
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+
+log = logging.getLogger(__name__)
+
+
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PPTX = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+JPEG = "image/jpeg"
+PNG = "image/png"
+TIFF = "image/tiff"
+GIF = "image/gif"
+HTML = "text/html"
+TEXT = "text/plain"
+
+# (signature, content type), checked against the first bytes of a document
+MAGIC_BYTES = [
+    (b"%PDF-", PDF),
+    (b"\x89PNG\r\n\x1a\n", PNG),
+    (b"\xff\xd8\xff", JPEG),
+    (b"GIF87a", GIF),
+    (b"GIF89a", GIF),
+    (b"II*\x00", TIFF),
+    (b"MM\x00*", TIFF),
+]
+
+# OOXML documents are zip files, the part names tell us which kind of document it is
+ZIP_MAGIC = b"PK\x03\x04"
+OOXML_PARTS = [(b"word/", DOCX), (b"xl/", XLSX), (b"ppt/", PPTX)]
+
+HTML_MARKERS = [b"<!doctype html", b"<html", b"<head", b"<body"]
+
+EXTENSIONS = {
+    ".pdf": PDF,
+    ".docx": DOCX,
+    ".xlsx": XLSX,
+    ".pptx": PPTX,
+    ".jpg": JPEG,
+    ".jpeg": JPEG,
+    ".png": PNG,
+    ".tif": TIFF,
+    ".tiff": TIFF,
+    ".gif": GIF,
+    ".html": HTML,
+    ".htm": HTML,
+    ".txt": TEXT,
+}
+
+# Declared content types (e.g. the "Content-Type" response header) we trust
+DECLARED_CONTENT_TYPES = set(EXTENSIONS.values()) | {"application/xhtml+xml"}
+
+
+def _from_magic_bytes(head: bytes) -> Optional[str]:
+    for signature, content_type in MAGIC_BYTES:
+        if head.startswith(signature):
+            return content_type
+
+    if head.startswith(ZIP_MAGIC):
+        for part, content_type in OOXML_PARTS:
+            if part in head:
+                return content_type
+        # some other zip file, or the parts are further back
+        return None
+
+    start = head[:1024].lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if any(marker in start for marker in HTML_MARKERS):
+        return HTML
+
+    return None
+
+
+def _from_declared(declared: Optional[str]) -> Optional[str]:
+    if not declared:
+        return None
+
+    content_type = declared.split(";")[0].strip().lower()
+    return content_type if content_type in DECLARED_CONTENT_TYPES else None
+
+
+def _from_extension(filename_or_url: Optional[str]) -> Optional[str]:
+    if not filename_or_url:
+        return None
+
+    if "://" in filename_or_url:
+        filename_or_url = urlparse(filename_or_url).path
+
+    extension = os.path.splitext(filename_or_url)[1].lower()
+    return EXTENSIONS.get(extension)
+
+
+def _is_text(head: bytes) -> bool:
+    if not head or b"\x00" in head:
+        return False
+
+    # the head may end within a multi-byte character
+    for cut in range(4):
+        try:
+            head[: len(head) - cut].decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            pass
+
+    return False
+
+
+def sniff_content_type(
+    head: bytes, filename_or_url: str = None, declared: str = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Fast (local) content type detection for the document types we usually see:
+    PDF, DOCX/OOXML, JPEG, PNG, TIFF, GIF, HTML and plain text.
+    Checks (in this order) the magic bytes in the first bytes ('head') of the document,
+    the declared content type (e.g. a "Content-Type" header), the file extension and whether it's text at all.
+
+    Returns (content type, name of the detector that decided), or (None, None) if inconclusive.
+    """
+    content_type = _from_magic_bytes(head)
+    if content_type:
+        return content_type, "magic"
+
+    content_type = _from_declared(declared)
+    if content_type:
+        return content_type, "declared"
+
+    content_type = _from_extension(filename_or_url)
+    if content_type:
+        return content_type, "extension"
+
+    if _is_text(head):
+        return TEXT, "text"
+
+    return None, None
@@ -0,0 +1,324 @@
+import app
+import io
+import os
+import logging
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Optional, Union
+from dotenv import load_dotenv, find_dotenv
+
+import requests
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.http_clients import HttpClientsInstance
+from app.models import ExtractorRequest
+
+
+# Bodies larger than this are spooled to a temp file on disk
+FETCH_SPOOL_MAX_BYTES = int(os.getenv("FETCH_SPOOL_MAX_BYTES", 10 * 1024 * 1024))
+# How many bytes we read for content type detection
+FETCH_HEAD_BYTES = int(os.getenv("FETCH_HEAD_BYTES", 8192))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 15))
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchContext(object):
+    """
+    Per-request state of a document (url, local file or in-memory buffer), shared by all extractors that look at it:
+
+    - the first bytes of the document, for content type detection
+    - the detected content type (memoized)
+    - the document body, downloaded at most once
+
+    The first bytes can be passed in ('head'), if we already have them.
+
+    A 'buffer' (bytes or memoryview, e.g. a small upload) is used as it is, without touching the filesystem,
+    unless an extractor asks for a path(). 'filename' is then just the name of the document.
+    Which one the extractors used in the end, is in 'input': "buffer" or "file".
+
+    For urls, we open a single streaming GET request and only read what's needed:
+    if no extractor needs the body (e.g. it's an image and Azure Computer Vision gets the url),
+    we only downloaded the first few KB.
+    Bodies larger than 'spool_max_bytes' are spooled to a temp file, which is deleted on close().
+
+    Env vars:
+        FETCH_SPOOL_MAX_BYTES    bodies above this size go to disk (default: 10 MB)
+        FETCH_HEAD_BYTES         bytes read for content type detection (default: 8 KB)
+        FETCH_TIMEOUT            timeout in seconds of the document request (default: 15)
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        filename: str = None,
+        declared_content_type: str = None,
+        head: bytes = None,
+        buffer: Union[bytes, memoryview] = None,
+        spool_max_bytes: int = FETCH_SPOOL_MAX_BYTES,
+        head_bytes: int = FETCH_HEAD_BYTES,
+        timeout: float = FETCH_TIMEOUT,
+    ):
+        assert url or filename or buffer is not None
+        self.url = url
+        self.filename = filename
+        self.buffer = buffer
+        self.spool_max_bytes = spool_max_bytes
+        self.head_bytes = head_bytes
+        self.timeout = timeout
+
+        # memoized by detect_content_type(), with the name of the detector that decided
+        self.content_type: Optional[str] = None
+        self.content_type_detector: Optional[str] = None
+        # "buffer" or "file", how the extractors got the document body
+        self.input: Optional[str] = None
+
+        self._declared_content_type = declared_content_type
+
+        self._response: requests.Response = None
+        # e.g. a 404 of the document request, raised again on every later access
+        self._error: Exception = None
+        # e.g. the first chunk of an upload, see app.extractor.upload
+        self._head: bytes = head[:head_bytes] if head is not None else None
+        self._body: io.BytesIO = None
+        self._spool_file = None
+        self._complete = False
+
+    @classmethod
+    def from_request(cls, request: ExtractorRequest) -> "FetchContext":
+        # e.g. the content type of an uploaded file, as declared by the client
+        declared = (request.meta or {}).get("content_type")
+        return cls(
+            url=request.url,
+            filename=request.filename,
+            declared_content_type=declared,
+            buffer=request.buffer,
+        )
+
+    @property
+    def name(self) -> str:
+        return self.url or self.filename
+
+    @property
+    def is_local(self) -> bool:
+        return not self.url
+
+    @property
+    def is_buffered(self) -> bool:
+        return self.buffer is not None
+
+    @property
+    def headers(self) -> dict:
+        """
+        Response headers of the document request (empty for local files)
+        """
+        if self.is_local:
+            return {}
+        self._open()
+        return self._response.headers
+
+    @property
+    def declared_content_type(self) -> Optional[str]:
+        """
+        The "Content-Type" header of the document request (for local files: as passed in)
+        """
+        if self.is_local:
+            return self._declared_content_type
+        return self.headers.get("content-type") or self._declared_content_type
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return None if self.is_local else self._open().encoding
+
+    @property
+    def downloaded_bytes(self) -> int:
+        if self._spool_file:
+            return self._spool_file.tell()
+        return self._body.tell() if self._body else 0
+
+    def _open(self) -> requests.Response:
+        if self._error is not None:
+            raise self._error
+        if self._response is None:
+            log.info(f"Fetching {self.url} ...")
+            response = HttpClientsInstance.session.get(
+                self.url, stream=True, timeout=self.timeout, allow_redirects=True
+            )
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                # the next extractor that looks at the document gets the same error, we don't fetch it again
+                response.close()
+                self._error = e
+                raise
+            self._response = response
+            self._body = io.BytesIO()
+        return self._response
+
+    def _read(self, size: int = None):
+        """
+        Reads (at least) 'size' bytes of the body, or the whole body
+        """
+        response = self._open()
+        chunk_size = min(CHUNK_SIZE, size) if size else CHUNK_SIZE
+        for chunk in response.iter_content(chunk_size):
+            self._write(chunk)
+            if size is not None and self.downloaded_bytes >= size:
+                return
+
+        self._complete = True
+        response.close()
+        log.info(f"Fetched {self.downloaded_bytes} bytes from {self.url}")
+
+    def _write(self, chunk: bytes):
+        if self._spool_file is None and (
+            self._body.tell() + len(chunk) > self.spool_max_bytes
+        ):
+            # too large to keep in memory
+            self._spool_file = tempfile.NamedTemporaryFile(
+                prefix="jargonbuster_fetch_", delete=False
+            )
+            self._spool_file.write(self._body.getvalue())
+            self._body = None
+
+        (self._spool_file or self._body).write(chunk)
+
+    def head(self) -> bytes:
+        """
+        The first bytes of the document
+        """
+        if self._head is None:
+            if self.is_buffered:
+                self._head = bytes(memoryview(self.buffer)[: self.head_bytes])
+            elif self.is_local:
+                with open(self.filename, "rb") as f:
+                    self._head = f.read(self.head_bytes)
+            else:
+                if self.downloaded_bytes < self.head_bytes and not self._complete:
+                    self._read(self.head_bytes)
+                self._head = self._peek(self.head_bytes)
+
+        return self._head
+
+    def _peek(self, size: int) -> bytes:
+        """
+        The first bytes of what we downloaded so far
+        """
+        if self._spool_file is not None:
+            self._spool_file.flush()
+            with open(self._spool_file.name, "rb") as f:
+                return f.read(size)
+
+        return self._body.getbuffer()[:size].tobytes()
+
+    def _download(self):
+        if not self.is_local and not self._complete:
+            self._read()
+
+    def is_spooled(self) -> bool:
+        """
+        True if the body is (or would be) kept on disk
+        """
+        if self.is_buffered:
+            return False
+        if self.is_local:
+            return True
+        self._download()
+        return self._spool_file is not None
+
+    def content(self) -> bytes:
+        """
+        The whole body, in memory (for buffers and downloads that weren't spooled: without copying it again)
+        """
+        if self.is_buffered:
+            self.input = "buffer"
+            return bytes(self.buffer)
+        if not self.is_spooled():
+            self.input = "buffer"
+            return self._body.getvalue()
+
+        with self.open() as f:
+            return f.read()
+
+    def text(self, errors: str = "replace") -> str:
+        return self.content().decode(self.encoding or "utf-8", errors=errors)
+
+    def open(self) -> BinaryIO:
+        """
+        Opens the whole body for reading
+        """
+        if self.is_buffered:
+            self.input = "buffer"
+            return io.BytesIO(self.buffer)
+        if self.is_local:
+            self.input = "file"
+            return open(self.filename, "rb")
+
+        self._download()
+        if self._spool_file is not None:
+            self._spool_file.flush()
+            self.input = "file"
+            return open(self._spool_file.name, "rb")
+
+        self.input = "buffer"
+        return io.BytesIO(self._body.getvalue())
+
+    def path(self) -> str:
+        """
+        Filename of the body on disk (spooled to disk, if needed)
+        """
+        self.input = "file"
+        if self.is_local and not self.is_buffered:
+            return self.filename
+
+        if not self.is_buffered:
+            self._download()
+        if self._spool_file is None:
+            suffix = os.path.splitext(self.filename or "")[1]
+            self._spool_file = tempfile.NamedTemporaryFile(
+                prefix="jargonbuster_fetch_", suffix=suffix, delete=False
+            )
+            if self.is_buffered:
+                self._spool_file.write(self.buffer)
+            else:
+                self._spool_file.write(self._body.getvalue())
+                self._body = None
+        self._spool_file.flush()
+
+        return self._spool_file.name
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        if self._spool_file is not None:
+            self._spool_file.close()
+            try:
+                os.unlink(self._spool_file.name)
+            except OSError as e:
+                log.warning(f"Can't delete fetch temp file: {str(e)}")
+            self._spool_file = None
+        self._body = None
+
+
+@contextmanager
+def request_fetch(request: ExtractorRequest):
+    """
+    The FetchContext of the request. Creates (and closes) a new one, if the request doesn't have one yet,
+    e.g. when an extractor is used on its own, not via the UniversalExtractor.
+    """
+    if request._fetch is not None:
+        yield request._fetch
+        return
+
+    context = FetchContext.from_request(request)
+    request._fetch = context
+    try:
+        yield context
+    finally:
+        request._fetch = None
+        context.close()
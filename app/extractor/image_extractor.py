@@ -1,7 +1,8 @@
 import app
-from app.extractor.spellcheck import Spellchecker
+from app.extractor.spellcheck import SpellcheckerRegistryInstance
 import os
 import logging
+from typing import BinaryIO, List, Tuple
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
@@ -31,13 +32,51 @@ region = os.getenv("AZ_COMPUTER_VISION_REGION", None)
 key = os.getenv("AZ_COMPUTER_VISION_KEY", None)
 
 from app.extractor.base import detect_content_type
+from app.extractor.fetch import FetchContext, request_fetch
 
 
-def _is_supported_content_type(filename_or_url: str) -> bool:
-    content_type = detect_content_type(filename_or_url)
+def _is_supported_content_type(
+    filename_or_url: str, context: FetchContext = None
+) -> bool:
+    content_type = detect_content_type(filename_or_url, context)
     return "image" in content_type.lower()
 
 
+def _assemble_text(ocr_result: OcrResult, words: List[str]) -> Tuple[str, dict]:
+    """
+    Joins the (corrected) words of all regions and lines: words are separated by a space,
+    lines by a newline and regions by two more newlines.
+
+    Also returns the layout of the words, as parallel arrays:
+        offsets   [start, end] of each word in the text
+        boxes     [left, top, width, height] of each word on the page, in pixels
+    """
+    parts = []
+    offsets = []
+    boxes = []
+    position = 0
+
+    words = iter(words)
+    for region in ocr_result.regions:
+        for line in region.lines:
+            for word in line.words:
+                corrected = next(words)
+                if corrected != word.text:
+                    log.debug(f"auto-corrected word: {word.text} -> {corrected}")
+
+                offsets.append([position, position + len(corrected)])
+                boxes.append([int(v) for v in word.bounding_box.split(",")])
+                parts.append(corrected)
+                parts.append(" ")
+                position += len(corrected) + 1
+            parts.append("\n")
+            position += 1
+        parts.append("\n\n")
+        position += 2
+
+    return "".join(parts), {"offsets": offsets, "boxes": boxes}
+
+
 class ImageExtractor(BaseExtractor):
     """
     This does Object Character Recognition (OCR) using Azure Computer Vision Service
@@ -58,23 +97,24 @@ class ImageExtractor(BaseExtractor):
             )
             self.vision_client = None
 
-    def _extract_text_from_image(self, filename_or_url: str, language: str = "en"):
+    def _extract_text_from_image(
+        self, url: str = None, image: BinaryIO = None, language: str = "en"
+    ):
         # url = "https://upload.wikimedia.org/wikipedia/commons/thumb/1/12/Broadway_and_Times_Square_by_night.jpg/450px-Broadway_and_Times_Square_by_night.jpg"
         # API docs: https://azuresdkdocs.blob.core.windows.net/$web/python/azure-cognitiveservices-vision-computervision/0.7.0/azure.cognitiveservices.vision.computervision.models.html#azure.cognitiveservices.vision.computervision.models.OcrResult
 
         # Raw response from Azure Cognitive Service
         ocr_result: OcrResult = None
 
-        if os.path.isfile(filename_or_url):
-            # Process a local file
-            local_image = open(filename_or_url, "rb")
+        if image is not None:
+            # Process a local file or buffer
             ocr_result = self.vision_client.recognize_printed_text_in_stream(
-                local_image, detect_orientation=True, language="unk"
+                image, detect_orientation=True, language="unk"
             )
         else:
             # Process a public URL
             ocr_result = self.vision_client.recognize_printed_text(
-                url=filename_or_url, detect_orientation=True, language="unk"
+                url=url, detect_orientation=True, language="unk"
             )
 
         # Transfer all data into meta
@@ -87,24 +127,22 @@ class ImageExtractor(BaseExtractor):
 
         # TODO improve word list w. medical dictionary + more languages.
         # FIXME: not very good results right now
-        spellcheck = Spellchecker(language=ocr_result.language)
+        spellcheck = SpellcheckerRegistryInstance.get(ocr_result.language)
+
+        # Correct all words of the page at once, each distinct word is looked up only once
+        words = [
+            word.text
+            for region in ocr_result.regions
+            for line in region.lines
+            for word in line.words
+        ]
+        corrected_words, meta["spellcheck"] = spellcheck.correct_words(words)
 
         # Now extract the text from all regions
-        fulltext = ""
-        for region in ocr_result.regions:
-            # print("Bounding box: {}".format(region.bounding_box))
-            for line in region.lines:
-                # print("Bounding box: {}".format(line.bounding_box))
-                for word in line.words:
-                    corrected = spellcheck.correct_word(word.text)
-                    if corrected != word.text:
-                        log.debug(f"auto-corrected word: {word.text} -> {corrected}")
-                    fulltext += corrected + " "
-                fulltext += "\n"
-            fulltext += "\n\n"
+        fulltext, layout = _assemble_text(ocr_result, corrected_words)
 
         # Return mutiple values
-        return fulltext, meta
+        return fulltext, meta, layout
 
     def can_handle(self, request: ExtractorRequest) -> bool:
         if not self.vision_client:
@@ -113,22 +151,24 @@ class ImageExtractor(BaseExtractor):
             )
             return False
 
-        return (request.url and _is_supported_content_type(request.url)) or (
-            request.filename and _is_supported_content_type(request.filename)
-        )
+        if not (request.url or request.filename or request.buffer is not None):
+            return False
+        with request_fetch(request) as fetch:
+            return _is_supported_content_type(request.url or request.filename, fetch)
 
     def extract(self, request: ExtractorRequest) -> ExtractorResponse:
         log.info(f"Extracting text from image (Azure Computer Vision OCR) ...")
 
         try:
             if request.url:
-                fulltext, meta = self._extract_text_from_image(request.url)
+                fulltext, meta, layout = self._extract_text_from_image(url=request.url)
             else:
-                fulltext, meta = self._extract_text_from_image(request.filename)
+                with request_fetch(request) as fetch, fetch.open() as image:
+                    fulltext, meta, layout = self._extract_text_from_image(image=image)
             # TODO get some meta data as well
             meta = {**meta, **{"source": "image", "extractor": "az-vision"}}
 
-            return ExtractorResponse(text=fulltext, meta=meta)
+            return ExtractorResponse(text=fulltext, meta=meta, layout=layout)
         except Exception as e:
             msg = f"Error extracting text using Azure Computer Vision: '{str(e)}'"
             log.error(msg)
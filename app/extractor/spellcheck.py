@@ -1,22 +1,52 @@
 import app
+import os
 from os import path
 import logging
 import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+from timeit import default_timer as timer
 import pkg_resources
 from symspellpy import SymSpell, Verbosity
+from dotenv import load_dotenv, find_dotenv
 
 import string
 
+load_dotenv(find_dotenv())
+
 
 log = logging.getLogger(__name__)
 
 
+from app.cache import hash_key
+
+
+# Languages to load at startup (comma separated), all others are loaded on first use
+SPELLCHECK_PRELOAD = os.getenv("SPELLCHECK_PRELOAD", "en")
+# Where the built SymSpell indexes are persisted (empty: don't persist)
+SPELLCHECK_CACHE_DIR = os.getenv("SPELLCHECK_CACHE_DIR", "./.cache/spellcheck")
+# Max. number of memoized word corrections (per language)
+SPELLCHECK_MEMO_SIZE = int(os.getenv("SPELLCHECK_MEMO_SIZE", 50000))
+
+RE_ALPHA = re.compile(r"[A-Za-z]")
+
+# language -> (package, resource) of the frequency dictionary
+DICTIONARIES = {
+    "en": ("symspellpy", "frequency_dictionary_en_82_765.txt"),
+}
+
+
 class Spellchecker(object):
     """
     We use https://github.com/mammothb/symspellpy to do basic word / n-gram based spell checking.
     It is based on SymSpell:
     https://github.com/wolfgarbe/SymSpell
 
+    Building the SymSpell index from the dictionary is expensive, so we persist the built index
+    (as pickle file in 'cache_dir') and load that one on the next start.
+    Don't create Spellcheckers per request, use SpellcheckerRegistryInstance.get(language) instead.
+
     TODO: We should be very cautious here and only "auto-correct" small one-off OCR errors (like "mnlicious -> malicious"),
     as otherwise we may change domain specific terms and abbreviations.
 
@@ -37,26 +67,92 @@ class Spellchecker(object):
     prefix_length = 7
     count_threshold = 2
 
-    def __init__(self, language="en"):
+    def __init__(
+        self,
+        language="en",
+        cache_dir: str = SPELLCHECK_CACHE_DIR,
+        memo_size: int = SPELLCHECK_MEMO_SIZE,
+    ):
+        self.language = language
+        # "pickle" or "dictionary", where the index came from
+        self.index_source = None
+
+        # memoized corrections, least recently used first
+        self.memo_size = memo_size
+        self._memo: "OrderedDict[str, str]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_misses = 0
+
         self.sym_spell = SymSpell(
             max_dictionary_edit_distance=self.max_dict_edit_distance,
             prefix_length=self.prefix_length,
             count_threshold=self.count_threshold,
         )
         # FIXME support non-english languages and custom models
-        if language == "en":
+        if language in DICTIONARIES:
             self.dictionary_path = pkg_resources.resource_filename(
-                "symspellpy", "frequency_dictionary_en_82_765.txt"
-            )
-            # term_index is the column of the term and count_index is the
-            # column of the term frequency
-            self.sym_spell.load_dictionary(
-                self.dictionary_path, term_index=0, count_index=1
+                *DICTIONARIES[language]
             )
+            self._load_index(cache_dir)
         else:
             log.warning(f"No spell checking available for language '{language}'")
             self.sym_spell = None
 
+    def _index_path(self, cache_dir: str) -> str:
+        """
+        The pickled index only contains the dictionary data, not the SymSpell settings,
+        so they (and the dictionary file) are part of the file name.
+        """
+        stat = os.stat(self.dictionary_path)
+        key = hash_key(
+            self.dictionary_path,
+            stat.st_size,
+            stat.st_mtime,
+            pkg_resources.get_distribution("symspellpy").version,
+            self.max_dict_edit_distance,
+            self.prefix_length,
+            self.count_threshold,
+        )
+
+        return path.join(cache_dir, f"symspell_{self.language}_{key[:16]}.pickle")
+
+    def _load_index(self, cache_dir: str):
+        started = timer()
+        index_path = self._index_path(cache_dir) if cache_dir else None
+
+        if index_path and path.isfile(index_path):
+            try:
+                # uncompressed, as unzipping takes longer than reading the larger file
+                if self.sym_spell.load_pickle(index_path, compressed=False):
+                    self.index_source = "pickle"
+                    log.info(
+                        f"Loaded spell checking index for '{self.language}' from {index_path} in {round((timer() - started) * 1000)} ms"
+                    )
+                    return
+            except Exception as e:
+                log.warning(f"Can't load spell checking index {index_path}: {str(e)}")
+
+        # term_index is the column of the term and count_index is the
+        # column of the term frequency
+        self.sym_spell.load_dictionary(
+            self.dictionary_path, term_index=0, count_index=1
+        )
+        self.index_source = "dictionary"
+        log.info(
+            f"Built spell checking index for '{self.language}' in {round((timer() - started) * 1000)} ms"
+        )
+
+        if index_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # write to a temp file first, other processes may read the index at the same time
+                tmp_path = f"{index_path}.{os.getpid()}.tmp"
+                self.sym_spell.save_pickle(tmp_path, compressed=False)
+                os.replace(tmp_path, index_path)
+            except Exception as e:
+                log.warning(f"Can't save spell checking index {index_path}: {str(e)}")
+
     def suggestions(self, input_term):
         # No suggestions if no spell checker available
         if not self.sym_spell:
@@ -74,18 +170,73 @@ class Spellchecker(object):
         return suggestions
 
     def correct_word(self, input_term):
-        stripped = str(input_term).strip(string.punctuation)
+        corrected, _ = self.correct_words([input_term])
+        return corrected[0]
+
+    def correct_words(self, words: Iterable[str]) -> Tuple[List[str], dict]:
+        """
+        Corrects a batch of words (e.g. all words of an OCR page), each distinct word is looked up once.
+        Corrections are memoized, OCR text contains the same words over and over again.
+
+        Returns the corrected words and counts of distinct words:
+        how many were corrected, skipped (too short / not a word) or found in the memo
+        """
+        words = list(words)
+        unique = list(dict.fromkeys(words))
+        stats = {
+            "words": len(words),
+            "unique": len(unique),
+            "corrected": 0,
+            "skipped": 0,
+            "cached": 0,
+        }
 
+        corrections = {}
+        with self._memo_lock:
+            for word in unique:
+                corrected = self._memo.get(word)
+                if corrected is not None:
+                    self._memo.move_to_end(word)
+                    corrections[word] = corrected
+            stats["cached"] = len(corrections)
+            self.memo_hits += len(corrections)
+            self.memo_misses += len(unique) - len(corrections)
+
+        looked_up = {}
+        for word in unique:
+            if word in corrections:
+                continue
+            stripped = str(word).strip(string.punctuation)
+            if self._is_candidate(stripped):
+                looked_up[word] = self._correct_word(word, stripped)
+            else:
+                stats["skipped"] += 1
+                corrections[word] = word
+
+        if looked_up:
+            corrections.update(looked_up)
+            with self._memo_lock:
+                self._memo.update(looked_up)
+                while len(self._memo) > self.memo_size:
+                    self._memo.popitem(last=False)
+
+        stats["corrected"] = sum(
+            1 for word, corrected in corrections.items() if corrected != word
+        )
+
+        return [corrections[word] for word in words], stats
+
+    @staticmethod
+    def _is_candidate(stripped: str) -> bool:
         # Don't correct words shorter than 4 chars (too risky it might be a domain specific abbreviation )
         if len(stripped) < 4:
-            return input_term
+            return False
 
-        # if less alpha chars than alpha chars: ignore
-        if len(re.findall(r"[A-Za-z]", stripped)) <= len(
-            re.findall(r"[^A-Za-z]", stripped)
-        ):
-            return input_term
+        # if less alpha chars than non-alpha chars: ignore
+        alpha = len(RE_ALPHA.findall(stripped))
+        return alpha > len(stripped) - alpha
 
+    def _correct_word(self, input_term, stripped):
         suggestions = self.suggestions(stripped)
 
         # No suggestions? Leave it as is
@@ -99,3 +250,51 @@ class Spellchecker(object):
                 candidate += input_term[i]
 
         return candidate
+
+
+class SpellcheckerRegistry(object):
+    """
+    Process-wide Spellcheckers, one per language. Loaded on first use, or at startup (see preload()).
+
+    Env vars:
+        SPELLCHECK_PRELOAD      languages to load at startup, comma separated (default: "en")
+        SPELLCHECK_CACHE_DIR    where built indexes are persisted (default: "./.cache/spellcheck", empty: off)
+        SPELLCHECK_MEMO_SIZE    max. number of memoized corrections per language (default: 50000)
+    """
+
+    def __init__(self, preload: str = SPELLCHECK_PRELOAD):
+        self.preload_languages = [
+            language.strip() for language in preload.split(",") if language.strip()
+        ]
+        self._spellcheckers = {}
+        self._lock = threading.Lock()
+
+    def get(self, language: str = "en") -> Spellchecker:
+        spellchecker = self._spellcheckers.get(language)
+        if spellchecker is None:
+            # Concurrent requests wait for the first one to load the index, instead of loading it again
+            with self._lock:
+                spellchecker = self._spellcheckers.get(language)
+                if spellchecker is None:
+                    spellchecker = Spellchecker(language=language)
+                    self._spellcheckers[language] = spellchecker
+
+        return spellchecker
+
+    def preload(self, background: bool = True):
+        def load():
+            for language in self.preload_languages:
+                try:
+                    self.get(language)
+                except Exception as e:
+                    log.error(f"Can't preload spellchecker '{language}': {str(e)}")
+
+        if background:
+            threading.Thread(
+                target=load, name="spellcheck-preload", daemon=True
+            ).start()
+        else:
+            load()
+
+
+SpellcheckerRegistryInstance = SpellcheckerRegistry()
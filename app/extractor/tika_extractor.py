@@ -1,9 +1,8 @@
 import app
 from app.extractor.base import BaseExtractor
+from app.extractor.fetch import request_fetch
 from app.models import ExtractorRequest, ExtractorResponse
 import logging
-from urllib3.packages.six import BytesIO
-import requests
 
 # import parser and detector object from tika
 from tika import parser
@@ -27,20 +26,21 @@ class TikaExtractor(BaseExtractor):
 
     def extract(self, request: ExtractorRequest = None) -> ExtractorResponse:
         try:
-            # request options to the document url and the tika server where we send the bytes to
+            # request options to the tika server where we send the bytes to
             # see: https://requests.kennethreitz.org/en/master/api/#requests.request
             tika_req_options = {"timeout": 15}
-            document_req_options = {"timeout": 15, "allow_redirects": True}
 
-            if request.url:
-                resp = requests.get(request.url, **document_req_options)
-
-                buffer = BytesIO(resp.content)
-                parsed = parser.from_buffer(buffer, requestOptions=tika_req_options)
-            else:
-                parsed = parser.from_file(
-                    request.filename, requestOptions=tika_req_options
-                )
+            with request_fetch(request) as fetch:
+                if not fetch.is_spooled():
+                    # in-memory buffer, or a download that wasn't spooled: send the bytes as they are
+                    parsed = parser.from_buffer(
+                        fetch.content(), requestOptions=tika_req_options
+                    )
+                else:
+                    # local file, or a large download that went to disk
+                    parsed = parser.from_file(
+                        fetch.path(), requestOptions=tika_req_options
+                    )
 
             text = parsed["content"] or ""
             # merge parsed metadata with source info
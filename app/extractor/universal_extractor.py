@@ -5,8 +5,15 @@ from app.extractor.image_extractor import ImageExtractor
 from app.extractor.web_article_extractor import WebArticleExtractor
 from app.extractor.wikipedia_extractor import WikipediaExtractor
 from app.extractor.tika_extractor import TikaExtractor
-from app.extractor.base import BaseExtractor
+from app.extractor.base import (
+    BaseExtractor,
+    detect_content_type,
+    run_in_extractor_pool,
+)
+from app.extractor.fetch import FetchContext, request_fetch
+import asyncio
 import logging
+from typing import List, Optional
 
 log = logging.getLogger(__name__)
 
@@ -16,7 +23,14 @@ from app.models import ExtractorRequest, ExtractorResponse
 
 class UniversalExtractor(BaseExtractor):
     """
-    This extractor tries to delegate to specific extractors based on the file/content type discovered.
+    This extractor delegates to specific extractors based on the file/content type discovered.
+
+    The content type is resolved once per request (Wikipedia pages are recognized by their url, without that),
+    and ROUTES tells which extractors may handle it, most specific first.
+    Tika is the fallback in case no specialized extractor can handle the request, or in case something else goes wrong.
+
+    aextract() asks all the extractors of a route at once whether they can handle the request,
+    sync extractors run in the extractor thread pool (see BaseExtractor).
     """
 
     tika: BaseExtractor = TikaExtractor()
@@ -25,37 +39,90 @@ class UniversalExtractor(BaseExtractor):
     image_ocr: BaseExtractor = ImageExtractor()
     abbyy_ocr: BaseExtractor = AbbyyOcrExtractor()
 
+    # (part of the) content type -> extractors to try, in this order
+    ROUTES = [
+        ("html", ["web_article"]),
+        ("image", ["abbyy_ocr", "image_ocr"]),
+    ]
+
     def can_handle(self, request: ExtractorRequest) -> bool:
         return True  # we'll shoot with everything we can...
 
+    async def acan_handle(self, request: ExtractorRequest) -> bool:
+        return True
+
     @timed(save_to="meta")
     def extract(self, request: ExtractorRequest = None) -> ExtractorResponse:
+        # All extractors share the same fetch context: urls are downloaded (at most) once
+        with request_fetch(request) as fetch:
+            result = self._extract(request, fetch)
+
+        return self._with_fetch_meta(result, fetch)
+
+    @timed(save_to="meta")
+    async def aextract(self, request: ExtractorRequest = None) -> ExtractorResponse:
+        with request_fetch(request) as fetch:
+            result = await self._aextract(request, fetch)
+
+        return self._with_fetch_meta(result, fetch)
+
+    def _with_fetch_meta(
+        self, result: Optional[ExtractorResponse], fetch: FetchContext
+    ) -> Optional[ExtractorResponse]:
+        if result is not None and fetch.content_type:
+            result.meta = {
+                **(result.meta or {}),
+                "detected_content_type": fetch.content_type,
+                "content_type_detector": fetch.content_type_detector,
+            }
+        # Did the extractor get the document from memory or from disk?
+        if result is not None and fetch.input:
+            result.meta = {**(result.meta or {}), "input": fetch.input}
+
+        return result
+
+    def _candidates(
+        self, request: ExtractorRequest, fetch: FetchContext
+    ) -> List[BaseExtractor]:
+        """
+        The specialized extractors that may handle the request, most specific first.
+        Blocks: may have to download the first bytes of the document.
+        """
+        if self.wikipedia.can_handle(request):
+            return [self.wikipedia]
+
+        content_type = detect_content_type(
+            request.url or request.filename, fetch
+        ).lower()
+        for match, names in self.ROUTES:
+            if match in content_type:
+                return [getattr(self, name) for name in names]
+
+        return []
+
+    def _name(self, request: ExtractorRequest) -> str:
+        return request.url if request.url else request.filename
+
+    def _extract(
+        self, request: ExtractorRequest, fetch: FetchContext
+    ) -> ExtractorResponse:
         result = None
         fallback = False
 
         try:
-            # We should try the most specific extractors first.
-            #  Tika is fallback in case no specialized extractor can handle the request,
-            # or in case something else goes wrong.
-            if self.wikipedia.can_handle(request):
-                log.info(f"Extracting text via Wikipedia client: {request.url} ...")
-                result = self.wikipedia.extract(request)
-            elif self.web_article.can_handle(request):
-                log.info(f"Extracting text via newspaper3k client: {request.url} ...")
-                result = self.web_article.extract(request)
-            elif self.abbyy_ocr.can_handle(request):
-                log.info(f"Extracting text via Abbyy Cloud OCR...")
-                result = self.abbyy_ocr.extract(request)
-            elif self.image_ocr.can_handle(request):
+            extractor = next(
+                (e for e in self._candidates(request, fetch) if e.can_handle(request)),
+                None,
+            )
+            if extractor is not None:
                 log.info(
-                    f"Extracting text from image via Azure Computer Vision  : {request.url} ..."
+                    f"Extracting text via {type(extractor).__name__}: '{self._name(request)}' ..."
                 )
-                result = self.image_ocr.extract(request)
-
+                result = extractor.extract(request)
             else:
                 fallback = True
                 log.info(
-                    f"Extracting text via generic Apache Tika extractor: '{request.url if request.url else request.filename}' ..."
+                    f"Extracting text via generic Apache Tika extractor: '{self._name(request)}' ..."
                 )
                 result = self.tika.extract(request)
 
@@ -70,3 +137,41 @@ class UniversalExtractor(BaseExtractor):
                 log.error(f"Error using fallback Tika extractor: {str(e)}")
 
         return result
+
+    async def _aextract(
+        self, request: ExtractorRequest, fetch: FetchContext
+    ) -> ExtractorResponse:
+        result = None
+        fallback = False
+
+        try:
+            candidates = await run_in_extractor_pool(self._candidates, request, fetch)
+            handles = await asyncio.gather(
+                *[extractor.acan_handle(request) for extractor in candidates]
+            )
+            extractor = next(
+                (e for e, can_handle in zip(candidates, handles) if can_handle), None
+            )
+            if extractor is not None:
+                log.info(
+                    f"Extracting text via {type(extractor).__name__}: '{self._name(request)}' ..."
+                )
+                result = await extractor.aextract(request)
+            else:
+                fallback = True
+                log.info(
+                    f"Extracting text via generic Apache Tika extractor: '{self._name(request)}' ..."
+                )
+                result = await self.tika.aextract(request)
+
+        except Exception as e:
+            if not fallback:
+                log.warn(
+                    f"Error using specialized extractor, trying to fall back to tika: {str(e)}"
+                )
+                fallback = True
+                result = await self.tika.aextract(request)
+            else:
+                log.error(f"Error using fallback Tika extractor: {str(e)}")
+
+        return result
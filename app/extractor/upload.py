@@ -0,0 +1,301 @@
+import app
+import os
+import asyncio
+import logging
+import tempfile
+from typing import AsyncIterator
+from dotenv import load_dotenv, find_dotenv
+from multipart.multipart import MultipartParser, parse_options_header
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.extractor.fetch import FETCH_HEAD_BYTES, FetchContext
+from app.models import ExtractorRequest
+
+
+# Max. size of an uploaded file, larger uploads are rejected with "413 Payload Too Large"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 100 * 1024 * 1024))
+# Uploads are written to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Uploads up to this size are passed to the extractors in memory, they never touch the filesystem
+EXTRACT_IN_MEMORY_MAX_BYTES = int(os.getenv("EXTRACT_IN_MEMORY_MAX_BYTES", 1024 * 1024))
+# Slack for the multipart headers, boundaries and other form fields on top of UPLOAD_MAX_BYTES
+UPLOAD_FORM_SLACK_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """
+    Raised when an upload exceeds the max. size (UPLOAD_MAX_BYTES)
+    """
+
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Upload exceeds the max. size of {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+class InvalidUpload(Exception):
+    """
+    Raised when the request body is no multipart/form-data with the uploaded file
+    """
+
+    pass
+
+
+class MultipartFileParser(object):
+    """
+    Incremental multipart/form-data parser (python-multipart, the same parser Starlette uses),
+    that only keeps the data of the file part 'field'. Feed it the request body with write(),
+    take() returns the file data that arrived since the last call.
+    """
+
+    def __init__(self, content_type: str, field: str = "file"):
+        mime_type, params = parse_options_header(content_type)
+        if mime_type != b"multipart/form-data" or not params.get(b"boundary"):
+            raise InvalidUpload("Expected a multipart/form-data request body")
+
+        self.field = field
+        # set once the headers of the file part are parsed
+        self.filename: str = None
+        self.content_type: str = None
+        self.done = False
+
+        self._in_file = False
+        self._data = []
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._parser = MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+
+    @property
+    def pending(self) -> int:
+        return sum(len(data) for data in self._data)
+
+    def write(self, data: bytes):
+        self._parser.write(data)
+
+    def finalize(self):
+        self._parser.finalize()
+
+    def take(self) -> bytes:
+        data = b"".join(self._data)
+        self._data = []
+        return data
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(
+            self._headers.get(b"content-disposition", b"")
+        )
+        name = options.get(b"name", b"").decode("latin-1")
+        if name == self.field and b"filename" in options and not self.done:
+            self._in_file = True
+            self.filename = options[b"filename"].decode("latin-1")
+            self.content_type = self._headers.get(b"content-type", b"").decode(
+                "latin-1"
+            )
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self.done = True
+
+
+class SpooledUpload(object):
+    """
+    An uploaded file, parsed from the request body while it arrives (see from_stream) and
+    written to a temp file on disk in chunks of 'chunk_size' (in a worker thread, not on the event loop),
+    so we never hold the whole upload in memory, and never copy it to disk twice.
+    Stops reading the request as soon as the upload gets larger than 'max_bytes' (UploadTooLarge).
+    Small uploads (up to 'in_memory_max_bytes') are kept in memory instead, see 'buffer'.
+
+    The buffer or temp file is handed to the extractors as it is, with a FetchContext that already has
+    the first bytes for content type detection. The temp file is deleted on close().
+
+    Env vars:
+        UPLOAD_MAX_BYTES                max. size of an upload (default: 100 MB)
+        UPLOAD_CHUNK_SIZE               bytes written at a time (default: 1 MB)
+        EXTRACT_IN_MEMORY_MAX_BYTES     uploads up to this size stay in memory (default: 1 MB)
+    """
+
+    def __init__(
+        self,
+        filename: str = None,
+        content_type: str = None,
+        max_bytes: int = UPLOAD_MAX_BYTES,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+        in_memory_max_bytes: int = EXTRACT_IN_MEMORY_MAX_BYTES,
+    ):
+        self.filename = filename
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.in_memory_max_bytes = in_memory_max_bytes
+        self.size = 0
+
+        # the upload, if it's small enough to keep it in memory
+        self.buffer: bytes = None
+        self.fetch: FetchContext = None
+        self._chunks = []
+        self._head = b""
+        self._file = None
+
+    @property
+    def path(self) -> str:
+        """
+        The temp file (None if the upload is kept in memory)
+        """
+        return self._file.name if self._file is not None else None
+
+    def write(self, data: bytes):
+        """
+        Appends 'data' to the upload, in memory until it gets larger than 'in_memory_max_bytes',
+        then in the temp file. Blocking
+        """
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+
+        if self._file is None:
+            self._chunks.append(data)
+            if self.size <= self.in_memory_max_bytes:
+                return
+
+            # too large for memory, move what we have to a temp file
+            ext = os.path.splitext(self.filename or "")[1]
+            self._file = tempfile.NamedTemporaryFile(
+                prefix="jargonbuster_", suffix=ext, delete=False
+            )
+            data = b"".join(self._chunks)
+            self._chunks = None
+
+        if len(self._head) < FETCH_HEAD_BYTES:
+            self._head += data[: FETCH_HEAD_BYTES - len(self._head)]
+        self._file.write(data)
+
+    def finish(self):
+        """
+        All data is written, creates the FetchContext for the extractors
+        """
+        if self._file is None:
+            self.buffer = b"".join(self._chunks)
+            self._chunks = None
+            self.fetch = FetchContext(
+                filename=self.filename,
+                declared_content_type=self.content_type,
+                buffer=self.buffer,
+            )
+            return
+
+        self._file.flush()
+        self.fetch = FetchContext(
+            filename=self.path, declared_content_type=self.content_type, head=self._head
+        )
+        log.info(f"Spooled {self.size} bytes of uploaded file '{self.filename}'")
+
+    @classmethod
+    async def from_stream(
+        cls,
+        stream: AsyncIterator[bytes],
+        content_type: str,
+        field: str = "file",
+        max_bytes: int = UPLOAD_MAX_BYTES,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+        in_memory_max_bytes: int = EXTRACT_IN_MEMORY_MAX_BYTES,
+    ) -> "SpooledUpload":
+        """
+        Reads the file 'field' from a multipart/form-data request body ('stream', e.g. Starlette's
+        request.stream(), 'content_type' is the Content-Type header of the request).
+        The body is counted while it arrives, larger bodies than 'max_bytes' (plus some slack for the other
+        form fields) are rejected after reading at most that much, with or without a Content-Length.
+        """
+        parser = MultipartFileParser(content_type, field)
+        loop = asyncio.get_event_loop()
+        upload = None
+        received = 0
+
+        try:
+            async for data in stream:
+                received += len(data)
+                if received > max_bytes + UPLOAD_FORM_SLACK_BYTES:
+                    raise UploadTooLarge(max_bytes)
+
+                parser.write(data)
+                if upload is None and parser.filename is not None:
+                    upload = cls(
+                        parser.filename,
+                        parser.content_type,
+                        max_bytes,
+                        chunk_size,
+                        in_memory_max_bytes,
+                    )
+                if upload is not None and (
+                    parser.pending >= chunk_size or (parser.done and parser.pending)
+                ):
+                    await loop.run_in_executor(None, upload.write, parser.take())
+
+            parser.finalize()
+            if upload is None or not parser.done:
+                raise InvalidUpload(f"No file '{field}' in the request body")
+            if parser.pending:
+                await loop.run_in_executor(None, upload.write, parser.take())
+            await loop.run_in_executor(None, upload.finish)
+
+        except Exception:
+            if upload is not None:
+                upload.close()
+            raise
+
+        return upload
+
+    def extractor_request(self, meta: dict = None) -> ExtractorRequest:
+        request = ExtractorRequest(
+            filename=self.path or self.filename, meta=meta, buffer=self.buffer
+        )
+        # the extractors use our FetchContext, see request_fetch()
+        request._fetch = self.fetch
+        return request
+
+    def close(self):
+        if self.fetch is not None:
+            self.fetch.close()
+            self.fetch = None
+        if self._file is not None:
+            log.debug(f"deleting upload temp file: {self._file.name}")
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except OSError as e:
+                log.warning(f"Can't delete upload temp file: {str(e)}")
+            self._file = None
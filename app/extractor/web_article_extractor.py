@@ -1,5 +1,6 @@
 import app
 from app.extractor.base import BaseExtractor, detect_content_type
+from app.extractor.fetch import request_fetch
 
 import logging
 
@@ -23,12 +24,21 @@ class WebArticleExtractor(BaseExtractor):
 
     def can_handle(self, request: ExtractorRequest) -> bool:
         # we handle only html content types by URL
-        return request.url and "html" in detect_content_type(request.url)
+        if not request.url:
+            return False
+        with request_fetch(request) as fetch:
+            return "html" in detect_content_type(request.url, fetch)
 
     def extract(self, request: ExtractorRequest) -> ExtractorResponse:
         try:
             article = Article(request.url, keep_article_html=True, fetch_images=False)
-            article.download()
+            with request_fetch(request) as fetch:
+                # Use the body we (probably) already downloaded for content type detection.
+                # Like newspaper3k: decode if there's a declared charset, otherwise newspaper3k detects it
+                if "charset" in fetch.headers.get("content-type", "").lower():
+                    article.download(input_html=fetch.text())
+                else:
+                    article.download(input_html=fetch.content())
             article.parse()
             # article.nlp()
 
@@ -1,7 +1,8 @@
 import os
 import app
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 from spacy.language import Language
 from spacy.tokens import Doc
 
@@ -9,104 +10,200 @@ from spacy.tokens import Doc
 log = logging.getLogger(__name__)
 
 
+from app.cache import TieredCache, create_cache, hash_key
+from app.http_clients import HttpClientsInstance
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
+
+
+# Data limits of the service, see:
+# https://docs.microsoft.com/en-us/azure/cognitive-services/text-analytics/concepts/data-limits?tabs=version-3
+# Max. characters per document
+AZ_TA_FOR_HEALTH_MAX_CHARS = int(os.getenv("AZ_TA_FOR_HEALTH_MAX_CHARS", 5120))
+# Max. documents per request
+AZ_TA_FOR_HEALTH_MAX_DOCS = int(os.getenv("AZ_TA_FOR_HEALTH_MAX_DOCS", 10))
+# Max. requests in flight for one text
+AZ_TA_FOR_HEALTH_PARALLEL = int(os.getenv("AZ_TA_FOR_HEALTH_PARALLEL", 4))
+# Number of sentences repeated at the start of the next chunk, so entities at chunk borders keep their context
+AZ_TA_FOR_HEALTH_OVERLAP = int(os.getenv("AZ_TA_FOR_HEALTH_OVERLAP", 1))
+
+API_VERSION = "v3.2-preview.1"
+
+# Entities per chunk (text, language and API version), see HEALTH_ANALYZER_CACHE_* env vars.
+# Memory only by default: the entities are text of (patient) documents, so they only go to disk
+# if HEALTH_ANALYZER_CACHE_PATH is set.
+HealthCacheInstance = create_cache(
+    "health_analyzer",
+    "HEALTH_ANALYZER_CACHE",
+    maxsize=4096,
+    ttl=30 * 24 * 3600,
+    max_disk_entries=100000,
+)
+
+# result key -> entity category
+CATEGORIES = {
+    "diagnosis": "Diagnosis",
+    "symptoms": "SymptomOrSign",
+    "treatments": "TreatmentName",
+    "examinations": "ExaminationName",
+}
+
+
+def _last_whitespace(text: str, start: int, end: int) -> int:
+    return max(text.rfind(c, start, end) for c in " \n\t")
+
+
+def split_into_chunks(
+    text: str, sentences: List[Tuple[int, int]], max_chars: int, overlap: int = 0
+) -> List[Tuple[int, int]]:
+    """
+    Groups consecutive sentences ((start, end) char offsets in 'text') into chunks of at most 'max_chars' characters.
+    Sentences longer than that are split at whitespace (or, if there is none, hard at 'max_chars').
+    A chunk starts with the last 'overlap' sentences of the previous chunk, if they still fit.
+
+    Returns the (start, end) char offsets of the chunks
+    """
+    units = []
+    for start, end in sentences:
+        while end - start > max_chars:
+            cut = _last_whitespace(text, start + 1, start + max_chars)
+            if cut <= start:
+                cut = start + max_chars
+            units.append((start, cut))
+            start = cut
+        if end > start:
+            units.append((start, end))
+
+    chunks = []
+    i = 0
+    while i < len(units):
+        start = units[i][0]
+        j = i
+        while j + 1 < len(units) and units[j + 1][1] - start <= max_chars:
+            j += 1
+        chunks.append((start, units[j][1]))
+        if j + 1 == len(units):
+            break
+
+        # the next chunk has to make progress and fit its first new sentence
+        next_i = max(j + 1 - overlap, i + 1)
+        if units[j + 1][1] - units[next_i][0] > max_chars:
+            next_i = j + 1
+        i = next_i
+
+    return chunks
 
 
 class HealthAnalyzer(object):
     """
     Analyzes the document using Azure Text Analytics for health.
+    Long texts are split into chunks on sentence boundaries, which are sent in parallel requests.
+
+    Env vars:
+        AZ_TA_FOR_HEALTH_ENDPOINT   endpoint of the service
+        AZ_TA_FOR_HEALTH_MAX_CHARS  max. characters per document (chunk) (default: 5120)
+        AZ_TA_FOR_HEALTH_MAX_DOCS   max. documents per request (default: 10)
+        AZ_TA_FOR_HEALTH_PARALLEL   max. requests in flight per text (default: 4)
+        AZ_TA_FOR_HEALTH_OVERLAP    sentences repeated at the start of the next chunk (default: 1)
+        HEALTH_ANALYZER_CACHE_*     see app.cache.create_cache() (default: memory only, 4096 chunks, 30 days)
+
+    The entities of every chunk are cached (see HealthCacheInstance), only uncached chunks are sent.
+    Chunk cache hits/misses of a doc are in doc.user_data["health_analyzer_cache"].
     """
 
     nlp: Language = None
 
-    def __init__(self, nlp):
+    def __init__(
+        self,
+        nlp,
+        endpoint: str = None,
+        max_chars: int = AZ_TA_FOR_HEALTH_MAX_CHARS,
+        max_docs: int = AZ_TA_FOR_HEALTH_MAX_DOCS,
+        parallel: int = AZ_TA_FOR_HEALTH_PARALLEL,
+        overlap: int = AZ_TA_FOR_HEALTH_OVERLAP,
+        cache: TieredCache = HealthCacheInstance,
+    ):
         self.nlp = nlp
-        self._endpoint = os.getenv("AZ_TA_FOR_HEALTH_ENDPOINT")
+        self._endpoint = endpoint or os.getenv("AZ_TA_FOR_HEALTH_ENDPOINT")
+        self.max_chars = max_chars
+        self.max_docs = max_docs
+        self.parallel = parallel
+        self.overlap = overlap
+        self.cache = cache
 
     def __call__(self, doc: Doc):
-        if not doc.has_extension(STAGE.HEALTH_ANALYZER) and self._endpoint:
-            doc.set_extension(STAGE.HEALTH_ANALYZER, getter=self._analyze_health_text)
-        if not self._endpoint:
+        if self._endpoint:
+            stage_extension(doc, STAGE.HEALTH_ANALYZER, "_analyze_health_text")
+        else:
             log.warning(
                 "No endpoint for Azure Text Analytics for health, pls configure env vars ('AZ_TA_FOR_HEALTH_ENDPOINT' etc..)"
             )
 
         return doc
 
-    def _split_into_documents(
-        self, fulltext, language="en", max_doc_length=5120
-    ) -> dict:
+    def _split_into_chunks(self, doc: Doc) -> List[Tuple[int, int]]:
         """
-        Returns ```
-        {"documents":
-            [{"id":1, "language":"en", "text:"<textchunk-1>"},
-             {"id":2, "language":"en", "text:"<textchunk-2>"},
-              ...
-            ]
-        }```
+        Chunks on sentence boundaries (if the doc has sentences), see split_into_chunks()
         """
-        # Limit of text input StringInfo.LengthInTextElements < 5,120 character, so we might need to split into multiple documents
-        # https://docs.microsoft.com/en-us/azure/cognitive-services/text-analytics/concepts/data-limits?tabs=version-3
-
-        fulltext_chunks = [
-            fulltext[i : i + max_doc_length]
-            for i in range(0, len(fulltext), max_doc_length)
-        ]
-        # add the chunks as documents
-        documents = {
-            "documents": [
-                {"language": language, "id": str(i), "text": fulltext_chunks[i]}
-                for i in range(0, len(fulltext_chunks))
-            ]
-        }
-
-        return documents
-
-    #
-    #
-    def _entitiesByCategory(self, entities, categoryName, offset=0):
-        entities = list(filter(lambda d: d["category"] in [categoryName], entities))
-        if offset > 0 and len(entities) > 0:
-            # Adjust the "offset" of each entity w.r.t. multi-document offset
-            for d in entities:
-                d.update((k, v + offset) for k, v in d.items() if k == "offset")
-
-        return entities
-
-    def _collect_entities(self, docs, max_doc_length=5120):
-        diagnosis = []
-        symptoms = []
-        treatments = []
-        examinations = []
-
-        for i in range(0, len(docs)):
-            raw = docs[i]
-            offset = i * max_doc_length
-
-            # extract all important entity categories into their own collections
-            # adjust text offset (= position of the detected entity within the full text) based on document split
-            diagnosis += self._entitiesByCategory(raw["entities"], "Diagnosis", offset)
-            symptoms += self._entitiesByCategory(
-                raw["entities"], "SymptomOrSign", offset
-            )
-            treatments += self._entitiesByCategory(
-                raw["entities"], "TreatmentName", offset
-            )
-            examinations += self._entitiesByCategory(
-                raw["entities"], "ExaminationName", offset
-            )
+        text = str(doc.text)
+        if doc.is_sentenced:
+            sentences = [(sent.start_char, sent.end_char) for sent in doc.sents]
+        else:
+            sentences = [(0, len(text))]
+
+        return split_into_chunks(text, sentences, self.max_chars, self.overlap)
+
+    def _post(self, url: str, headers: dict, documents: List[dict]) -> List[dict]:
+        response = HttpClientsInstance.session.post(
+            url,
+            headers=headers,
+            # offsets in (python) characters, not in "text elements"
+            params={"stringIndexType": "UnicodeCodePoint"},
+            json={"documents": documents},
+        )
+        if not response.ok:
+            raise Exception(response.reason)
+
+        result = response.json()
+        for error in result.get("errors", []):
+            log.warning(f"Text Analytics for health failed on a chunk: {error}")
+
+        return result["documents"]
+
+    def _collect_entities(self, docs: List[dict], chunks: List[Tuple[int, int]]):
+        """
+        Collects the entities of all chunks by category, with offsets relative to the full text.
+        Entities in the overlap of two chunks are only collected once.
+        """
+        categories = {category: key for key, category in CATEGORIES.items()}
+        result = {key: [] for key in CATEGORIES}
+        seen = set()
+
+        for raw in sorted(docs, key=lambda d: int(d["id"])):
+            chunk_start = chunks[int(raw["id"])][0]
+            for entity in raw["entities"]:
+                key = categories.get(entity["category"])
+                if key is None:
+                    continue
+
+                offset = entity["offset"] + chunk_start
+                identity = (offset, entity["length"], entity["category"])
+                if identity in seen:
+                    continue
+                seen.add(identity)
+                result[key].append({**entity, "offset": offset})
+
+        for entities in result.values():
+            entities.sort(key=lambda e: e["offset"])
 
-        result = {
-            "diagnosis": diagnosis,
-            "symptoms": symptoms,
-            "treatments": treatments,
-            "examinations": examinations,
-        }
         return result
 
     def _analyze_health_text(self, doc: Doc):
         """
-        Getter method. Makes the API call and aggregates the response.
+        Getter method. Makes the API calls and aggregates the responses.
+
+        The text is split into chunks on sentence boundaries (see split_into_chunks()),
+        the chunks are sent in requests of up to 'max_docs' documents, with up to 'parallel' requests at the same time.
         """
 
         assert doc.has_extension(STAGE.HEALTH_ANALYZER)
@@ -117,18 +214,56 @@ class HealthAnalyzer(object):
             {}
         )  # FIXME authorization / API key. Right now this goes to a preview deployment
         # FIXME change to new Azure Web API
-        url = f"{self._endpoint}/text/analytics/v3.2-preview.1/entities/health"
+        url = f"{self._endpoint}/text/analytics/{API_VERSION}/entities/health"
         # TODO language
         language = "en"
         try:
-            documents = self._split_into_documents(str(doc.text), language)
-            response = requests.post(url, headers=headers, json=documents)
-            if response.ok:
-                docs = response.json()["documents"]
-                result = self._collect_entities(docs)
-                return result
+            text = str(doc.text)
+            chunks = self._split_into_chunks(doc)
+            keys = [
+                hash_key(API_VERSION, language, text[start:end])
+                for start, end in chunks
+            ]
+
+            # only send the chunks we didn't analyze before
+            docs = []
+            documents = []
+            for i, (start, end) in enumerate(chunks):
+                entities = self.cache.get(keys[i]) if self.cache else None
+                if entities is not None:
+                    docs.append({"id": str(i), "entities": entities})
+                else:
+                    documents.append(
+                        {"language": language, "id": str(i), "text": text[start:end]}
+                    )
+            doc.user_data["health_analyzer_cache"] = {
+                "chunks": len(chunks),
+                "hits": len(docs),
+                "misses": len(documents),
+            }
+
+            requests = [
+                documents[i : i + self.max_docs]
+                for i in range(0, len(documents), self.max_docs)
+            ]
+
+            if len(requests) > 1 and self.parallel > 1:
+                with ThreadPoolExecutor(
+                    max_workers=min(self.parallel, len(requests))
+                ) as pool:
+                    results = list(
+                        pool.map(lambda r: self._post(url, headers, r), requests)
+                    )
             else:
-                raise Exception(response.reason)
+                results = [self._post(url, headers, r) for r in requests]
+
+            for result in results:
+                for d in result:
+                    if self.cache:
+                        self.cache.set(keys[int(d["id"])], d["entities"])
+                    docs.append(d)
+
+            return self._collect_entities(docs, chunks)
 
         except Exception as e:
             raise Exception(e)
@@ -0,0 +1,200 @@
+import app
+import os
+import logging
+import threading
+from timeit import default_timer as timer
+from urllib.parse import urlparse
+from dotenv import load_dotenv, find_dotenv
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+# Number of hosts we keep a connection pool for (sync client)
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10))
+# Max. number of (keep-alive) connections per host
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 20))
+# Default timeouts in seconds, if a call doesn't set its own
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+
+
+class HttpMetrics(object):
+    """
+    Per-host request count, errors (exceptions and 5xx responses) and latency (time until the response headers)
+    """
+
+    def __init__(self):
+        # host -> [requests, errors, total ms, max ms]
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def record(self, host: str, elapsed_ms: float, error: bool = False):
+        with self._lock:
+            stats = self._hosts.setdefault(host, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += 1 if error else 0
+            stats[2] += elapsed_ms
+            stats[3] = max(stats[3], elapsed_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                host: {
+                    "requests": count,
+                    "errors": errors,
+                    "avg_ms": round(total_ms / count, 1),
+                    "max_ms": round(max_ms, 1),
+                }
+                for host, (count, errors, total_ms, max_ms) in self._hosts.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._hosts = {}
+
+
+class _MeteredSession(requests.Session):
+    def __init__(self, metrics: HttpMetrics, timeout: tuple):
+        super().__init__()
+        self._metrics = metrics
+        self._timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        host = urlparse(url).hostname
+        started = timer()
+        try:
+            response = super().request(method, url, **kwargs)
+        except Exception:
+            self._metrics.record(host, (timer() - started) * 1000, error=True)
+            raise
+
+        self._metrics.record(
+            host, (timer() - started) * 1000, error=response.status_code >= 500
+        )
+        return response
+
+
+class _MeteredAsyncClient(httpx.AsyncClient):
+    def __init__(self, metrics: HttpMetrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+
+    async def send(self, request, *args, **kwargs):
+        host = request.url.host
+        started = timer()
+        try:
+            response = await super().send(request, *args, **kwargs)
+        except Exception:
+            self._metrics.record(host, (timer() - started) * 1000, error=True)
+            raise
+
+        self._metrics.record(
+            host, (timer() - started) * 1000, error=response.status_code >= 500
+        )
+        return response
+
+
+class HttpClients(object):
+    """
+    Shared clients for all outbound HTTP calls (Azure services, ABBYY, dictionary, document downloads),
+    so connections are kept alive and reused instead of opening a new TCP/TLS connection per call:
+
+    - session        a requests.Session, for sync code (extractors, pipeline stages)
+    - async_client   a httpx.AsyncClient, for the API's event loop
+    - create_async_client() for other event loops (an async client can't be shared between loops)
+
+    All of them report into the same per-host metrics, see stats().
+    Started and closed with the app (see main.py), created on first use otherwise.
+    Note: tika-python does its own (unpooled) requests to the Tika server.
+
+    Env vars:
+        HTTP_POOL_CONNECTIONS   number of hosts with a connection pool (default: 10)
+        HTTP_POOL_MAXSIZE       max. connections per host (default: 20)
+        HTTP_TIMEOUT            default (read) timeout in seconds (default: 30)
+        HTTP_CONNECT_TIMEOUT    default connect timeout in seconds (default: 5)
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = HTTP_POOL_CONNECTIONS,
+        pool_maxsize: int = HTTP_POOL_MAXSIZE,
+        timeout: float = HTTP_TIMEOUT,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.metrics = HttpMetrics()
+
+        self._lock = threading.Lock()
+        self._session: requests.Session = None
+        # the session's pooled connections must not be shared with forked worker processes
+        self._session_pid: int = None
+        self._async_client: httpx.AsyncClient = None
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = _MeteredSession(
+                    self.metrics, (self.connect_timeout, self.timeout)
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = self.create_async_client()
+        return self._async_client
+
+    def create_async_client(self, **kwargs) -> httpx.AsyncClient:
+        """
+        A new (metered) async client with our pool settings, 'kwargs' are passed to httpx.AsyncClient
+        """
+        settings = {
+            "limits": httpx.Limits(
+                max_connections=self.pool_connections * self.pool_maxsize,
+                max_keepalive_connections=self.pool_maxsize,
+            ),
+            "timeout": httpx.Timeout(self.timeout, connect=self.connect_timeout),
+        }
+        return _MeteredAsyncClient(self.metrics, **{**settings, **kwargs})
+
+    def start(self):
+        log.info(
+            f"Starting shared HTTP clients, {self.pool_maxsize} connections per host"
+        )
+        self.session
+        self.async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def stats(self) -> dict:
+        return self.metrics.stats()
+
+
+HttpClientsInstance = HttpClients()
@@ -0,0 +1,166 @@
+import app
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+from dotenv import load_dotenv, find_dotenv
+
+import httpx
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.http_clients import HttpClientsInstance
+
+
+tenant_id = os.getenv("AZ_IMMERSIVE_READER_TENANT_ID")
+client_id = os.getenv("AZ_IMMERSIVE_READER_CLIENT_ID")
+client_secret = os.getenv("AZ_IMMERSIVE_READER_CLIENT_SECRET")
+
+# AAD auth endpoint
+AZ_IMMERSIVE_READER_TOKEN_URL = os.getenv(
+    "AZ_IMMERSIVE_READER_TOKEN_URL",
+    f"https://login.windows.net/{tenant_id}/oauth2/token",
+)
+# Tokens aren't handed out later than this many seconds before they expire
+AZ_IMMERSIVE_READER_TOKEN_EXPIRY_MARGIN = float(
+    os.getenv("AZ_IMMERSIVE_READER_TOKEN_EXPIRY_MARGIN", 60)
+)
+# The token is refreshed in the background this many seconds before it expires
+AZ_IMMERSIVE_READER_TOKEN_REFRESH_AHEAD = float(
+    os.getenv("AZ_IMMERSIVE_READER_TOKEN_REFRESH_AHEAD", 300)
+)
+
+RESOURCE = "https://cognitiveservices.azure.com/"
+
+
+class ImmersiveReaderToken(object):
+    """
+    The Azure AD token for the Immersive Reader, cached until shortly before it expires ('expires_on').
+    Concurrent callers share a single token request, and the token is refreshed in the background
+    ahead of its expiry, so callers (almost) always get it from memory.
+    Lives on the API's event loop.
+
+    Env vars:
+        AZ_IMMERSIVE_READER_TOKEN_URL             AAD token endpoint (default: login.windows.net of the tenant)
+        AZ_IMMERSIVE_READER_TOKEN_EXPIRY_MARGIN   seconds before expiry a token isn't handed out anymore (default: 60)
+        AZ_IMMERSIVE_READER_TOKEN_REFRESH_AHEAD   seconds before expiry the background refresh starts (default: 300)
+    """
+
+    def __init__(
+        self,
+        token_url: str = AZ_IMMERSIVE_READER_TOKEN_URL,
+        client_id: str = client_id,
+        client_secret: str = client_secret,
+        expiry_margin: float = AZ_IMMERSIVE_READER_TOKEN_EXPIRY_MARGIN,
+        refresh_ahead: float = AZ_IMMERSIVE_READER_TOKEN_REFRESH_AHEAD,
+        client: httpx.AsyncClient = None,
+    ):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self.client = client
+
+        self.token: Optional[str] = None
+        self.expires_on: float = 0
+        self.requests = 0
+
+        self._inflight: asyncio.Future = None
+        self._refresh_handle: asyncio.TimerHandle = None
+
+    def _is_valid(self) -> bool:
+        return self.token is not None and (
+            time.time() < self.expires_on - self.expiry_margin
+        )
+
+    async def get(self) -> str:
+        if self._is_valid():
+            return self.token
+        return await self._refresh()
+
+    async def _refresh(self) -> str:
+        # single-flight: everybody waits for the same request
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._request_token())
+        return await asyncio.shield(self._inflight)
+
+    async def _request_token(self) -> str:
+        try:
+            client = self.client or HttpClientsInstance.async_client
+            self.requests += 1
+            response = await client.post(
+                self.token_url,
+                data={
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                    "resource": RESOURCE,
+                    "grant_type": "client_credentials",
+                },
+                headers={"content-type": "application/x-www-form-urlencoded"},
+            )
+            token = response.json()
+            if "access_token" not in token:
+                raise ValueError(
+                    f"AAD Authentication error. Check your IR access credentials: {token.get('error_description', token)}"
+                )
+
+            if "expires_on" in token:
+                expires_on = float(token["expires_on"])
+            else:
+                expires_on = time.time() + float(token.get("expires_in", 3600))
+
+            self.token = token["access_token"]
+            self.expires_on = expires_on
+            self._schedule_refresh()
+            log.info(
+                f"Acquired Immersive Reader token, expires in {round(expires_on - time.time())}s"
+            )
+
+            return self.token
+        finally:
+            self._inflight = None
+
+    def _schedule_refresh(self, delay: float = None):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+
+        if delay is None:
+            lifetime = self.expires_on - time.time()
+            # short-lived tokens: refresh after half of their lifetime
+            delay = max(lifetime - self.refresh_ahead, lifetime / 2, 0)
+
+        loop = asyncio.get_event_loop()
+        self._refresh_handle = loop.call_later(delay, self._background_refresh)
+
+    def _background_refresh(self):
+        def done(future: asyncio.Future):
+            if future.exception():
+                if self.expires_on <= time.time():
+                    # the next caller requests a new token
+                    log.error(
+                        f"Can't refresh Immersive Reader token: {str(future.exception())}"
+                    )
+                    return
+                log.warning(
+                    f"Can't refresh Immersive Reader token, retrying: {str(future.exception())}"
+                )
+                # retry while the current token is still valid
+                self._schedule_refresh(
+                    max(min(30, (self.expires_on - time.time()) / 4), 1)
+                )
+
+        asyncio.ensure_future(self._refresh()).add_done_callback(done)
+
+    def close(self):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+
+
+ImmersiveReaderTokenInstance = ImmersiveReaderToken()
@@ -1,6 +1,8 @@
-from typing import List, Optional
+from datetime import datetime
+from typing import Any, List, Optional
 from fastapi.datastructures import UploadFile
 from pydantic.main import BaseModel
+from pydantic.fields import PrivateAttr
 from enum import Enum
 
 
@@ -16,11 +18,21 @@ class ExtractorRequest(BaseModel):
     extractor: Optional[str] = None
     config: Optional[dict] = None
 
+    # The document itself (bytes or memoryview), instead of a url or file.
+    # 'filename' is then just the name of the document, e.g. for its extension.
+    buffer: Optional[Any] = None
+
+    # FetchContext (see app.extractor.fetch), shared by all extractors that look at this request.
+    # A private attribute: it's no part of the request data (or the API schema), clients can't set it.
+    _fetch: Optional[Any] = PrivateAttr(default=None)
+
 
 class ExtractorResponse(BaseResponse):
     meta: Optional[dict] = None
     text: str = ""
     embedded_objects: Optional[List[dict]] = None
+    # Where the words of the text are on the page (OCR only), see ImageExtractor
+    layout: Optional[dict] = None
 
 
 class PipelineExecutionRequest(BaseModel):
@@ -43,16 +55,46 @@ class PipelineExecutionResponse(BaseModel):
     meta: Optional[dict] = {}
 
 
+class PipelineInfo(BaseModel):
+    """
+    A created (cached) pipeline, as listed by the PipelineFactory
+    """
+
+    name: str
+    pipeline_class: str
+    cache_key: str
+    settings: dict = {}
+    pipes: List[str] = []
+    hits: int = 0
+    memory_bytes: Optional[int] = None
+    load_time_ms: Optional[int] = None
+    created: Optional[datetime] = None
+
+
+class ReadinessResponse(BaseModel):
+    """
+    Readiness of the API: ready once all configured pipelines are warmed up.
+    'pipelines' has status, load and warm-up time per pipeline.
+    """
+
+    ready: bool
+    pipelines: dict = {}
+
+
 class ImmersiveReaderTokenResponse(BaseModel):
     token: str
     subdomain: str
 
 
-class DefinitionResponse(BaseModel):
+class DefinitionResponse(BaseResponse):
     term: str
     definitions: Optional[list]
 
 
+class DefinitionsRequest(BaseModel):
+    terms: List[str]
+
+
 # TAH = (Azure) Text Analytics for Health
 class TAHRequestDocument(BaseModel):
     language: Optional[str] = "en"
@@ -85,6 +127,7 @@ class PIPELINE_STAGES(object):
     MERGE_NOUN_CHUNKS = "merge_noun_chunks"
     MERGE_ENTITIES = "merge_entities"
     HEALTH_ANALYZER = "health_analyzer"
+    DEFINITIONS = "definitions"
     READABILITY = "readability"
     REPORT_COLLECTOR = "report_collector"
     STORY_GENERATOR = "story_generator"
@@ -2,21 +2,33 @@ from datetime import datetime
 import uuid
 from app.readability import ReadabilityCalculator
 import app
-from app.cleaner import Cleaner
+from app.cleaner import Cleaner, CleaningResult
 from app.summarizer import Summarizer
 from app.rouge_scorer import RougeScorer
 from app.story_generator import StoryGenerator
 from app.health_analyzer import HealthAnalyzer
+from app.definitions import DefinitionsPrefetcher
 
+import os
+import gc
+import copy
+import json
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import psutil
+import spacy
 from spacy.language import Language
+from spacy.tokens import Doc
 
 
 log = logging.getLogger(__name__)
 
-import textacy
-
-from app.models import PipelineExecutionResponse
+from app.models import PipelineExecutionResponse, PipelineInfo
 from app.models import PIPELINE_STAGES as STAGE
 
 # Sentencizer
@@ -26,7 +38,28 @@ from app.models import PIPELINE_STAGES as STAGE
 from app.report_collector import ReportCollector
 
 
-from app.utils import find_first, timed
+from app.utils import DOC_LANGUAGE, find_first, timed
+from app.cache import create_cache, hash_key
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+# Results of previous pipeline executions, see PIPELINE_RESULT_CACHE_* env vars
+ResultCacheInstance = create_cache("pipeline_results", "PIPELINE_RESULT_CACHE")
+
+
+def stage_names(value) -> List[str]:
+    """
+    A list of stage names from a setting: query params are strings ("cleaner,ner"), json bodies lists.
+    (spaCy checks 'name in disable', so a string would match substrings, e.g. "ner" in "cleaner")
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+
+    return [str(name).strip() for name in value if str(name).strip()]
 
 
 class AbstractPipeline(object):
@@ -39,16 +72,41 @@ class AbstractPipeline(object):
     name: str = ""
     settings: dict = {}
 
+    # Settings that change what create() builds, with their default values.
+    # Only these are passed on to the pipeline, and make up the pipeline cache key.
+    create_settings: dict = {}
+
+    nlp: Language = None
+
     def __init__(self, name: str, settings: dict = {}):
         self.name = name
         self.settings = settings
 
+    @classmethod
+    def normalize_settings(cls, settings: dict) -> dict:
+        return {
+            key: str(settings.get(key) or default)
+            for key, default in cls.create_settings.items()
+        }
+
     def create(self) -> Language:
         """
         Create the spaCy nlp pipeline.
         """
         raise NotImplementedError("Please implement this method in your subclass")
 
+    def pipe_names(self) -> List[str]:
+        return self.nlp.pipe_names if self.nlp else []
+
+    def dispose(self):
+        """
+        Releases the spaCy nlp pipeline. Called when the pipeline got evicted from the cache,
+        and no execution has it checked out anymore (see PipelineFactory.checkout).
+        """
+        # The Doc extensions of our stages are global and don't refer to this pipeline (see stage_extension),
+        # docs that are still in flight keep their own reference to the Language (doc.user_data[DOC_LANGUAGE])
+        self.nlp = None
+
     def execute(
         self, text: str, meta: dict = {}, settings: dict = {}
     ) -> PipelineExecutionResponse:
@@ -67,7 +125,7 @@ class DefaultSummarizerPipeline(AbstractPipeline):
 
     """
 
-    nlp = None
+    create_settings = {"language_model": "en_core_web_md"}
 
     @timed(save_to="timed", force=True)
     def create(self) -> Language:
@@ -79,9 +137,9 @@ class DefaultSummarizerPipeline(AbstractPipeline):
         )
 
         # This is an expensive / long running operation
-        self.nlp = textacy.load_spacy_lang(
-            name=language_model
-        )  # spacy.load(language_model)
+        # (Not using textacy.load_spacy_lang, as it caches and returns the very same Language object,
+        # which we modify below and want to be able to free again)
+        self.nlp = spacy.load(language_model)
 
         # shorthand
         nlp = self.nlp
@@ -100,7 +158,7 @@ class DefaultSummarizerPipeline(AbstractPipeline):
         # Our pipeline:
         # (see https://spacy.io/usage/processing-pipelines#pipelines for reference)
         #
-        #   cleaner -> Cleans the doc (actually, creates a new Doc, so do this first)
+        #   cleaner -> Cleans the text (the pipeline cleans before tokenization, see _clean)
         #   tagger -> Assign part-of-speech-tags (Token.pos_ etc.)
         #   sentencizer -> detect sentence boundaries
         #   (sentencizer_scoring -> tries to assess the quality of the sentence splitting by assigning penalities to things that do't look like real sentences)
@@ -112,6 +170,8 @@ class DefaultSummarizerPipeline(AbstractPipeline):
         #   entity_linker -> disambiguate a named entity in text to a unique knowledge base identifier
         #   summarizer -> do summarization of text
         #   rouge_scorer -> calcuate the ROUGE scores for the summary vs. original (cleaned) text
+        #   health_analyzer -> medical entities (Text Analytics for health)
+        #   definitions -> (optional) dictionary definitions of the entities
         #   readability -> calculate readability score
         #   results_collector -> collect all results into usable format for API
 
@@ -161,6 +221,11 @@ class DefaultSummarizerPipeline(AbstractPipeline):
         analyzer = HealthAnalyzer(nlp)
         nlp.add_pipe(analyzer, name=STAGE.HEALTH_ANALYZER)
 
+        # Look up the definitions of the (health) entities, within a time budget.
+        # Optional, see _disabled_pipes
+        definitions = DefinitionsPrefetcher(nlp)
+        nlp.add_pipe(definitions, name=STAGE.DEFINITIONS)
+
         #
         # calculate readability score
         # Our implementation is a wrapper around spacy_readability
@@ -197,65 +262,85 @@ class DefaultSummarizerPipeline(AbstractPipeline):
 
         return self.nlp
 
-    @timed(save_to="meta")
-    def execute(
-        self, text: str, meta: dict = {}, settings: dict = {}
-    ) -> PipelineExecutionResponse:
-        #
-        # run pipeline (expensive )
-        #
-        pipeline_started = datetime.now()
-
-        # reuse previously constructed pipeline / nlp
-        assert self.nlp is not None
-        nlp = self.nlp  # a bit shorter
-
-        # apply to input text. If we pass a "disable" list setting, disable those stages from the full pipeline.
-        # If we pass an "enable" list as part of the settings, ONLY those stages are executed
+    def _disabled_pipes(self, settings: dict) -> list:
+        """
+        If we pass a "disable" list setting, disable those stages from the full pipeline.
+        If we pass an "enable" list as part of the settings, ONLY those stages are executed
+        (as query params, both are comma separated strings, see stage_names())
+        The "definitions" stage only runs with "prefetch_definitions=true" (or if it is "enable"d)
+        """
         # FIXME turn these known settings keys into Pydantic model/enum/constants, aso available for
         # API docs
-        if settings.get("disable"):
-            disabled_pipes = settings["disable"]
-        elif settings.get("enable"):
+        disable = stage_names(settings.get("disable"))
+        enable = stage_names(settings.get("enable"))
+        if disable:
+            disabled_pipes = disable
+        elif enable:
             disabled_pipes = [
-                str(p) for p in nlp.pipe_names if not str(p) in settings.get("enable")
+                str(p) for p in self.nlp.pipe_names if str(p) not in enable
             ]
         else:
             disabled_pipes = []
 
-        log.info(f"Disabling pipes: {disabled_pipes}")
+        # Optional stages, only run when asked for (with their setting, or if "enable"d explicitly)
+        if (
+            STAGE.DEFINITIONS in self.nlp.pipe_names
+            and STAGE.DEFINITIONS not in disabled_pipes
+            and STAGE.DEFINITIONS not in enable
+            and str(settings.get("prefetch_definitions", False)).lower() != "true"
+        ):
+            disabled_pipes = [*disabled_pipes, STAGE.DEFINITIONS]
 
-        with nlp.disable_pipes(disabled_pipes):
-            ####
-            #
-            # Run the pipline !
-            #
-            ###
-            execution_id = uuid.uuid4().hex
-            doc = nlp(text)
-
-            # Add basic meta data to report here
-            report = {
-                "execution_id": execution_id,
-                "pipeline": nlp.pipe_names,
-                "pipeline_started": pipeline_started.strftime("%Y-%m-%d %H:%M:%S.%f"),
-            }
-
-            # Most of the interesting data comes from the report_collector.
-            # If you disable (or forgot to "enable") the report_collector in your pipeline execution request
-            # you'll only get some very basic meta data back!
-            if doc.has_extension(STAGE.REPORT_COLLECTOR):
-                report = doc._.get(STAGE.REPORT_COLLECTOR)
-
-            pipeline_finished = datetime.now()
-            report["pipeline_finished"] = pipeline_finished.strftime(
-                "%Y-%m-%d %H:%M:%S.%f"
-            )
-            report["pipeline_runtime_ms"] = pipeline_finished - pipeline_started
+        return disabled_pipes
 
+    def _create_report(self, doc: Doc, nlp: Language, disabled_pipes: list) -> dict:
+        """
+        Creates the report from an already processed Doc: the analysis results only,
+        the fields of the execution are added by _with_execution().
+        """
+        # The pipeline is shared between concurrent executions, so we don't disable pipes
+        # on the pipeline itself. Instead, we remember on the Doc which stages actually ran.
+        doc.user_data["pipeline"] = [
+            name for name in nlp.pipe_names if name not in disabled_pipes
+        ]
+        # the (lazy) stage results are computed by the stages of this very pipeline, see stage_extension
+        doc.user_data[DOC_LANGUAGE] = nlp
+
+        # Add basic meta data to report here
+        report = {"pipeline": doc.user_data["pipeline"]}
+
+        # Most of the interesting data comes from the report_collector.
+        # If you disable (or forgot to "enable") the report_collector in your pipeline execution request
+        # you'll only get some very basic meta data back!
+        if STAGE.REPORT_COLLECTOR in doc.user_data["pipeline"] and doc.has_extension(
+            STAGE.REPORT_COLLECTOR
+        ):
+            report = doc._.get(STAGE.REPORT_COLLECTOR)
+
+        return report
+
+    def _with_execution(self, report: dict, pipeline_started: datetime) -> dict:
+        """
+        Adds the fields of this very execution to the report (a new dict),
+        they are never part of a cached result.
+        """
+        pipeline_finished = datetime.now()
+
+        return {
+            **report,
+            "execution_id": uuid.uuid4().hex,
+            "pipeline_started": pipeline_started.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "pipeline_finished": pipeline_finished.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "pipeline_runtime_ms": pipeline_finished - pipeline_started,
+        }
+
+    def _create_response(
+        self, text: str, report: dict, meta: dict
+    ) -> PipelineExecutionResponse:
         # merge together: metadata as coming from the extractor + the report with transformed/aggregated values
         # TODO maybe make inclusion of meta data optional here (contains e.g. metadata from extractor)
-        result_metadata = {**(meta or {}), **report}
+        meta = meta or {}
+        result_metadata = {**meta, **report}
 
         # "Standardize" some key information, as extractors differ in the meta-data they provide.
         # We'll take the first matching key from a list of aliases, e.g. known extractor-specific fields that may arrive here.
@@ -290,16 +375,191 @@ class DefaultSummarizerPipeline(AbstractPipeline):
         )
 
         return PipelineExecutionResponse(
-            text=str(doc.text),
+            text=text,
             meta=result_metadata,
         )
 
+    def _clean(self, text: str, disabled_pipes: list) -> Optional[CleaningResult]:
+        """
+        Cleaning is a text transform before tokenization, so that the text is only tokenized once.
+        The "cleaner" stage then just passes the Doc through (see _component_cfg).
+        Returns None if the cleaner is disabled.
+        """
+        if STAGE.CLEANER in disabled_pipes:
+            return None
 
-class PipelineFactory(object):
+        return self.nlp.get_pipe(STAGE.CLEANER).clean(text)
+
+    def _component_cfg(self, disabled_pipes: list) -> dict:
+        if STAGE.CLEANER in disabled_pipes:
+            return {}
+
+        return {STAGE.CLEANER: {"pre_cleaned": True}}
+
+    def _result_cache_key(self, text: str, disabled_pipes: list) -> str:
+        """
+        Content address of an execution result: the (already cleaned) input text, the pipeline (with its settings),
+        the stages that run and the version of the language model.
+        """
+        enabled_pipes = [p for p in self.nlp.pipe_names if p not in disabled_pipes]
+        model = self.nlp.meta
+        model_version = f"{model.get('lang')}_{model.get('name')}-{model.get('version')}/spacy-{spacy.__version__}"
+
+        return hash_key(
+            text,
+            type(self).__name__,
+            json.dumps(self.settings, sort_keys=True),
+            ",".join(enabled_pipes),
+            model_version,
+        )
 
-    # caching already created pipelines
-    # keys are a hash of class names and serialization of settings object
-    pipeline_cache = {}
+    @timed(save_to="meta")
+    def execute(
+        self, text: str, meta: dict = {}, settings: dict = {}
+    ) -> PipelineExecutionResponse:
+        #
+        # run pipeline (expensive )
+        #
+        pipeline_started = datetime.now()
+
+        # reuse previously constructed pipeline / nlp
+        assert self.nlp is not None
+        nlp = self.nlp  # a bit shorter
+
+        # apply to input text.
+        disabled_pipes = self._disabled_pipes(settings)
+        log.info(f"Disabling pipes: {disabled_pipes}")
+
+        cleaning = self._clean(text, disabled_pipes)
+        if cleaning is not None:
+            text = cleaning.text
+
+        # Did we already analyze the very same document?
+        # Use setting "result_cache=false" to skip the cache (and re-analyze the document)
+        use_cache = str(settings.get("result_cache", True)).lower() != "false"
+        cache_key = self._result_cache_key(text, disabled_pipes)
+        cached = ResultCacheInstance.get(cache_key) if use_cache else None
+
+        if cached:
+            log.info(f"Result cache hit: {cache_key}")
+            result_text, report = copy.deepcopy(cached)
+            report = {
+                **self._with_execution(report, pipeline_started),
+                "result_cache": "hit",
+            }
+        else:
+            ####
+            #
+            # Run the pipline !
+            #
+            ###
+            doc = nlp(
+                text,
+                disable=disabled_pipes,
+                component_cfg=self._component_cfg(disabled_pipes),
+            )
+            if cleaning is not None:
+                doc.user_data["cleaning"] = cleaning
+
+            result_text = str(doc.text)
+            report = self._create_report(doc, nlp, disabled_pipes)
+            if use_cache:
+                ResultCacheInstance.set(cache_key, (result_text, report))
+            report = {
+                **self._with_execution(report, pipeline_started),
+                "result_cache": "miss",
+            }
+
+        report["result_cache_key"] = cache_key
+
+        return self._create_response(result_text, report, meta)
+
+    def execute_batch(
+        self,
+        items: Iterable[Tuple[str, dict]],
+        settings: dict = {},
+        batch_size: int = 32,
+        n_process: int = 1,
+    ) -> Iterator[PipelineExecutionResponse]:
+        """
+        Executes the pipeline on many (text, meta) tuples, using spaCy's batched Language.pipe.
+        Yields one response per input, in input order, as soon as it's done.
+        The same settings apply to all items of the batch.
+        """
+        assert self.nlp is not None
+        nlp = self.nlp
+
+        disabled_pipes = self._disabled_pipes(settings)
+        log.info(
+            f"Batch execution with batch_size={batch_size}, n_process={n_process}. Disabling pipes: {disabled_pipes}"
+        )
+
+        if n_process > 1:
+            # Docs are processed in child processes and come back serialized.
+            # Our stages register their Doc extensions when they first run, so make
+            # sure that also happened in this process (the getters are lazy, so this is cheap).
+            nlp("", disable=disabled_pipes)
+
+        def cleaned_items():
+            # the CleaningResult is part of the context, so it stays in this process
+            for text, meta in items:
+                cleaning = self._clean(text, disabled_pipes)
+                if cleaning is not None:
+                    text = cleaning.text
+                yield text, (meta, cleaning)
+
+        docs = nlp.pipe(
+            cleaned_items(),
+            as_tuples=True,
+            batch_size=batch_size,
+            n_process=n_process,
+            disable=disabled_pipes,
+            component_cfg=self._component_cfg(disabled_pipes),
+        )
+
+        pipeline_started = datetime.now()
+        for doc, (meta, cleaning) in docs:
+            if cleaning is not None:
+                doc.user_data["cleaning"] = cleaning
+            report = self._with_execution(
+                self._create_report(doc, nlp, disabled_pipes), pipeline_started
+            )
+            yield self._create_response(str(doc.text), report, meta)
+            pipeline_started = datetime.now()
+
+
+class PipelineCacheEntry(object):
+    """
+    A created pipeline in the PipelineFactory cache, plus some stats about it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        pipeline: AbstractPipeline,
+        memory_bytes: int,
+        load_time_ms: int,
+    ):
+        self.name = name
+        self.pipeline = pipeline
+        self.memory_bytes = memory_bytes
+        self.load_time_ms = load_time_ms
+        self.created = datetime.now()
+        self.hits = 0
+        # number of executions that currently use the pipeline (see PipelineFactory.checkout)
+        self.checkouts = 0
+        # evicted from the cache while checked out, disposed on the last release
+        self.evicted = False
+
+
+class PipelineFactory(object):
+    """
+    Creates pipelines and keeps the most recently used ones around.
+    Executions should use checkout(): a pipeline that gets evicted while it's checked out
+    is only disposed once the last execution released it.
+    Configured via env vars:
+        PIPELINE_CACHE_SIZE     max. number of created pipelines (e.g. loaded spaCy models) per process (default: 2)
+    """
 
     #
     # define some aliases, so that we can use shorter names for buildin Pipeline classes
@@ -308,8 +568,21 @@ class PipelineFactory(object):
         "quick": "DefaultSummarizerPipeline",
     }
 
-    @timed()
-    def create(self, name: str = "default", settings: dict = {}) -> AbstractPipeline:
+    def __init__(self, max_pipelines: int = None):
+        self.max_pipelines = max_pipelines or int(os.getenv("PIPELINE_CACHE_SIZE", 2))
+
+        # caching already created pipelines, least recently used first.
+        # keys are class names and serialization of the (normalized) settings object
+        self.pipeline_cache: "OrderedDict[str, PipelineCacheEntry]" = OrderedDict()
+
+        # called with the PipelineCacheEntry, before an evicted pipeline gets disposed
+        self.eviction_hooks: List[Callable[[PipelineCacheEntry], None]] = []
+
+        self._lock = threading.RLock()
+        # creating pipelines one at a time, as memory usage is measured per created pipeline
+        self._create_lock = threading.Lock()
+
+    def _resolve(self, name: str) -> Tuple[str, type]:
         # lookup class name in shortnames or use as-is
         targetClass = name if not name in self.aliases else self.aliases[name]
 
@@ -319,17 +592,133 @@ class PipelineFactory(object):
             raise Exception(f"Pipeline class not found: {name}")
         assert issubclass(pipelineClass, AbstractPipeline)
 
-        pipeline = None
-        cache_key = targetClass  # hash(name + json.dumps(settings, sort_keys=True))
+        return targetClass, pipelineClass
 
-        if cache_key in self.pipeline_cache:
-            pipeline = self.pipeline_cache[cache_key]
-        else:
-            pipeline = pipelineClass(type, settings or {})
+    def cache_key(self, name: str = "default", settings: dict = {}) -> str:
+        targetClass, pipelineClass = self._resolve(name)
+        normalized = pipelineClass.normalize_settings(settings or {})
+
+        return targetClass + json.dumps(normalized, sort_keys=True)
+
+    @timed()
+    def create(self, name: str = "default", settings: dict = {}) -> AbstractPipeline:
+        return self._entry(name, settings)[1].pipeline
+
+    @contextmanager
+    def checkout(
+        self, name: str = "default", settings: dict = {}
+    ) -> Iterator[AbstractPipeline]:
+        """
+        Creates (or gets) the pipeline for an execution. It isn't disposed while it's checked out,
+        even if it gets evicted from the cache in the meantime.
+        """
+        cache_key, entry = self._entry(name, settings, checkout=True)
+        try:
+            yield entry.pipeline
+        finally:
+            with self._lock:
+                entry.checkouts -= 1
+                dispose = entry.evicted and entry.checkouts == 0
+            if dispose:
+                self._dispose(cache_key, entry)
+
+    def _entry(
+        self, name: str, settings: dict, checkout: bool = False
+    ) -> Tuple[str, PipelineCacheEntry]:
+        targetClass, pipelineClass = self._resolve(name)
+
+        # Only settings that change the created pipeline are part of the key,
+        # e.g. "enable"/"disable" are applied when executing the pipeline
+        normalized = pipelineClass.normalize_settings(settings or {})
+        cache_key = targetClass + json.dumps(normalized, sort_keys=True)
+
+        entry = self._get(cache_key, checkout)
+        if entry:
+            return cache_key, entry
+
+        with self._create_lock:
+            # might have been created while we were waiting
+            entry = self._get(cache_key, checkout)
+            if entry:
+                return cache_key, entry
+
+            rss_before = psutil.Process().memory_info().rss
+            started = timer()
+
+            pipeline = pipelineClass(name, normalized)
             pipeline.create()  # this takes a while !
-            self.pipeline_cache[cache_key] = pipeline
 
-        return pipeline
+            entry = PipelineCacheEntry(
+                name=name,
+                pipeline=pipeline,
+                memory_bytes=max(0, psutil.Process().memory_info().rss - rss_before),
+                load_time_ms=round((timer() - started) * 1000),
+            )
+            log.info(
+                f"Created pipeline '{cache_key}' in {entry.load_time_ms}ms, using ~{entry.memory_bytes // 2**20} MB"
+            )
+
+            with self._lock:
+                if checkout:
+                    entry.checkouts += 1
+                self.pipeline_cache[cache_key] = entry
+                evicted = []
+                while len(self.pipeline_cache) > self.max_pipelines:
+                    key, evicted_entry = self.pipeline_cache.popitem(last=False)
+                    # checked out ones are disposed on their last release
+                    evicted_entry.evicted = True
+                    if evicted_entry.checkouts == 0:
+                        evicted.append((key, evicted_entry))
+
+        for key, evicted_entry in evicted:
+            self._dispose(key, evicted_entry)
+
+        return cache_key, entry
+
+    def _get(
+        self, cache_key: str, checkout: bool = False
+    ) -> Optional[PipelineCacheEntry]:
+        with self._lock:
+            entry = self.pipeline_cache.get(cache_key)
+            if entry:
+                entry.hits += 1
+                if checkout:
+                    entry.checkouts += 1
+                self.pipeline_cache.move_to_end(cache_key)
+            return entry
+
+    def _dispose(self, cache_key: str, entry: PipelineCacheEntry):
+        log.info(f"Evicting pipeline '{cache_key}' from cache")
+        for hook in self.eviction_hooks:
+            try:
+                hook(entry)
+            except Exception as e:
+                log.error(f"Error in pipeline eviction hook: {str(e)}")
+
+        # Only called once no execution has the pipeline checked out (anymore)
+        entry.pipeline.dispose()
+        entry.pipeline = None
+        gc.collect()
+
+    def info(self) -> List[PipelineInfo]:
+        """
+        Lists the currently created (cached) pipelines of this process
+        """
+        with self._lock:
+            return [
+                PipelineInfo(
+                    name=entry.name,
+                    pipeline_class=type(entry.pipeline).__name__,
+                    cache_key=key,
+                    settings=entry.pipeline.settings,
+                    pipes=entry.pipeline.pipe_names(),
+                    hits=entry.hits,
+                    memory_bytes=entry.memory_bytes,
+                    load_time_ms=entry.load_time_ms,
+                    created=entry.created,
+                )
+                for key, entry in self.pipeline_cache.items()
+            ]
 
 
-PipelineFactoryInstance = PipelineFactory()
\ No newline at end of file
+PipelineFactoryInstance = PipelineFactory()
@@ -1,6 +1,6 @@
-from os import read
 import app
 import logging
+from typing import Optional
 from spacy.language import Language
 from spacy.tokens import Doc
 from spacy_readability import Readability
@@ -9,50 +9,74 @@ log = logging.getLogger(__name__)
 
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
 
 
 class ReadabilityCalculator(object):
     """
-    Calculates readability metrics for both full text and summary (if present)
+    Calculates readability metrics for both full text and summary (if present).
+    This stage is shared by concurrent pipeline executions, so all per-document state lives on the Doc.
+
+    Note: spacy_readability returns a SMOG score of 0 for texts with less than 30 sentences,
+    which usually is the case for the summary.
     """
 
     nlp: Language = None
-    summary_doc: Doc = None
 
     def __init__(self, nlp):
         self.nlp = nlp
+        # both are stateless, so we can share them between documents
+        self.readability = Readability()
+        self.sentencizer = nlp.create_pipe(STAGE.SENTENCIZER)
 
     def __call__(self, doc: Doc):
-        if not doc.has_extension(STAGE.READABILITY):
-            doc.set_extension(STAGE.READABILITY, getter=self._calculate_readability)
+        stage_extension(doc, STAGE.READABILITY, "_calculate_readability")
 
-        if doc.has_extension(STAGE.SUMMARIZER):
-            # If the summarizer ran, we also calculate scores for the summary (not just fulltext)
-            # spacy_readability needs a "Doc" object
-            summary_sents = [str(s) for s in doc._.summarizer]
+        return doc
 
-            summary_text = "\n".join([str(s) for s in summary_sents])
+    def _create_summary_doc(self, doc: Doc) -> Optional[Doc]:
+        """
+        spacy_readability needs a "Doc" object (with sentence boundaries) for the summary.
+        Only created when the readability scores are actually needed.
+        """
+        if not doc.has_extension(STAGE.SUMMARIZER):
+            return None
 
-            # FIXME Sentencizer is needed by spacy_readability, but this here does not seem to work.
-            # SMOG scores currently DON'T work !
-            self.summary_doc = self.nlp.make_doc(summary_text)
-            self.summary_doc = self.nlp.create_pipe("sentencizer")(self.summary_doc)
+        summary_sents = [str(s).strip() for s in doc._.summarizer]
+        summary_sents = [s for s in summary_sents if s]
+        if not summary_sents:
+            return None
 
-            # FIXME we could use the correct sentence boundaries to mark token.is_sent_start instead ?
+        summary_doc = self.nlp.make_doc(" ".join(summary_sents))
+        summary_doc = self.sentencizer(summary_doc)
 
-        return doc
+        # Every summary sentence starts a new sentence, even if the sentencizer doesn't think so
+        # (e.g. a sentence without final punctuation)
+        sentence_starts = set()
+        offset = 0
+        for sentence in summary_sents:
+            sentence_starts.add(offset)
+            offset += len(sentence) + 1
+        for token in summary_doc:
+            if token.idx in sentence_starts:
+                token.is_sent_start = True
+
+        return summary_doc
 
     def _calculate_readability(self, doc: Doc):
         """
         Call the readability score functions
         """
         assert doc.has_extension(STAGE.READABILITY)
-        readability = Readability()
+        readability = self.readability
         scores = {"summary": {}, "text": {}}
         scores["text"]["dale_chall"] = readability.dale_chall(doc)
         scores["text"]["smog"] = readability.smog(doc)
-        if self.summary_doc:
-            scores["summary"]["dale_chall"] = readability.dale_chall(self.summary_doc)
-            scores["summary"]["smog"] = readability.smog(self.summary_doc)
+
+        # If the summarizer ran, we also calculate scores for the summary (not just fulltext)
+        summary_doc = self._create_summary_doc(doc)
+        if summary_doc is not None:
+            scores["summary"]["dale_chall"] = readability.dale_chall(summary_doc)
+            scores["summary"]["smog"] = readability.smog(summary_doc)
 
         return scores
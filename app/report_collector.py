@@ -1,13 +1,56 @@
 import app
 import logging
-from typing import Counter
+from collections import Counter
+
+import numpy as np
+from spacy.attrs import IS_PUNCT, IS_STOP, ORTH, POS
 from spacy.language import Language
+from spacy.symbols import NOUN
+from spacy.tokens import Doc
 
 
 log = logging.getLogger(__name__)
 
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
+
+
+# Named entity labels we report separately
+ENTITY_LABELS = [
+    "ORG",
+    "PERSON",
+    "GPE",
+    "WORK_OF_ART",
+    "PRODUCT",
+    "EVENT",
+    "FAC",
+    "NORP",
+]
+
+
+def _raw_span(doc: Doc, start: int, end: int) -> tuple:
+    """
+    Maps a character span of the (cleaned) doc text back to the raw input text
+    """
+    cleaning = doc.user_data.get("cleaning")
+    if cleaning is None:
+        return start, end
+
+    return cleaning.raw_span(start, end)
+
+
+def _most_common(hashes: np.ndarray, strings, n: int = 5) -> list:
+    """
+    Same as Counter(<texts>).most_common(n), for an array of string hashes:
+    ordered by count, ties in order of first occurrence.
+    """
+    values, first_index, counts = np.unique(
+        hashes, return_index=True, return_counts=True
+    )
+    order = np.lexsort((first_index, -counts))[:n]
+
+    return [(strings[int(values[i])], int(counts[i])) for i in order]
 
 
 class ReportCollector(object):
@@ -22,80 +65,112 @@ class ReportCollector(object):
         self.nlp = nlp
 
     def __call__(self, doc):
-        if not doc.has_extension(STAGE.REPORT_COLLECTOR):
-            doc.set_extension(STAGE.REPORT_COLLECTOR, getter=self._collect)
+        stage_extension(doc, STAGE.REPORT_COLLECTOR, "_collect")
 
         return doc
 
+    def _token_stats(self, doc: Doc) -> dict:
+        """
+        Counts all tokens, words and nouns in one sweep over the doc's token attribute array.
+        Words are tokens that aren't stop words or punctuation, nouns are words with POS "NOUN".
+        Tokens are counted by their ORTH hash, we only look up the strings of the most common ones.
+        """
+        attrs = doc.to_array([ORTH, IS_STOP, IS_PUNCT, POS])
+        orth = attrs[:, 0]
+        is_word = (attrs[:, 1] == 0) & (attrs[:, 2] == 0)
+        is_noun = is_word & (attrs[:, 3] == NOUN)
+
+        stats = {
+            "num_token": len(doc),
+            "num_words": int(is_word.sum()),
+            # counting, without creating all the sentence Spans' texts
+            "num_sentences": sum(1 for _ in doc.sents) if doc.is_sentenced else 0,
+        }
+
+        # Noun chunks (done by parser w. statistical model)
+        if doc.is_parsed:
+            noun_chunks = [chunk.text for chunk in doc.noun_chunks]
+            stats["noun_chunks"] = noun_chunks
+            stats["num_noun_chunks"] = len(noun_chunks)
+            stats["common_noun_chunks"] = Counter(noun_chunks).most_common(5)
+
+        # five most common word tokens
+        stats["common_words"] = _most_common(orth[is_word], doc.vocab.strings)
+        # five most common noun (chunk) tokens
+        stats["common_nouns"] = _most_common(orth[is_noun], doc.vocab.strings)
+
+        return stats
+
+    def _entity_stats(self, doc: Doc) -> dict:
+        """
+        Sorts all named entities into their label buckets, in one pass
+        """
+        entities = set()
+        offsets = []
+        by_label = {label: [] for label in ENTITY_LABELS}
+        for entity in doc.ents:
+            text, label = entity.text, entity.label_
+            entities.add((text, label))
+            if label in by_label:
+                by_label[label].append(text)
+
+            raw_start, raw_end = _raw_span(doc, entity.start_char, entity.end_char)
+            offsets.append(
+                {
+                    "text": text,
+                    "label": label,
+                    "start": entity.start_char,
+                    "end": entity.end_char,
+                    "raw_start": raw_start,
+                    "raw_end": raw_end,
+                }
+            )
+
+        # "start"/"end" are offsets into the (cleaned) result text, "raw_start"/"raw_end" into the input text
+        stats = {"named_entities": sorted(entities), "named_entity_offsets": offsets}
+        for label, texts in by_label.items():
+            stats[label] = sorted(set(texts))
+            stats["common_" + label] = Counter(texts).most_common(5)
+
+        return stats
+
+    def _with_raw_offsets(self, doc: Doc, health_entities: dict) -> dict:
+        """
+        Adds "raw_offset"/"raw_length" (offsets into the input text) to the health entities.
+        Copies the entities, the stage result itself stays as it is.
+        """
+        result = {}
+        for category, entities in health_entities.items():
+            result[category] = []
+            for entity in entities:
+                entity = dict(entity)
+                if "offset" in entity and "length" in entity:
+                    raw_start, raw_end = _raw_span(
+                        doc, entity["offset"], entity["offset"] + entity["length"]
+                    )
+                    entity["raw_offset"] = raw_start
+                    entity["raw_length"] = raw_end - raw_start
+                result[category].append(entity)
+
+        return result
+
     def _collect(self, doc):
         assert doc.has_extension(STAGE.REPORT_COLLECTOR)
 
-        # get pipeline steps/ registered extensions
-        pipeline_names = self.nlp.pipe_names
+        # get pipeline steps/ registered extensions (the stages that actually ran on this doc)
+        pipeline_names = doc.user_data.get("pipeline", self.nlp.pipe_names)
         log.info(f"Collecting results from pipeline: {str(pipeline_names)}")
 
         # create the result object we'll append props to
         result = {"pipeline": pipeline_names}
 
-        # Full (input) text and sentences
-        if doc.is_sentenced:
-            sentences = [sentence.text for sentence in doc.sents]
-        else:
-            sentences = []
-
-        # all tokens that arent stop words or punctuations
-        words = [
-            token.text for token in doc if not token.is_stop and not token.is_punct
-        ]
-        # noun (or noun chunk!) tokens that arent stop words or punctuations
-        nouns = [
-            token.text
-            for token in doc
-            if not token.is_stop and not token.is_punct and token.pos_ == "NOUN"
-        ]
-        # Noun chunks (done by parser w. statistical model)
-        if doc.is_parsed:
-            result["noun_chunks"] = [token.text for token in doc.noun_chunks]
-            result["num_noun_chunks"] = len(result["noun_chunks"])
-            result["common_noun_chunks"] = Counter(result["noun_chunks"]).most_common(5)
-
-        # merge into result...
-        result = {
-            **{
-                "num_token": len(doc),
-                "num_words": len(words),
-                "num_sentences": len(sentences),
-            },
-            **result,
-        }
-
-        # five most common word tokens
-        result["common_words"] = Counter(words).most_common(5)
-        # five most common noun (chunk) tokens
-        result["common_nouns"] = Counter(nouns).most_common(5)
+        # Token, sentence and noun chunk statistics, in a single pass
+        result = {**self._token_stats(doc), **result}
 
         # NER: List of named entities, if "ner" pipe ran
         # see https://spacy.io/api/annotation#named-entities
         if doc.is_nered:
-            entities = sorted(
-                set([(entity.text, entity.label_) for entity in doc.ents])
-            )
-            result["named_entities"] = entities
-            for label in [
-                "ORG",
-                "PERSON",
-                "GPE",
-                "WORK_OF_ART",
-                "PRODUCT",
-                "EVENT",
-                "FAC",
-                "NORP",
-            ]:
-                filtered_entities = [
-                    entity.text for entity in doc.ents if entity.label_ == label
-                ]
-                result[label] = sorted(set(filtered_entities))
-                result["common_" + label] = Counter(filtered_entities).most_common(5)
+            result.update(self._entity_stats(doc))
 
         # get the summary text, if "summarizer" pipe ran
         if doc.has_extension(STAGE.SUMMARIZER):
@@ -121,10 +196,21 @@ class ReportCollector(object):
                 "rougeL": float(d["rougeL"].recall),
             }
 
-        # Add the results from Azure Text Analytics fro Health
-        if doc.has_extension(STAGE.HEALTH_ANALYZER):
+        # Add the results from Azure Text Analytics fro Health (the extension is global, so only if the stage ran)
+        if STAGE.HEALTH_ANALYZER in pipeline_names and doc.has_extension(
+            STAGE.HEALTH_ANALYZER
+        ):
             d = doc._.get(STAGE.HEALTH_ANALYZER)
-            result[STAGE.HEALTH_ANALYZER] = d
+            result[STAGE.HEALTH_ANALYZER] = self._with_raw_offsets(doc, d)
+            # Chunks served from the Text Analytics for health cache
+            result["health_analyzer_cache"] = doc.user_data.get("health_analyzer_cache")
+
+        # Definitions of the entities, as far as they were resolved within the time budget
+        if STAGE.DEFINITIONS in pipeline_names and doc.has_extension(STAGE.DEFINITIONS):
+            result[STAGE.DEFINITIONS] = doc._.get(STAGE.DEFINITIONS)
+
+        # How many times each stage actually computed its results for this doc (should be 1 each)
+        result["stage_computations"] = dict(doc.user_data.get("stage_computations", {}))
 
         # remove all empty fields (e.g. keys with uncollected values)
         result = {k: v for k, v in result.items() if v}
@@ -8,6 +8,7 @@ from rouge_score import rouge_scorer
 log = logging.getLogger(__name__)
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
 
 
 class RougeScorer(object):
@@ -28,8 +29,8 @@ class RougeScorer(object):
                 f"The 'summarizer' pipeline stage did not run, can't calculate ROUGE scores"
             )
             return
-        elif not doc.has_extension(self.name):
-            doc.set_extension(self.name, getter=self._calculate_rouge_scores)
+
+        stage_extension(doc, self.name, "_calculate_rouge_scores")
 
         return doc
 
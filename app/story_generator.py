@@ -10,6 +10,7 @@ from spacy.tokens import Doc
 log = logging.getLogger(__name__)
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
 
 
 class StoryGenerator(object):
@@ -32,8 +33,7 @@ class StoryGenerator(object):
             # model is saved into current directory under /models/124M/ """
 
     def __call__(self, doc):
-        if not doc.has_extension(STAGE.STORY_GENERATOR):
-            doc.set_extension(STAGE.STORY_GENERATOR, getter=self._generate_story)
+        stage_extension(doc, STAGE.STORY_GENERATOR, "_generate_story")
 
         return doc
 
@@ -5,6 +5,7 @@ import logging
 log = logging.getLogger(__name__)
 
 from app.models import PIPELINE_STAGES as STAGE
+from app.utils import stage_extension
 
 
 # from string import punctuation
@@ -30,8 +31,7 @@ class Summarizer(object):
         self.num_sentences = num_sentences
 
     def __call__(self, doc: Doc):
-        if not doc.has_extension(STAGE.SUMMARIZER):
-            doc.set_extension(STAGE.SUMMARIZER, getter=self._summarize)
+        stage_extension(doc, STAGE.SUMMARIZER, "_summarize")
 
         return doc
 
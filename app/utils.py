@@ -1,4 +1,5 @@
 from functools import partial, wraps
+import asyncio
 import logging
 from timeit import default_timer as timer
 
@@ -17,6 +18,59 @@ def find_first(d, aliases, default="<unknown>"):
     return default
 
 
+def memoized_stage(name: str, getter):
+    """
+    Wraps the Doc extension getter of a pipeline stage, so that it computes only once per Doc.
+    (A plain extension getter runs again on every doc._.<name> access)
+    The result is stored in doc.user_data, and we count how many times each stage actually computed
+    in doc.user_data["stage_computations"], so that we notice if a stage runs more often than expected.
+    """
+    key = ("memoized_stage", name)
+
+    @wraps(getter)
+    def wrapper_memoized(doc):
+        if key not in doc.user_data:
+            doc.user_data[key] = getter(doc)
+            computations = doc.user_data.setdefault("stage_computations", {})
+            computations[name] = computations.get(name, 0) + 1
+
+        return doc.user_data[key]
+
+    return wrapper_memoized
+
+
+# doc.user_data key of the Language (pipeline) that processed the Doc, see stage_extension()
+DOC_LANGUAGE = "language"
+
+
+def stage_getter(name: str, method: str):
+    """
+    Extension getter that runs 'method' of the stage 'name' of the Language that processed the doc
+    (doc.user_data[DOC_LANGUAGE]), memoized (see memoized_stage).
+    """
+
+    def getter(doc):
+        nlp = doc.user_data.get(DOC_LANGUAGE)
+        if nlp is None:
+            raise ValueError(
+                f"Can't compute '{name}': no pipeline set for this doc (doc.user_data['{DOC_LANGUAGE}'])"
+            )
+        return getattr(nlp.get_pipe(name), method)(doc)
+
+    return memoized_stage(name, getter)
+
+
+def stage_extension(doc, name: str, method: str):
+    """
+    Registers the Doc extension of a pipeline stage, if it isn't registered yet.
+    Doc extensions are global, but every pipeline has its own stages (e.g. with another language model):
+    the getter is the same for all pipelines, it runs the stage of the doc's own pipeline (see stage_getter).
+    So the extensions are never removed, and don't keep any pipeline alive.
+    """
+    if not doc.has_extension(name):
+        doc.set_extension(name, getter=stage_getter(name, method))
+
+
 def timed(save_to: str = None, force=False):
     def _timed(func):
         """
@@ -25,18 +79,10 @@ def timed(save_to: str = None, force=False):
         The save_to attribute must exist on the return value, unless you set force=True.
         In which case we try to create the dict-attribute on the fly to store the result.
 
-        TODO: usually does not work as expected for async functions, so be aware
+        Works for async functions (coroutine functions) too, measuring until they return.
         """
 
-        @wraps(func)
-        def wrapper_timed(*f_args, **f_kwargs):
-            # 1. Do something before
-            log.info(f">>> Starting @timed() function {func.__qualname__!r} ")
-            start_timing = timer()
-            # 2. call wrapped function
-            return_value = func(*f_args, **f_kwargs)
-            # 3. Do something after
-            runtime_ms = round((timer() - start_timing) * 1000)
+        def _save(return_value, runtime_ms: int):
             log.info(f"<<< Finished {func.__qualname__!r} in {runtime_ms}ms")
 
             # We can inidcate a field on the return value to record the timing to.
@@ -60,6 +106,27 @@ def timed(save_to: str = None, force=False):
 
             return return_value
 
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper_timed_async(*f_args, **f_kwargs):
+                log.info(f">>> Starting @timed() function {func.__qualname__!r} ")
+                start_timing = timer()
+                return_value = await func(*f_args, **f_kwargs)
+                return _save(return_value, round((timer() - start_timing) * 1000))
+
+            return wrapper_timed_async
+
+        @wraps(func)
+        def wrapper_timed(*f_args, **f_kwargs):
+            # 1. Do something before
+            log.info(f">>> Starting @timed() function {func.__qualname__!r} ")
+            start_timing = timer()
+            # 2. call wrapped function
+            return_value = func(*f_args, **f_kwargs)
+            # 3. Do something after
+            return _save(return_value, round((timer() - start_timing) * 1000))
+
         return wrapper_timed
 
     return _timed
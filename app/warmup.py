@@ -0,0 +1,146 @@
+import app
+import os
+import logging
+import threading
+from timeit import default_timer as timer
+from typing import List, Tuple
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+
+log = logging.getLogger(__name__)
+
+
+from app.models import PIPELINE_STAGES as STAGE
+from app.executor import PipelineExecutorInstance
+
+
+# A small document that runs through all (local) pipeline stages, so that lazily
+# initialized things (vocab, vectors, caches of the stages) are filled before the first real request.
+WARMUP_TEXT = """Breast cancer is cancer that develops from breast tissue.
+Signs of breast cancer may include a lump in the breast, a change in breast shape, or fluid coming from the nipple.
+The diagnosis is confirmed by taking a biopsy of the concerning lump.
+Treatments may include surgery, radiation therapy, chemotherapy and hormonal therapy.
+Most patients were discharged from the hospital after a few days without complications."""
+
+# Stages that would call (paid) external services
+WARMUP_SETTINGS = {"disable": [STAGE.HEALTH_ANALYZER]}
+
+
+def parse_pipeline_specs(specs: str) -> List[Tuple[str, dict]]:
+    """
+    Parses a comma separated list of pipelines, optionally with their language model, e.g.
+    "default,default:en_core_web_sm" -> [("default", {}), ("default", {"language_model": "en_core_web_sm"})]
+    """
+    pipelines = []
+    for spec in (specs or "").split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        name, _, language_model = spec.partition(":")
+        settings = {"language_model": language_model} if language_model else {}
+        pipelines.append((name, settings))
+
+    return pipelines
+
+
+def warmup_pipeline(name: str, settings: dict) -> dict:
+    """
+    Creates the pipeline (if not cached yet) and runs the warm-up document through it.
+    Module level function, so that it can run in pipeline worker processes as well.
+    """
+    from app.pipeline import PipelineFactoryInstance
+
+    started = timer()
+    with PipelineFactoryInstance.checkout(name, settings) as pipeline:
+        load_time_ms = round((timer() - started) * 1000)
+
+        started = timer()
+        pipeline.execute(
+            text=WARMUP_TEXT, meta={}, settings={**settings, **WARMUP_SETTINGS}
+        )
+        warmup_time_ms = round((timer() - started) * 1000)
+
+    return {"load_time_ms": load_time_ms, "warmup_time_ms": warmup_time_ms}
+
+
+class PipelineWarmup(object):
+    """
+    Preloads pipelines at startup and tracks if we're ready to serve requests.
+
+    Configured via env vars:
+        WARMUP_PIPELINES        comma separated list of pipelines to preload, e.g. "default,default:en_core_web_sm"
+                                (default: "default", set to empty to skip warm-up)
+        WARMUP_IN_BACKGROUND    "true" (default) to warm up on a background thread,
+                                so that the server starts (and is "alive") right away
+    """
+
+    def __init__(self, pipelines: str = None):
+        self.pipelines = parse_pipeline_specs(
+            pipelines
+            if pipelines is not None
+            else os.getenv("WARMUP_PIPELINES", "default")
+        )
+        # per pipeline spec: status, load and warm-up time (or error)
+        self.status = {
+            self._spec(name, settings): {"status": "pending"}
+            for name, settings in self.pipelines
+        }
+        self._finished = threading.Event()
+
+    @staticmethod
+    def _spec(name: str, settings: dict) -> str:
+        language_model = settings.get("language_model")
+        return f"{name}:{language_model}" if language_model else name
+
+    @property
+    def ready(self) -> bool:
+        return self._finished.is_set() and all(
+            s["status"] == "ready" for s in self.status.values()
+        )
+
+    def start(self, background: bool = None):
+        if background is None:
+            background = os.getenv("WARMUP_IN_BACKGROUND", "true").lower() == "true"
+
+        if background:
+            threading.Thread(
+                target=self.run, name="pipeline-warmup", daemon=True
+            ).start()
+        else:
+            self.run()
+
+    def run(self):
+        log.info(f"Warming up pipelines: {list(self.status.keys())}")
+        for name, settings in self.pipelines:
+            spec = self._spec(name, settings)
+            self.status[spec] = {"status": "loading"}
+            try:
+                if PipelineExecutorInstance.mode == "process":
+                    # Every worker process has its own pipelines. Submitting one warm-up per worker
+                    # at the same time should keep every worker busy with (exactly) one of them.
+                    futures = [
+                        PipelineExecutorInstance.executor.submit(
+                            warmup_pipeline, name, settings
+                        )
+                        for _ in range(PipelineExecutorInstance.max_workers)
+                    ]
+                    timings = max(
+                        (f.result() for f in futures), key=lambda t: t["load_time_ms"]
+                    )
+                else:
+                    timings = warmup_pipeline(name, settings)
+
+                self.status[spec] = {"status": "ready", **timings}
+                log.info(f"Pipeline '{spec}' is warmed up: {timings}")
+            except Exception as e:
+                msg = f"Error warming up pipeline '{spec}': {str(e)}"
+                log.error(msg)
+                self.status[spec] = {"status": "failed", "error": msg}
+
+        self._finished.set()
+
+
+PipelineWarmupInstance = PipelineWarmup()
@@ -0,0 +1,49 @@
+"""
+Compares the compiled "default" cleaning profile with the chain of textacy preprocessing
+functions it replaces. The pipeline runs the profile with offset tracking (clean_with_offsets,
+to map entities back to the raw text), so both variants are timed.
+
+    python -m benchmarks.bench_cleaner [copies] [repeat]
+"""
+import os
+import sys
+from timeit import timeit
+
+from app.cleaner import compile_profile
+from benchmarks.reference_cleaner import reference_clean
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+def main(copies: int = 20, repeat: int = 5):
+    with open(f"{TEST_DOCS}/txt/simple.txt", encoding="UTF-8") as f:
+        text = "\n".join([f.read()] * copies)
+
+    engine = compile_profile("default")
+    assert engine.clean(text) == reference_clean(text)
+    assert engine.clean_with_offsets(text).text == reference_clean(text)
+
+    reference_ms = timeit(lambda: reference_clean(text), number=repeat) / repeat * 1000
+    compiled_ms = timeit(lambda: engine.clean(text), number=repeat) / repeat * 1000
+    offsets_ms = (
+        timeit(lambda: engine.clean_with_offsets(text), number=repeat) / repeat * 1000
+    )
+
+    print(f"Text with {len(text)} characters, {repeat} runs each")
+    print(f"textacy chain: {reference_ms:8.1f} ms")
+    print(f"compiled:      {compiled_ms:8.1f} ms ({reference_ms / compiled_ms:.1f}x)")
+    print(f"with offsets:  {offsets_ms:8.1f} ms ({reference_ms / offsets_ms:.1f}x)")
+
+    # time spent per pass, without/with offset tracking
+    for cleaning_pass in engine.passes:
+        pass_ms = timeit(lambda: cleaning_pass(text), number=repeat) / repeat * 1000
+        edits_ms = (
+            timeit(lambda: cleaning_pass(text, []), number=repeat) / repeat * 1000
+        )
+        print(f"  {cleaning_pass.name:<25} {pass_ms:8.1f} ms {edits_ms:8.1f} ms")
+        text = cleaning_pass(text)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
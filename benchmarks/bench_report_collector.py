@@ -0,0 +1,100 @@
+"""
+Compares the single-pass statistics of the ReportCollector with the previous implementation,
+which walked all tokens several times and all entities once per label.
+
+    python -m benchmarks.bench_report_collector [num_tokens] [repeat]
+"""
+import os
+import sys
+from collections import Counter
+from timeit import timeit
+
+from app.models import PIPELINE_STAGES as STAGE
+from app.pipeline import PipelineFactoryInstance
+from app.report_collector import ENTITY_LABELS, ReportCollector
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+def legacy_stats(doc) -> dict:
+    """
+    The previous implementation (token, sentence and entity statistics only)
+    """
+    result = {}
+    if doc.is_sentenced:
+        sentences = [sentence.text for sentence in doc.sents]
+    else:
+        sentences = []
+    words = [token.text for token in doc if not token.is_stop and not token.is_punct]
+    nouns = [
+        token.text
+        for token in doc
+        if not token.is_stop and not token.is_punct and token.pos_ == "NOUN"
+    ]
+    if doc.is_parsed:
+        result["noun_chunks"] = [token.text for token in doc.noun_chunks]
+        result["num_noun_chunks"] = len(result["noun_chunks"])
+        result["common_noun_chunks"] = Counter(result["noun_chunks"]).most_common(5)
+    result = {
+        **{
+            "num_token": len(doc),
+            "num_words": len(words),
+            "num_sentences": len(sentences),
+        },
+        **result,
+    }
+    result["common_words"] = Counter(words).most_common(5)
+    result["common_nouns"] = Counter(nouns).most_common(5)
+    if doc.is_nered:
+        entities = sorted(set([(entity.text, entity.label_) for entity in doc.ents]))
+        result["named_entities"] = entities
+        for label in ENTITY_LABELS:
+            filtered_entities = [
+                entity.text for entity in doc.ents if entity.label_ == label
+            ]
+            result[label] = sorted(set(filtered_entities))
+            result["common_" + label] = Counter(filtered_entities).most_common(5)
+
+    return result
+
+
+def single_pass_stats(collector: ReportCollector, doc) -> dict:
+    stats = {**collector._token_stats(doc), **collector._entity_stats(doc)}
+    # not part of the previous implementation
+    del stats["named_entity_offsets"]
+    return stats
+
+
+def main(num_tokens: int = 100000, repeat: int = 5):
+    pipeline = PipelineFactoryInstance.create("default")
+    nlp = pipeline.nlp
+
+    with open(f"{TEST_DOCS}/txt/simple.txt", encoding="UTF-8") as f:
+        text = f.read()
+    # Only the stages that annotate tokens, sentences and entities
+    disable = [
+        name
+        for name in nlp.pipe_names
+        if name not in [STAGE.TAGGER, STAGE.SENTENCIZER, STAGE.PARSER, STAGE.NER]
+    ]
+    chunk = nlp(text, disable=disable)
+    copies = max(1, num_tokens // len(chunk))
+    nlp.max_length = max(nlp.max_length, len(text) * copies + copies)
+    doc = nlp("\n".join([text] * copies), disable=disable)
+
+    collector = nlp.get_pipe(STAGE.REPORT_COLLECTOR)
+    assert single_pass_stats(collector, doc) == legacy_stats(doc)
+
+    legacy_ms = timeit(lambda: legacy_stats(doc), number=repeat) / repeat * 1000
+    single_pass_ms = (
+        timeit(lambda: single_pass_stats(collector, doc), number=repeat) / repeat * 1000
+    )
+
+    print(f"Doc with {len(doc)} tokens, {len(doc.ents)} entities, {repeat} runs each")
+    print(f"legacy:      {legacy_ms:8.1f} ms")
+    print(f"single-pass: {single_pass_ms:8.1f} ms ({legacy_ms / single_pass_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,29 @@
+"""
+The chain of textacy preprocessing functions that the compiled "default" cleaning profile replaces.
+Used by bench_cleaner and by the golden tests of the profile (tests/test_cleaner.py).
+"""
+import re
+
+from textacy import preprocessing
+
+
+def reference_clean(text: str) -> str:
+    """
+    The "default" cleaning profile as a chain of textacy preprocessing functions
+    """
+    txt = text.strip()
+    txt = preprocessing.normalize_unicode(txt, form="NFKC")
+    txt = preprocessing.normalize_whitespace(txt)
+    txt = preprocessing.normalize_repeating_chars(txt, chars="\n", maxn=1)
+    txt = preprocessing.normalize_hyphenated_words(txt)
+    txt = preprocessing.normalize_quotation_marks(txt)
+    txt = preprocessing.replace_urls(txt, replace_with="")
+    txt = preprocessing.replace_phone_numbers(txt, replace_with="")
+    txt = preprocessing.replace_emails(txt, replace_with="")
+    txt = preprocessing.replace_user_handles(txt, replace_with="")
+    txt = preprocessing.normalize_repeating_chars(txt, chars=".,;:-_ ", maxn=1)
+    txt = re.sub("\n ", " ", txt)
+    txt = re.sub(" \n", " ", txt)
+    txt = re.sub("\n", " ", txt)
+    txt = re.sub(" . ", " ", txt)
+    return txt
@@ -9,6 +9,14 @@ from app import api
 
 
 from app.api import API_V1
+from app.executor import PipelineExecutorInstance
+from app.http_clients import HttpClientsInstance
+from app.definitions import DefinitionsLookupInstance
+from app.immersive_reader import ImmersiveReaderTokenInstance
+from app.extractor.abbyy_ocr_runner import AbbyyOcrJobRunnerInstance
+from app.extractor.base import shutdown_extractor_pool
+from app.extractor.spellcheck import SpellcheckerRegistryInstance
+from app.warmup import PipelineWarmupInstance
 
 #
 # Load environment variables from the '.env' file
@@ -81,6 +89,15 @@ async def startup_event():
     uvicorn_log.addHandler(console_handler)
     uvicorn_log.addHandler(logfile_handler)
 
+    # Preload and warm up the pipelines (see WARMUP_PIPELINES), /readyz reports when we're done
+    PipelineWarmupInstance.start()
+
+    # Shared (pooled) clients for outbound HTTP calls
+    HttpClientsInstance.start()
+
+    # Load the spell checking dictionaries for OCR (see SPELLCHECK_PRELOAD) in the background
+    SpellcheckerRegistryInstance.preload()
+
     # We're done here...
     log.info(f"Started MedJargonBuster API server, version={app.version}")
 
@@ -88,6 +105,12 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     log.info(f"Shutting down MedJargonBuster API server")
+    PipelineExecutorInstance.shutdown(wait=False)
+    shutdown_extractor_pool(wait=False)
+    AbbyyOcrJobRunnerInstance.close()
+    ImmersiveReaderTokenInstance.close()
+    DefinitionsLookupInstance.close()
+    await HttpClientsInstance.aclose()
 
 
 # Entrypoint for "python main.py"
@@ -0,0 +1,137 @@
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from PIL import Image
+
+from app.extractor.abbyy_ocr_runner import AbbyyOcrError, AbbyyOcrJobRunner
+
+
+def _page_number(image: bytes) -> int:
+    with Image.open(io.BytesIO(image)) as page:
+        return page.getpixel((0, 0)) // 50 + 1
+
+
+class FakeAbbyyHandler(BaseHTTPRequestHandler):
+    """
+    Tasks are done after 'polls' status requests. Their result is the page number drawn into
+    the submitted image (see _tiff), so every result belongs to the page it was created from.
+    """
+
+    polls = 2
+    tasks = {}
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def _json(self, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        with FakeAbbyyHandler.lock:
+            task_id = str(len(FakeAbbyyHandler.tasks) + 1)
+            FakeAbbyyHandler.tasks[task_id] = {"polls": 0, "page": _page_number(data)}
+            FakeAbbyyHandler.in_flight += 1
+            FakeAbbyyHandler.max_in_flight = max(
+                FakeAbbyyHandler.max_in_flight, FakeAbbyyHandler.in_flight
+            )
+        self._json({"taskId": task_id, "status": "Queued"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/v2/getTaskStatus":
+            task_id = parse_qs(url.query)["taskId"][0]
+            with FakeAbbyyHandler.lock:
+                task = FakeAbbyyHandler.tasks[task_id]
+                task["polls"] += 1
+                if task["polls"] < FakeAbbyyHandler.polls:
+                    return self._json({"taskId": task_id, "status": "InProgress"})
+                if task["polls"] == FakeAbbyyHandler.polls:
+                    FakeAbbyyHandler.in_flight -= 1
+            host = f"http://127.0.0.1:{self.server.server_port}"
+            return self._json(
+                {
+                    "taskId": task_id,
+                    "status": "Completed",
+                    "resultUrls": [f"{host}/result/{task_id}"],
+                }
+            )
+
+        task = FakeAbbyyHandler.tasks[url.path.split("/")[-1]]
+        body = f"page {task['page']}".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def abbyy_url():
+    FakeAbbyyHandler.polls = 2
+    FakeAbbyyHandler.tasks = {}
+    FakeAbbyyHandler.in_flight = 0
+    FakeAbbyyHandler.max_in_flight = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeAbbyyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def _runner(url: str, **kwargs) -> AbbyyOcrJobRunner:
+    settings = {"timeout": 10, "poll_interval": 0.01, "max_poll_interval": 0.05}
+    return AbbyyOcrJobRunner(
+        url=url, app_id="app", password="secret", **{**settings, **kwargs}
+    )
+
+
+def _tiff(pages: int) -> bytes:
+    # the gray level of each page is its page number
+    images = [Image.new("L", (32, 32), color=i * 50) for i in range(pages)]
+    data = io.BytesIO()
+    images[0].save(data, format="TIFF", save_all=True, append_images=images[1:])
+    return data.getvalue()
+
+
+def test_single_page(abbyy_url):
+    runner = _runner(abbyy_url)
+    try:
+        assert runner.process(_tiff(1)) == "page 1"
+    finally:
+        runner.close()
+
+
+def test_pages_in_parallel(abbyy_url):
+    runner = _runner(abbyy_url, max_jobs=2)
+    try:
+        text = runner.process(_tiff(5))
+    finally:
+        runner.close()
+
+    # every page's result, in page order (whichever order the tasks were submitted in)
+    assert text == "\n\n".join(f"page {i}" for i in range(1, 6))
+    submitted = sorted(task["page"] for task in FakeAbbyyHandler.tasks.values())
+    assert submitted == list(range(1, 6))
+    assert FakeAbbyyHandler.max_in_flight == 2
+
+
+def test_deadline(abbyy_url):
+    FakeAbbyyHandler.polls = 1000
+    runner = _runner(abbyy_url, timeout=0.3)
+    try:
+        with pytest.raises(AbbyyOcrError):
+            runner.process(_tiff(1))
+    finally:
+        runner.close()
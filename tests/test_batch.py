@@ -0,0 +1,60 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from app.api import API_V1
+
+
+client = TestClient(API_V1)
+
+TEXTS = [
+    "The patient was admitted with chest pain. An ECG was performed.",
+    "Breast cancer is the most common cancer in women. It can be treated.",
+    "The wound healed without complications. The patient was discharged.",
+]
+
+
+def test_batch_json():
+    requests = [{"text": text, "meta": {"n": i}} for i, text in enumerate(TEXTS)]
+
+    response = client.post(
+        "/pipeline/default/batch?batch_size=2&disable=health_analyzer", json=requests
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == len(TEXTS)
+    # in input order, with the meta data passed through
+    assert [line["meta"]["n"] for line in lines] == [0, 1, 2]
+
+
+def test_batch_ndjson():
+    body = "\n".join(json.dumps({"text": text}) for text in TEXTS)
+
+    response = client.post(
+        "/pipeline/default/batch?clean_only=true",
+        data=body,
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == len(TEXTS)
+    assert all(line["meta"]["pipeline"] == ["cleaner"] for line in lines)
+
+
+def test_batch_disable_query_string():
+    body = "\n".join(json.dumps({"text": text}) for text in TEXTS)
+
+    response = client.post(
+        "/pipeline/default/batch?disable=cleaner",
+        data=body,
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    # only the cleaner is disabled, not "ner" (which is a substring of "cleaner")
+    assert all("cleaner" not in line["meta"]["pipeline"] for line in lines)
+    assert all("ner" in line["meta"]["pipeline"] for line in lines)
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from app.cleaner import compile_profile
+from app.extractor.tika_extractor import TikaExtractor
+from app.models import ExtractorRequest
+from benchmarks.reference_cleaner import reference_clean
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+DOCUMENTS = [
+    "txt/simple.txt",
+    "research_papers/simple.pdf",
+    "research_papers/summarization.pdf",
+    "research_papers/1902.07669.pdf",
+    "research_papers/2004.15011.pdf",
+    "guides/Breastcancerorg_Pathology_Report_Guide_2016.pdf",
+    "clinical_reports/de-report01.docx",
+]
+
+
+def _read_test_document(path: str) -> str:
+    if path.endswith(".txt"):
+        with open(f"{TEST_DOCS}/{path}", encoding="UTF-8") as f:
+            return f.read()
+
+    response = TikaExtractor().extract(ExtractorRequest(filename=f"{TEST_DOCS}/{path}"))
+    assert not response.error, response.error
+    return response.text
+
+
+@pytest.mark.parametrize("path", DOCUMENTS)
+def test_default_profile_golden(path):
+    text = _read_test_document(path)
+    assert compile_profile("default").clean(text) == reference_clean(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "  \r\n\r\n \u200b\n\t\xa0text\v\v",
+        "pre-  \n fix, co- operate, 12- 34, ab- 1c",
+        "“quoted” ‘single’ `back` ʼmodifierʼ",
+        "see https://example.com/x?y=1, www.test.org and bit.ly/abc.",
+        "mail to john.doe@example.org or mailto:x@y.com, @handle, foo@bar",
+        "call (555) 123-4567 ext. 12 or +1 555.123.4567",
+        "a .,;:-_ .,;:-_ b\n \nc x d",
+    ],
+)
+def test_default_profile_edge_cases(text):
+    assert compile_profile("default").clean(text) == reference_clean(text)
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        compile_profile("unknown")
+
+
+def test_raw_offsets():
+    raw = "  \u201cPre-\n  fix\u201d\u200b  text, see www.example.com/page  or\r\n\r\nmail@example.org . done\n"
+    result = compile_profile("default").clean_with_offsets(raw)
+
+    assert result.text == reference_clean(raw)
+    assert result.raw_length == len(raw)
+    for word in ["text", "see", "or", "done"]:
+        start = result.text.index(word)
+        raw_start, raw_end = result.raw_span(start, start + len(word))
+        assert raw[raw_start:raw_end] == word
+
+    # a word that was changed by the cleaning maps to the raw text it was created from
+    start = result.text.index("Prefix")
+    raw_start, raw_end = result.raw_span(start, start + len("Prefix"))
+    assert raw[raw_start:raw_end] == "Pre-\n  fix"
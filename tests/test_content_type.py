@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from app.extractor.base import detect_content_type
+from app.extractor.content_type import (
+    DOCX,
+    GIF,
+    HTML,
+    JPEG,
+    PDF,
+    PNG,
+    TEXT,
+    TIFF,
+    sniff_content_type,
+)
+from app.extractor.fetch import FetchContext
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("research_papers/simple.pdf", PDF),
+        ("clinical_reports/de-report01.docx", DOCX),
+        ("clinical_reports/de-OP-Bericht-001.jpeg", JPEG),
+        ("txt/simple.txt", TEXT),
+    ],
+)
+def test_test_documents(path, expected):
+    context = FetchContext(filename=f"{TEST_DOCS}/{path}")
+    assert detect_content_type(context.name, context) == expected
+    assert context.content_type_detector != "tika"
+
+
+@pytest.mark.parametrize(
+    "head, expected",
+    [
+        (b"\x89PNG\r\n\x1a\n\x00\x00", (PNG, "magic")),
+        (b"GIF89a\x01\x00", (GIF, "magic")),
+        (b"II*\x00\x08\x00", (TIFF, "magic")),
+        (b"MM\x00*\x00\x08", (TIFF, "magic")),
+        (b"\xef\xbb\xbf\n  <!DOCTYPE html><html>", (HTML, "magic")),
+        (b"Some text, with \xc3\xa4 and a cut \xc3", (TEXT, "text")),
+    ],
+)
+def test_magic_bytes(head, expected):
+    assert sniff_content_type(head) == expected
+
+
+def test_declared_and_extension():
+    binary = b"\x00\x01\x02\x03"
+    assert sniff_content_type(binary, declared="image/png; q=1") == (PNG, "declared")
+    assert sniff_content_type(binary, "https://x.org/scan.TIF?page=1") == (
+        TIFF,
+        "extension",
+    )
+    # unknown binary data: let Tika decide
+    assert sniff_content_type(binary, "file.bin", "application/octet-stream") == (
+        None,
+        None,
+    )
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import pytest
+import spacy
+from spacy.tokens import Span
+
+from app.cache import TieredCache
+from app.definitions import DefinitionsLookup, DefinitionsPrefetcher
+from app.models import PIPELINE_STAGES as STAGE
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+with open(f"{TEST_DOCS}/json/mw_dicitionary_response_example.json") as f:
+    DOCTOR = json.load(f)
+
+
+class StubDictionaryHandler(BaseHTTPRequestHandler):
+    """
+    Knows "doctor" and "slow" (which takes its time), suggests the example's entries for everything else
+    """
+
+    lookups = Counter()
+
+    def do_GET(self):
+        term = unquote(urlparse(self.path).path.split("/")[-1])
+        StubDictionaryHandler.lookups[term] += 1
+        time.sleep(0.5 if term == "slow" else 0.02)
+
+        if term in ("doctor", "slow"):
+            definitions = DOCTOR
+        else:
+            definitions = [entry["meta"]["id"] for entry in DOCTOR]
+
+        data = json.dumps(definitions).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def lookup():
+    StubDictionaryHandler.lookups = Counter()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubDictionaryHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    lookup = DefinitionsLookup(
+        url=f"http://127.0.0.1:{httpd.server_port}/medical/json",
+        api_key="key",
+        cache=TieredCache("test_definitions"),
+    )
+    yield lookup
+    lookup.close()
+    httpd.shutdown()
+
+
+def _doc():
+    nlp = spacy.blank("en")
+    doc = nlp("The doctor saw another Doctor on Monday , slow and doctr .")
+    doc.ents = [
+        Span(doc, 1, 2, label="PERSON"),
+        Span(doc, 4, 5, label="PERSON"),
+        Span(doc, 6, 7, label="DATE"),
+        Span(doc, 8, 9, label="ORG"),
+        Span(doc, 10, 11, label="ORG"),
+    ]
+    doc.user_data["pipeline"] = [STAGE.NER, STAGE.DEFINITIONS]
+    return nlp, doc
+
+
+def test_lookup_within_timeout(lookup):
+    definitions, pending = lookup.lookup_many(["doctor", "doctr", "slow"], timeout=0.3)
+
+    assert definitions == {
+        "doctor": DOCTOR,
+        "doctr": [entry["meta"]["id"] for entry in DOCTOR],
+    }
+    assert pending == ["slow"]
+
+    # the skipped lookup still ends up in the cache
+    time.sleep(0.5)
+    assert lookup.cached("Slow") == DOCTOR
+
+
+def test_prefetch(lookup):
+    nlp, doc = _doc()
+    prefetcher = DefinitionsPrefetcher(nlp, lookup=lookup, budget_ms=300)
+    prefetcher(doc)
+
+    result = prefetcher._prefetch(doc)
+    # unique terms, no dates
+    assert result["terms"] == 3
+    assert result["cached"] == 0
+    # "doctr" isn't in the dictionary, "slow" takes too long
+    assert list(result["definitions"]) == ["doctor"]
+    assert result["definitions"]["doctor"][0] == {
+        "id": DOCTOR[0]["meta"]["id"],
+        "fl": DOCTOR[0]["fl"],
+        "shortdef": DOCTOR[0]["shortdef"],
+    }
+    assert result["resolved"] == 1
+    assert result["skipped"] == ["slow"]
+
+    # the next document gets all of them from the cache
+    time.sleep(0.5)
+    nlp, doc = _doc()
+    result = prefetcher._prefetch(doc)
+    assert result["cached"] == 3
+    assert list(result["definitions"]) == ["doctor", "slow"]
+    assert result["skipped"] == []
+    assert StubDictionaryHandler.lookups == {"doctor": 1, "doctr": 1, "slow": 1}
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import pytest
+
+from app.cache import TieredCache
+from app.dictionary import Dictionary, normalize_term
+from app.http_clients import HttpClients
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+with open(f"{TEST_DOCS}/json/mw_dicitionary_response_example.json") as f:
+    DOCTOR = json.load(f)
+
+
+class StubDictionaryHandler(BaseHTTPRequestHandler):
+    """
+    Knows "doctor" only, suggests the example's entries for everything else
+    """
+
+    lookups = Counter()
+
+    def do_GET(self):
+        term = unquote(urlparse(self.path).path.split("/")[-1])
+        StubDictionaryHandler.lookups[term] += 1
+        time.sleep(0.05)
+
+        if term == "doctor":
+            definitions = DOCTOR
+        else:
+            definitions = [entry["meta"]["id"] for entry in DOCTOR]
+
+        data = json.dumps(definitions).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def dictionary_url():
+    StubDictionaryHandler.lookups = Counter()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubDictionaryHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}/medical/json"
+    httpd.shutdown()
+
+
+def _run(dictionary_url: str, lookups, negative_ttl: float = 3600):
+    async def run():
+        client = HttpClients().create_async_client()
+        dictionary = Dictionary(
+            url=dictionary_url,
+            api_key="key",
+            cache=TieredCache("test_dictionary"),
+            negative_ttl=negative_ttl,
+            client=client,
+        )
+        try:
+            return await lookups(dictionary)
+        finally:
+            await client.aclose()
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_normalize_term():
+    assert normalize_term("  Breast  Cancer,") == "breast cancer"
+    assert normalize_term("Mad-Doctor") == "mad-doctor"
+
+
+def test_cached_lookups(dictionary_url):
+    async def lookups(dictionary):
+        return [
+            await dictionary.lookup("doctor"),
+            await dictionary.lookup(" Doctor."),
+            await dictionary.lookup("doctr"),
+            await dictionary.lookup("Doctr"),
+        ]
+
+    doctor, doctor_again, unknown, unknown_again = _run(dictionary_url, lookups)
+
+    assert doctor == doctor_again == DOCTOR
+    assert unknown == unknown_again == [entry["meta"]["id"] for entry in DOCTOR]
+    # misses are cached, too
+    assert StubDictionaryHandler.lookups == {"doctor": 1, "doctr": 1}
+
+
+def test_negative_ttl(dictionary_url):
+    async def lookups(dictionary):
+        await dictionary.lookup("doctr")
+        await asyncio.sleep(0.1)
+        await dictionary.lookup("doctr")
+
+    _run(dictionary_url, lookups, negative_ttl=0.05)
+    assert StubDictionaryHandler.lookups == {"doctr": 2}
+
+
+def test_single_flight_bulk(dictionary_url):
+    async def lookups(dictionary):
+        terms = ["doctor", "Doctor", "doctr", "doctor ", "surgeon"]
+        return await dictionary.lookup_many(terms * 3)
+
+    results = _run(dictionary_url, lookups)
+
+    assert list(results) == ["doctor", "Doctor", "doctr", "doctor ", "surgeon"]
+    assert results["Doctor"] == DOCTOR
+    assert StubDictionaryHandler.lookups == {"doctor": 1, "doctr": 1, "surgeon": 1}
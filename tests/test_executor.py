@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.api
+from app.api import API_V1
+from app.executor import ExecutorQueueFull, PipelineExecutor
+
+
+client = TestClient(API_V1)
+
+
+def test_queue_full():
+    executor = PipelineExecutor(max_workers=1, queue_size=0, retry_after=3)
+    # occupy the only slot
+    executor._slots.acquire()
+
+    with pytest.raises(ExecutorQueueFull):
+        asyncio.run(executor.execute("default", text="Some text."))
+
+
+def test_queue_full_returns_503(monkeypatch):
+    executor = PipelineExecutor(max_workers=1, queue_size=0, retry_after=3)
+    executor._slots.acquire()
+    monkeypatch.setattr(app.api, "PipelineExecutorInstance", executor)
+
+    response = client.post("/pipeline/default", json={"text": "Some text."})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+
+def test_batch_queue_full_returns_503(monkeypatch):
+    executor = PipelineExecutor(max_workers=1, queue_size=0, retry_after=3)
+    executor._slots.acquire()
+    monkeypatch.setattr(app.api, "PipelineExecutorInstance", executor)
+
+    response = client.post("/pipeline/default/batch", json=[{"text": "Some text."}])
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+    # the batch gives its slot back once it's streamed
+    executor._slots.release()
+    response = client.post(
+        "/pipeline/default/batch?clean_only=true", json=[{"text": "Some text."}]
+    )
+    assert response.status_code == 200
+    assert executor._slots.acquire(blocking=False)
+
+
+def test_queue_wait_reported():
+    executor = PipelineExecutor(max_workers=1, queue_size=1)
+    response = asyncio.run(
+        executor.execute("default", text="Some text.", settings={"enable": ["cleaner"]})
+    )
+    executor.shutdown()
+
+    assert "queue_wait_ms" in response.meta["timed"]
@@ -0,0 +1,93 @@
+import os
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+import requests
+
+from app.extractor import UNIVERSAL_EXTRACTOR
+from app.extractor.fetch import FetchContext
+from app.models import ExtractorRequest
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        CountingHandler.requests.append(self.path)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    CountingHandler.requests = []
+    handler = partial(CountingHandler, directory=TEST_DOCS)
+    httpd = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_fetch_once(server):
+    with open(f"{TEST_DOCS}/research_papers/simple.pdf", "rb") as f:
+        expected = f.read()
+
+    context = FetchContext(url=f"{server}/research_papers/simple.pdf", head_bytes=16)
+    try:
+        assert context.head() == expected[:16]
+        assert context.content() == expected
+        with open(context.path(), "rb") as f:
+            assert f.read() == expected
+    finally:
+        context.close()
+
+    assert CountingHandler.requests == ["/research_papers/simple.pdf"]
+
+
+def test_spool_to_disk(server):
+    context = FetchContext(
+        url=f"{server}/research_papers/simple.pdf", spool_max_bytes=1024
+    )
+    assert context.is_spooled()
+    path = context.path()
+    assert os.path.isfile(path)
+    assert os.path.getsize(path) == os.path.getsize(
+        f"{TEST_DOCS}/research_papers/simple.pdf"
+    )
+
+    context.close()
+    assert not os.path.exists(path)
+
+
+def test_extract_downloads_once(server):
+    request = ExtractorRequest(url=f"{server}/research_papers/simple.pdf")
+    response = UNIVERSAL_EXTRACTOR.extract(request)
+
+    assert not response.error, response.error
+    assert response.text
+    # content type detection and extraction share one download
+    assert CountingHandler.requests == ["/research_papers/simple.pdf"]
+    assert request._fetch is None
+
+
+def test_fetch_error(server):
+    context = FetchContext(url=f"{server}/research_papers/missing.pdf")
+    try:
+        # every access fails the same way (e.g. the next extractor probe), with a single request
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                context.head()
+        with pytest.raises(requests.HTTPError):
+            context.content()
+    finally:
+        context.close()
+
+    assert CountingHandler.requests == ["/research_papers/missing.pdf"]
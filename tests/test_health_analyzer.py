@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import spacy
+
+from app.cache import TieredCache
+from app.health_analyzer import HealthAnalyzer, split_into_chunks
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+with open(f"{TEST_DOCS}/json/ta4h_example_response.json") as f:
+    EXAMPLE_ENTITIES = json.load(f)["documents"][0]["entities"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Replays the entities of the example response, wherever their text occurs in a posted document
+    """
+
+    requests = []
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with StubHandler.lock:
+            StubHandler.requests.append(body["documents"])
+            StubHandler.in_flight += 1
+            StubHandler.max_in_flight = max(
+                StubHandler.max_in_flight, StubHandler.in_flight
+            )
+        time.sleep(0.05)
+
+        documents = []
+        for document in body["documents"]:
+            text = document["text"].lower()
+            entities = []
+            for entity in EXAMPLE_ENTITIES:
+                offset = text.find(entity["text"])
+                while offset >= 0:
+                    entities.append({**entity, "offset": offset})
+                    offset = text.find(entity["text"], offset + 1)
+            documents.append({"id": document["id"], "entities": entities})
+
+        data = json.dumps({"documents": documents, "errors": []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with StubHandler.lock:
+            StubHandler.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    StubHandler.requests = []
+    StubHandler.max_in_flight = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_split_into_chunks():
+    text = "One two three. Four five six seven. Eight. " + "x" * 25
+    sentences = [(0, 14), (15, 35), (36, 42), (43, 68)]
+
+    chunks = split_into_chunks(text, sentences, max_chars=20)
+    assert chunks == [(0, 14), (15, 35), (36, 42), (43, 63), (63, 68)]
+
+    # the short sentence before the long one is repeated
+    chunks = split_into_chunks(text, sentences[:3], max_chars=30, overlap=1)
+    assert chunks == [(0, 14), (15, 42)]
+    chunks = split_into_chunks(text, sentences[1:3], max_chars=20, overlap=1)
+    assert chunks == [(15, 35), (36, 42)]
+
+    assert split_into_chunks("a b c d", [(0, 7)], max_chars=4) == [(0, 3), (3, 7)]
+
+
+SENTENCES = [
+    "The patient was diagnosed with breast cancer last year.",
+    "A mastectomy was performed in March.",
+    "Her health-related quality of life improved after breast cancer surgery.",
+    "No invasive breast cancer was found.",
+]
+
+
+def _nlp():
+    nlp = spacy.blank("en")
+    nlp.add_pipe(nlp.create_pipe("sentencizer"))
+    return nlp
+
+
+def test_parallel_chunked_requests(endpoint):
+    nlp = _nlp()
+    doc = nlp(" ".join(SENTENCES * 10))
+
+    analyzer = HealthAnalyzer(
+        nlp,
+        endpoint=endpoint,
+        max_chars=200,
+        max_docs=3,
+        parallel=2,
+        overlap=1,
+        cache=None,
+    )
+    analyzer(doc)
+    result = analyzer._analyze_health_text(doc)
+
+    chunks = analyzer._split_into_chunks(doc)
+    # chunks overlap
+    assert sum(end - start for start, end in chunks) > len(doc.text)
+    assert len(StubHandler.requests) == -(-len(chunks) // 3)
+    assert all(len(documents) <= 3 for documents in StubHandler.requests)
+    assert StubHandler.max_in_flight == 2
+
+    text = doc.text.lower()
+    for entities in result.values():
+        identities = [(e["offset"], e["length"]) for e in entities]
+        # no duplicates from the chunk overlaps
+        assert len(identities) == len(set(identities))
+        for e in entities:
+            assert text[e["offset"] : e["offset"] + e["length"]] == e["text"]
+
+    assert len(result["treatments"]) == text.count("mastectomy") + text.count(
+        "breast cancer surgery"
+    )
+    assert len(result["diagnosis"]) == text.count("breast cancer") + text.count(
+        "invasive breast cancer"
+    )
+
+
+def test_chunk_cache(endpoint):
+    nlp = _nlp()
+    cache = TieredCache("test_health_analyzer")
+    analyzer = HealthAnalyzer(nlp, endpoint=endpoint, max_chars=200, cache=cache)
+
+    doc = nlp(" ".join(SENTENCES * 2))
+    analyzer(doc)
+    first = analyzer._analyze_health_text(doc)
+    chunks = doc.user_data["health_analyzer_cache"]["chunks"]
+    assert doc.user_data["health_analyzer_cache"]["misses"] == chunks
+
+    # the first chunks are the same, the new ones at the end are sent
+    StubHandler.requests = []
+    doc = nlp(" ".join(SENTENCES * 2 + ["Then a second mastectomy followed."]))
+    analyzer(doc)
+    second = analyzer._analyze_health_text(doc)
+    stats = doc.user_data["health_analyzer_cache"]
+    assert stats["hits"] > 0 and stats["misses"] > 0
+    assert sum(len(documents) for documents in StubHandler.requests) == stats["misses"]
+
+    assert len(second["treatments"]) == len(first["treatments"]) + 1
+    text = doc.text.lower()
+    for e in second["treatments"]:
+        assert text[e["offset"] : e["offset"] + e["length"]] == e["text"]
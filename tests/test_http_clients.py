@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.http_clients import HttpClients
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_GET(self):
+        KeepAliveHandler.connections.add(self.client_address)
+        status = 500 if self.path == "/error" else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    KeepAliveHandler.connections = set()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_session_keeps_connections_alive(server):
+    clients = HttpClients()
+    for _ in range(5):
+        assert clients.session.get(f"{server}/").text == "ok"
+    clients.session.get(f"{server}/error")
+
+    assert len(KeepAliveHandler.connections) == 1
+    stats = clients.stats()["127.0.0.1"]
+    assert stats["requests"] == 6
+    assert stats["errors"] == 1
+
+
+def test_async_client(server):
+    clients = HttpClients()
+
+    async def run():
+        responses = [await clients.async_client.get(f"{server}/") for _ in range(5)]
+        await clients.aclose()
+        return responses
+
+    responses = asyncio.get_event_loop().run_until_complete(run())
+
+    assert [r.text for r in responses] == ["ok"] * 5
+    assert len(KeepAliveHandler.connections) == 1
+    assert clients.stats()["127.0.0.1"]["requests"] == 5
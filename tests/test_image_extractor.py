@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from app.extractor.image_extractor import _assemble_text
+
+
+def _word(text, box):
+    return SimpleNamespace(text=text, bounding_box=box)
+
+
+def test_assemble_text():
+    ocr_result = SimpleNamespace(
+        regions=[
+            SimpleNamespace(
+                lines=[
+                    SimpleNamespace(
+                        words=[
+                            _word("Hello", "10,20,50,12"),
+                            _word("wrld", "70,20,40,12"),
+                        ]
+                    ),
+                    SimpleNamespace(words=[_word("again", "10,40,52,12")]),
+                ]
+            ),
+            SimpleNamespace(lines=[SimpleNamespace(words=[_word("2", "10,80,8,12")])]),
+        ]
+    )
+
+    text, layout = _assemble_text(ocr_result, ["Hello", "world", "again", "2"])
+
+    assert text == "Hello world \nagain \n\n\n2 \n\n\n"
+    assert layout["boxes"] == [
+        [10, 20, 50, 12],
+        [70, 20, 40, 12],
+        [10, 40, 52, 12],
+        [10, 80, 8, 12],
+    ]
+    words = [text[start:end] for start, end in layout["offsets"]]
+    assert words == ["Hello", "world", "again", "2"]
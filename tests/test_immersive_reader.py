@@ -0,0 +1,97 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.http_clients import HttpClients
+from app.immersive_reader import ImmersiveReaderToken
+
+
+class FakeTokenHandler(BaseHTTPRequestHandler):
+    """
+    Hands out tokens "token-1", "token-2", ... valid for 'lifetime' seconds
+    """
+
+    lifetime = 3600
+    issued = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        FakeTokenHandler.issued += 1
+        time.sleep(0.05)
+        data = json.dumps(
+            {
+                "token_type": "Bearer",
+                "expires_in": str(FakeTokenHandler.lifetime),
+                "expires_on": str(int(time.time() + FakeTokenHandler.lifetime)),
+                "access_token": f"token-{FakeTokenHandler.issued}",
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def token_url():
+    FakeTokenHandler.lifetime = 3600
+    FakeTokenHandler.issued = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeTokenHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}/tenant/oauth2/token"
+    httpd.shutdown()
+
+
+def _run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_single_flight_and_cached(token_url):
+    async def run():
+        client = HttpClients().create_async_client()
+        token = ImmersiveReaderToken(token_url, "id", "secret", client=client)
+        tokens = await asyncio.gather(*[token.get() for _ in range(10)])
+        tokens.append(await token.get())
+        token.close()
+        await client.aclose()
+        return tokens
+
+    assert _run(run()) == ["token-1"] * 11
+    assert FakeTokenHandler.issued == 1
+
+
+def test_background_refresh(token_url):
+    FakeTokenHandler.lifetime = 3
+
+    async def run():
+        client = HttpClients().create_async_client()
+        token = ImmersiveReaderToken(
+            token_url,
+            "id",
+            "secret",
+            expiry_margin=0.5,
+            refresh_ahead=300,
+            client=client,
+        )
+        first = await token.get()
+        # refreshed after half of the lifetime, without anybody asking
+        await asyncio.sleep(2)
+        issued = FakeTokenHandler.issued
+        second = await token.get()
+        token.close()
+        await client.aclose()
+        return first, issued, second
+
+    first, issued, second = _run(run())
+    assert first == "token-1"
+    assert issued == 2
+    assert second == "token-2"
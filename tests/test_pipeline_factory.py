@@ -0,0 +1,154 @@
+from types import SimpleNamespace
+
+import spacy
+
+import app.pipeline
+from app.pipeline import AbstractPipeline, DefaultSummarizerPipeline, PipelineFactory
+from app.utils import DOC_LANGUAGE, stage_extension
+
+
+class FakePipeline(AbstractPipeline):
+    create_settings = {"language_model": "fake_sm"}
+
+    def create(self):
+        self.nlp = SimpleNamespace(pipe_names=["cleaner"], pipeline=[])
+        return self.nlp
+
+
+class Marker(object):
+    """
+    A stage whose (lazy) result is the language model of its pipeline
+    """
+
+    def __init__(self, nlp, model: str):
+        self.nlp = nlp
+        self.model = model
+
+    def __call__(self, doc):
+        stage_extension(doc, "marker", "_mark")
+        return doc
+
+    def _mark(self, doc):
+        return self.model
+
+
+class MarkerPipeline(AbstractPipeline):
+    create_settings = {"language_model": "fake_sm"}
+
+    def create(self):
+        self.nlp = spacy.blank("en")
+        self.nlp.add_pipe(
+            Marker(self.nlp, self.settings["language_model"]), name="marker"
+        )
+        return self.nlp
+
+    def run(self, text: str):
+        doc = self.nlp(text)
+        doc.user_data[DOC_LANGUAGE] = self.nlp
+        return doc
+
+
+def test_cache_key_uses_create_settings(monkeypatch):
+    monkeypatch.setitem(vars(app.pipeline), "FakePipeline", FakePipeline)
+    factory = PipelineFactory(max_pipelines=2)
+
+    # execution settings don't create a new pipeline, defaults are normalized
+    a = factory.create("FakePipeline", {"enable": ["cleaner"]})
+    b = factory.create("FakePipeline", {"language_model": "fake_sm"})
+    assert a is b
+
+    c = factory.create("FakePipeline", {"language_model": "fake_md"})
+    assert c is not a
+    assert c.settings == {"language_model": "fake_md"}
+
+    info = {i.settings["language_model"]: i for i in factory.info()}
+    assert info["fake_sm"].hits == 1
+    assert info["fake_md"].hits == 0
+
+
+def test_lru_eviction(monkeypatch):
+    monkeypatch.setitem(vars(app.pipeline), "FakePipeline", FakePipeline)
+    factory = PipelineFactory(max_pipelines=2)
+    evicted = []
+    factory.eviction_hooks.append(lambda entry: evicted.append(entry.pipeline))
+
+    sm = factory.create("FakePipeline", {"language_model": "sm"})
+    md = factory.create("FakePipeline", {"language_model": "md"})
+    # "sm" is now the most recently used one
+    factory.create("FakePipeline", {"language_model": "sm"})
+    factory.create("FakePipeline", {"language_model": "lg"})
+
+    assert evicted == [md]
+    assert md.nlp is None
+    assert sm.nlp is not None
+    assert [i.settings["language_model"] for i in factory.info()] == ["sm", "lg"]
+
+
+def test_no_dispose_while_checked_out(monkeypatch):
+    monkeypatch.setitem(vars(app.pipeline), "FakePipeline", FakePipeline)
+    factory = PipelineFactory(max_pipelines=1)
+    evicted = []
+    factory.eviction_hooks.append(lambda entry: evicted.append(entry.pipeline))
+
+    with factory.checkout("FakePipeline", {"language_model": "sm"}) as sm:
+        with factory.checkout("FakePipeline", {"language_model": "sm"}) as same:
+            assert same is sm
+            # evicted from the cache, but still in use
+            factory.create("FakePipeline", {"language_model": "md"})
+            assert [i.settings["language_model"] for i in factory.info()] == ["md"]
+            assert sm.nlp is not None
+
+        assert evicted == []
+        assert sm.nlp is not None
+
+    # disposed with the last release
+    assert evicted == [sm]
+    assert sm.nlp is None
+
+
+def test_disabled_pipes_from_query_string():
+    pipeline = DefaultSummarizerPipeline("default")
+    pipeline.nlp = SimpleNamespace(pipe_names=["cleaner", "tagger", "parser", "ner"])
+
+    # query params are strings: "cleaner" must not disable "ner" (substring) or be split into chars
+    assert pipeline._disabled_pipes({"disable": "cleaner"}) == ["cleaner"]
+    assert pipeline._disabled_pipes({"disable": "cleaner, parser"}) == [
+        "cleaner",
+        "parser",
+    ]
+    assert pipeline._disabled_pipes({"disable": ["cleaner"]}) == ["cleaner"]
+    assert pipeline._disabled_pipes({"enable": "cleaner,ner"}) == ["tagger", "parser"]
+    assert pipeline._disabled_pipes({}) == []
+
+
+def test_definitions_stage_is_optional():
+    pipeline = DefaultSummarizerPipeline("default")
+    pipeline.nlp = SimpleNamespace(pipe_names=["cleaner", "ner", "definitions"])
+
+    assert pipeline._disabled_pipes({}) == ["definitions"]
+    assert pipeline._disabled_pipes({"disable": "cleaner"}) == [
+        "cleaner",
+        "definitions",
+    ]
+    assert pipeline._disabled_pipes({"prefetch_definitions": "true"}) == []
+    assert pipeline._disabled_pipes(
+        {"disable": "cleaner", "prefetch_definitions": "true"}
+    ) == ["cleaner"]
+    assert pipeline._disabled_pipes({"enable": "ner,definitions"}) == ["cleaner"]
+
+
+def test_stages_of_the_docs_own_pipeline(monkeypatch):
+    monkeypatch.setitem(vars(app.pipeline), "MarkerPipeline", MarkerPipeline)
+    factory = PipelineFactory(max_pipelines=1)
+
+    with factory.checkout("MarkerPipeline", {"language_model": "sm"}) as sm:
+        sm_doc = sm.run("A document.")
+        # the second pipeline evicts the first one, while its doc is in flight
+        md = factory.create("MarkerPipeline", {"language_model": "md"})
+        md_doc = md.run("Another document.")
+        assert md_doc._.marker == "md"
+
+    # disposed, but the extension is still there and the doc still has its pipeline
+    assert sm.nlp is None
+    assert sm_doc._.marker == "sm"
+    assert md.run("A third document.")._.marker == "md"
@@ -0,0 +1,73 @@
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+from app.api import API_V1
+from app.cache import TieredCache
+
+
+client = TestClient(API_V1)
+
+
+def test_tiered_cache(tmpdir):
+    path = os.path.join(str(tmpdir), "cache.sqlite")
+    cache = TieredCache("test", maxsize=2, ttl=60, path=path)
+
+    for i in range(3):
+        cache.set(f"key{i}", {"value": i})
+    # evicted from memory, but still on disk
+    assert len(cache._memory) == 2
+    assert cache.get("key0") == {"value": 0}
+    assert cache.disk_hits == 1
+
+    # expired entries are misses
+    cache.set("expired", "value", ttl=-1)
+    assert cache.get("expired") is None
+
+    # the disk tier survives a "restart"
+    assert TieredCache("test", path=path).get("key1") == {"value": 1}
+
+    assert cache.clear() == 4
+    assert cache.get("key1") is None
+
+
+def test_tiered_cache_connection_per_process(tmpdir, monkeypatch):
+    path = os.path.join(str(tmpdir), "cache.sqlite")
+    cache = TieredCache("test", path=path)
+    # opened on first use, not when created (e.g. at import time)
+    assert not os.path.exists(path)
+
+    cache.set("key", "value")
+    parent_db = cache.db
+    assert os.path.exists(path)
+
+    # a forked worker doesn't use the connection of its parent
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    cache._memory.clear()
+    assert cache.get("key") == "value"
+    assert cache.db is not parent_db
+
+
+def test_pipeline_result_cache():
+    text = f"The patient was discharged on {time.time()}. There were no complications."
+    data = {"text": text, "settings": {"disable": ["health_analyzer"]}}
+
+    first = client.post("/pipeline/default", json=data).json()
+    assert first["meta"]["result_cache"] == "miss"
+
+    # same cleaned text -> same result
+    second = client.post(
+        "/pipeline/default", json={**data, "text": "  " + text + "\n"}
+    ).json()
+    assert second["meta"]["result_cache"] == "hit"
+    assert second["meta"]["result_cache_key"] == first["meta"]["result_cache_key"]
+    assert second["text"] == first["text"]
+    # only the analysis results come from the cache, not the fields of the first execution
+    assert second["meta"]["execution_id"] != first["meta"]["execution_id"]
+    assert second["meta"]["pipeline_started"] > first["meta"]["pipeline_started"]
+
+    key = first["meta"]["result_cache_key"]
+    assert client.delete(f"/cache/results?key={key}").json() == {"purged": 1}
+    third = client.post("/pipeline/default", json=data).json()
+    assert third["meta"]["result_cache"] == "miss"
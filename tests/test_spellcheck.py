@@ -0,0 +1,44 @@
+from app.extractor.spellcheck import Spellchecker, SpellcheckerRegistry
+
+
+def test_persisted_index(tmp_path):
+    built = Spellchecker(language="en", cache_dir=str(tmp_path))
+    assert built.index_source == "dictionary"
+    assert len(list(tmp_path.glob("*.pickle"))) == 1
+
+    loaded = Spellchecker(language="en", cache_dir=str(tmp_path))
+    assert loaded.index_source == "pickle"
+    assert loaded.correct_word("mnlicious") == built.correct_word("mnlicious")
+
+
+def test_memo(tmp_path):
+    spellcheck = Spellchecker(language="en", cache_dir=str(tmp_path), memo_size=2)
+    assert spellcheck.correct_word("mnlicious,") == "malicious,"
+    assert spellcheck.correct_word("mnlicious,") == "malicious,"
+    assert spellcheck.memo_hits == 1
+
+    spellcheck.correct_word("recieve")
+    spellcheck.correct_word("langauge")
+    assert "mnlicious," not in spellcheck._memo
+
+
+def test_correct_words(tmp_path):
+    spellcheck = Spellchecker(language="en", cache_dir=str(tmp_path))
+    spellcheck.correct_word("recieve")
+
+    words = ["mnlicious", "the", "recieve", "mnlicious", "12-34"]
+    corrected, stats = spellcheck.correct_words(words)
+    assert corrected == ["malicious", "the", "receive", "malicious", "12-34"]
+    assert stats == {
+        "words": 5,
+        "unique": 4,
+        "corrected": 2,
+        "skipped": 2,
+        "cached": 1,
+    }
+
+
+def test_registry():
+    registry = SpellcheckerRegistry(preload="")
+    assert registry.get("xx") is registry.get("xx")
+    assert registry.get("xx").correct_word("mnlicious") == "mnlicious"
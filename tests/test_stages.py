@@ -0,0 +1,85 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from app.pipeline import PipelineFactoryInstance
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+def _simple_text() -> str:
+    with open(f"{TEST_DOCS}/txt/simple.txt", encoding="UTF-8") as f:
+        return f.read()
+
+
+def test_stages_compute_once():
+    pipeline = PipelineFactoryInstance.create("default")
+    result = pipeline.execute(
+        text=_simple_text(),
+        settings={"disable": ["health_analyzer"], "result_cache": "false"},
+    )
+
+    computations = result.meta["stage_computations"]
+    # the summary is used by rouge_scorer, readability and the report, but computed once
+    assert computations["summarizer"] == 1
+    assert all(count == 1 for count in computations.values())
+
+
+def test_readability_concurrent():
+    pipeline = PipelineFactoryInstance.create("default")
+    settings = {"disable": ["health_analyzer"], "result_cache": "false"}
+
+    # documents of different length and content, e.g. different summaries and scores
+    sentences = _simple_text().split(". ")
+    texts = [". ".join(sentences[i : i + 10 + i]) + "." for i in range(0, 40, 2)]
+
+    def readability(text):
+        return pipeline.execute(text=text, settings=settings).meta.get("readability")
+
+    expected = [readability(text) for text in texts]
+    assert len({str(scores) for scores in expected}) > 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(3):
+            assert list(executor.map(readability, texts)) == expected
+
+
+def test_cleaning_before_tokenization():
+    pipeline = PipelineFactoryInstance.create("default")
+    raw = "  Contact   the\nBoston    Children's Hospital -\n see  https://example.com  or  Boston  \n"
+    result = pipeline.execute(
+        text=raw,
+        settings={
+            "enable": ["cleaner", "ner", "report_collector"],
+            "result_cache": "false",
+        },
+    )
+
+    # the same text as cleaning the tokenized text
+    assert result.text == pipeline.nlp.get_pipe("cleaner").engine.clean(raw)
+    assert result.meta["stage_computations"] == {"report_collector": 1}
+
+    offsets = result.meta["named_entity_offsets"]
+    assert offsets
+    for entity in offsets:
+        assert result.text[entity["start"] : entity["end"]] == entity["text"]
+        assert (
+            raw[entity["raw_start"] : entity["raw_end"]].split()
+            == entity["text"].split()
+        )
+
+
+def test_disabled_health_analyzer_not_collected(monkeypatch):
+    pipeline = PipelineFactoryInstance.create("default")
+    analyzer = pipeline.nlp.get_pipe("health_analyzer")
+    monkeypatch.setattr(analyzer, "_endpoint", "https://example.com")
+    monkeypatch.setattr(analyzer, "_analyze_health_text", lambda doc: {"diagnosis": []})
+
+    # registers the (global) health_analyzer extension
+    pipeline.execute(text=_simple_text(), settings={"result_cache": "false"})
+
+    result = pipeline.execute(
+        text=_simple_text(),
+        settings={"disable": ["health_analyzer"], "result_cache": "false"},
+    )
+    assert "health_analyzer" not in result.meta["stage_computations"]
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+from app.extractor.base import BaseExtractor
+from app.extractor.universal_extractor import UniversalExtractor
+from app.models import ExtractorRequest, ExtractorResponse
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+class FakeExtractor(BaseExtractor):
+    """
+    Sync extractor, remembers in which threads it was called
+    """
+
+    def __init__(self, name: str, handles: bool = True, fails: bool = False):
+        self.name = name
+        self.handles = handles
+        self.fails = fails
+        self.threads = []
+
+    def can_handle(self, request: ExtractorRequest) -> bool:
+        self.threads.append(threading.current_thread().name)
+        return self.handles
+
+    def extract(self, request: ExtractorRequest) -> ExtractorResponse:
+        self.threads.append(threading.current_thread().name)
+        if self.fails:
+            raise Exception(f"{self.name} failed")
+        return ExtractorResponse(text=self.name, meta={})
+
+
+def _extractor(**fakes) -> UniversalExtractor:
+    extractor = UniversalExtractor()
+    for name in ["tika", "wikipedia", "web_article", "image_ocr", "abbyy_ocr"]:
+        setattr(extractor, name, fakes.get(name, FakeExtractor(name, handles=False)))
+    return extractor
+
+
+def _run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_route_by_content_type():
+    abbyy_ocr = FakeExtractor("abbyy_ocr", handles=False)
+    image_ocr = FakeExtractor("image_ocr")
+    web_article = FakeExtractor("web_article")
+    extractor = _extractor(
+        abbyy_ocr=abbyy_ocr, image_ocr=image_ocr, web_article=web_article
+    )
+
+    result = _run(extractor.aextract(ExtractorRequest(buffer=PNG)))
+    assert result.text == "image_ocr"
+    assert result.meta["detected_content_type"] == "image/png"
+
+    # both image extractors were asked, in the extractor thread pool
+    assert len(abbyy_ocr.threads) == 1
+    assert all(t.startswith("extractor") for t in abbyy_ocr.threads + image_ocr.threads)
+    # not the html extractor
+    assert web_article.threads == []
+
+    # same route for the sync API
+    result = extractor.extract(ExtractorRequest(buffer=PNG))
+    assert result.text == "image_ocr"
+
+
+def test_wikipedia_without_content_type():
+    extractor = _extractor(wikipedia=FakeExtractor("wikipedia"))
+
+    result = _run(
+        extractor.aextract(
+            ExtractorRequest(url="https://en.wikipedia.org/wiki/Breast_cancer")
+        )
+    )
+    # nothing was downloaded to detect the content type
+    assert result.text == "wikipedia"
+    assert "detected_content_type" not in result.meta
+
+
+def test_fallback_to_tika():
+    extractor = _extractor(
+        tika=FakeExtractor("tika"),
+        image_ocr=FakeExtractor("image_ocr", fails=True),
+    )
+
+    result = _run(extractor.aextract(ExtractorRequest(buffer=PNG)))
+    assert result.text == "tika"
+
+    # no specialized extractor for plain text
+    result = _run(
+        extractor.aextract(ExtractorRequest(filename="note.txt", buffer=b"some text"))
+    )
+    assert result.text == "tika"
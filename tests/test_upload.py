@@ -0,0 +1,147 @@
+import asyncio
+import os
+
+import pytest
+
+from app.extractor.fetch import FETCH_HEAD_BYTES, FetchContext
+from app.extractor.upload import (
+    UPLOAD_FORM_SLACK_BYTES,
+    InvalidUpload,
+    SpooledUpload,
+    UploadTooLarge,
+)
+
+
+TEST_DOCS = f"{os.path.dirname(__file__)}/../test-documents"
+
+
+BOUNDARY = "----upload-boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def _body(data: bytes, filename: str = "simple.pdf") -> bytes:
+    """
+    A multipart/form-data body with another field in front of the file
+    """
+    return (
+        (
+            f"--{BOUNDARY}\r\n"
+            'Content-Disposition: form-data; name="comment"\r\n\r\n'
+            "not the file\r\n"
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/pdf\r\n\r\n"
+        ).encode("latin-1")
+        + data
+        + f"\r\n--{BOUNDARY}--\r\n".encode("latin-1")
+    )
+
+
+class Stream(object):
+    """
+    The request body in chunks of 'size' bytes, like Starlette's request.stream(). Counts what was read
+    """
+
+    def __init__(self, body: bytes, size: int = 700):
+        self.chunks = [body[i : i + size] for i in range(0, len(body), size)]
+        self.read = 0
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.read += len(chunk)
+            yield chunk
+
+
+def _from_stream(stream: Stream, **kwargs) -> SpooledUpload:
+    return asyncio.new_event_loop().run_until_complete(
+        SpooledUpload.from_stream(stream, CONTENT_TYPE, **kwargs)
+    )
+
+
+def test_spool_upload():
+    with open(f"{TEST_DOCS}/research_papers/simple.pdf", "rb") as f:
+        data = f.read()
+
+    upload = _from_stream(Stream(_body(data)), chunk_size=1000, in_memory_max_bytes=0)
+    try:
+        assert upload.filename == "simple.pdf"
+        assert upload.content_type == "application/pdf"
+        assert upload.size == len(data)
+        assert upload.buffer is None
+        assert upload.path.endswith(".pdf")
+        with open(upload.path, "rb") as f:
+            assert f.read() == data
+
+        # the extractors get the spooled file, with the first bytes for content type detection
+        request = upload.extractor_request({"content_type": "application/pdf"})
+        assert request.filename == upload.path
+        assert request._fetch.head() == data[:FETCH_HEAD_BYTES]
+        assert request._fetch.declared_content_type == "application/pdf"
+    finally:
+        path = upload.path
+        upload.close()
+
+    assert not os.path.exists(path)
+
+
+def test_upload_too_large():
+    body = _body(b"x" * 10000)
+
+    with pytest.raises(UploadTooLarge):
+        _from_stream(
+            Stream(body), max_bytes=2500, chunk_size=1000, in_memory_max_bytes=0
+        )
+
+    # a chunked upload without a Content-Length: stops reading the body right after the limit
+    stream = Stream(body, size=100)
+    with pytest.raises(UploadTooLarge):
+        _from_stream(stream, max_bytes=100, chunk_size=50)
+    assert stream.read < 100 + UPLOAD_FORM_SLACK_BYTES
+    assert stream.read < len(body)
+
+
+def test_invalid_upload():
+    with pytest.raises(InvalidUpload):
+        asyncio.new_event_loop().run_until_complete(
+            SpooledUpload.from_stream(Stream(b"{}"), "application/json")
+        )
+
+    with pytest.raises(InvalidUpload):
+        _from_stream(Stream(_body(b"data")), field="document")
+
+
+def test_small_upload_in_memory():
+    data = b"%PDF-1.4 a small document"
+    upload = _from_stream(Stream(_body(data, "note.pdf"), size=10))
+
+    # no temp file
+    assert upload.path is None
+    request = upload.extractor_request({"content_type": "application/pdf"})
+    assert request.buffer == data
+    assert request.filename == "note.pdf"
+
+    fetch = request._fetch
+    assert fetch.head() == data
+    assert not fetch.is_spooled()
+    assert fetch.content() is upload.buffer
+    assert fetch.input == "buffer"
+    upload.close()
+
+
+def test_buffer_to_file():
+    # only if an extractor asks for a path, the buffer is written to disk
+    fetch = FetchContext(filename="note.txt", buffer=memoryview(b"some text"))
+    try:
+        with fetch.open() as f:
+            assert f.read() == b"some text"
+        assert fetch.input == "buffer"
+
+        path = fetch.path()
+        assert path.endswith(".txt")
+        with open(path, "rb") as f:
+            assert f.read() == b"some text"
+        assert fetch.input == "file"
+    finally:
+        fetch.close()
+
+    assert not os.path.exists(path)
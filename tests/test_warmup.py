@@ -0,0 +1,36 @@
+from fastapi.testclient import TestClient
+
+import app.api
+from app.api import API_V1
+from app.warmup import PipelineWarmup, parse_pipeline_specs
+
+
+client = TestClient(API_V1)
+
+
+def test_parse_pipeline_specs():
+    assert parse_pipeline_specs("default, default:en_core_web_sm,") == [
+        ("default", {}),
+        ("default", {"language_model": "en_core_web_sm"}),
+    ]
+    assert parse_pipeline_specs("") == []
+
+
+def test_readiness(monkeypatch):
+    warmup = PipelineWarmup("default")
+    monkeypatch.setattr(app.api, "PipelineWarmupInstance", warmup)
+
+    assert client.get("/healthz").status_code == 200
+
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["pipelines"]["default"]["status"] == "pending"
+
+    warmup.start(background=False)
+
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    status = response.json()["pipelines"]["default"]
+    assert status["status"] == "ready"
+    assert "load_time_ms" in status
+    assert "warmup_time_ms" in status